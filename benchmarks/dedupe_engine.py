@@ -0,0 +1,134 @@
+"""Throughput of the numpy duplicate frame detector against ffmpeg's mpdecimate.
+
+    python -m benchmarks.dedupe_engine [recording.mkv] [--seconds 60]
+
+Both engines only decide which frames to keep here, neither encodes anything,
+so this compares the analysis cost alone. Without a recording a synthetic one
+is generated that alternates between motion and still frames. Results are
+printed as JSON.
+"""
+import argparse
+from decimal import Decimal
+import json
+from pathlib import Path
+import sys
+from tempfile import TemporaryDirectory
+import time
+
+from benchmarks.footage import Footage
+from vedit.ffmpeg import FFmpeg
+from vedit.regions import ANALYSIS_HEIGHT, ANALYSIS_WIDTH, AnalysisRegions
+from vedit.logger import get_logger
+from vedit.frame_dedupe import (
+    DuplicateDetector,
+    analysis_mask,
+    read_frames,
+    np,
+    require_numpy,
+)
+
+
+def make_recording(out_file: Path, seconds: int) -> Path:
+    # Motion, then the last frame held still, three times over
+    span = max(seconds // 6, 1)
+    return Footage(tuple([("motion", span), ("still", span)] * 3)).make(out_file)
+
+
+def bench_mpdecimate(ffmpeg: FFmpeg, recording: Path, time_range) -> float:
+    started = time.perf_counter()
+    ffmpeg.run(
+        "-ss",
+        str(time_range[0]),
+        "-t",
+        str(time_range[1] - time_range[0]),
+        "-i",
+        recording.as_posix(),
+        "-an",
+        "-vf",
+        f"{AnalysisRegions().filter(ANALYSIS_WIDTH, ANALYSIS_HEIGHT)},mpdecimate",
+        "-f",
+        "null",
+        "-",
+        stage="mpdecimate",
+    )
+    return time.perf_counter() - started
+
+
+def bench_numpy(ffmpeg: FFmpeg, recording: Path, time_range) -> dict:
+    regions = AnalysisRegions()
+    detector = DuplicateDetector(analysis_mask(regions))
+    height, width = detector.mask.shape
+    frames_read = 0
+
+    def counted(batches):
+        nonlocal frames_read
+        for batch in batches:
+            frames_read += len(batch)
+            yield batch
+
+    started = time.perf_counter()
+    with ffmpeg.raw_frames(
+        recording,
+        ANALYSIS_WIDTH,
+        ANALYSIS_HEIGHT,
+        time_range=time_range,
+        regions=regions,
+    ) as stream:
+        keep = detector.frames_to_keep(counted(read_frames(stream, width, height)))
+    total_secs = time.perf_counter() - started
+
+    # The comparisons on their own, without waiting on the decoder
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 255, (frames_read, height, width), dtype=np.uint8)
+    # Every other frame is a duplicate
+    frames[1::2] = frames[::2][: len(frames[1::2])]
+    started = time.perf_counter()
+    detector.frames_to_keep(iter([frames]))
+    compare_secs = time.perf_counter() - started
+
+    return dict(
+        secs=total_secs,
+        frames=frames_read,
+        kept=len(keep),
+        fps=frames_read / total_secs,
+        compare_only_fps=frames_read / compare_secs,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("recording", type=Path, nargs="?")
+    parser.add_argument("--seconds", type=int, default=60)
+    args = parser.parse_args()
+    require_numpy()
+    # Keep stdout for the results
+    get_logger().out_stream = sys.stderr
+
+    with TemporaryDirectory() as tmp_dir:
+        recording = args.recording or make_recording(
+            Path(tmp_dir) / "synthetic.mkv", args.seconds
+        )
+        time_range = (Decimal(0), Decimal(args.seconds))
+        ffmpeg = FFmpeg()
+
+        numpy_result = bench_numpy(ffmpeg, recording, time_range)
+        mpdecimate_secs = bench_mpdecimate(ffmpeg, recording, time_range)
+
+    print(
+        json.dumps(
+            dict(
+                recording=str(args.recording or "synthetic"),
+                seconds=args.seconds,
+                numpy=numpy_result,
+                mpdecimate=dict(
+                    secs=mpdecimate_secs,
+                    fps=numpy_result["frames"] / mpdecimate_secs,
+                ),
+            ),
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
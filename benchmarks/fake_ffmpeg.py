@@ -0,0 +1,271 @@
+"""A stand-in for ffmpeg and ffprobe that doesn't decode or encode anything.
+
+It answers the commands FFmpeg runs the way the real programs would, with
+the same progress and frame counts on stderr, so everything around ffmpeg
+can be timed on its own. Recordings are small JSON files describing the
+video instead of video:
+
+    {"duration": 600, "width": 1920, "height": 1080, "frame_rate": 30,
+     "still": [[10, 30], [45, 60]], "keyframe_secs": 2}
+
+Frames in a still span are duplicates of the first one, and their packets
+are tiny unless they are keyframes. Outputs are written
+the same way, so what one stage makes the next can read.
+
+How long each run takes is set with the VEDIT_FAKE_FFMPEG environment
+variable, as JSON: {"run_secs": 0.01, "speed": 50} takes 10ms plus a
+second for every 50 seconds of video. Linux and macOS only, install()
+writes shell scripts.
+"""
+import json
+import math
+import os
+from pathlib import Path
+import re
+import stat
+import sys
+import time
+
+ENV_VAR = "VEDIT_FAKE_FFMPEG"
+
+
+def install(bin_dir: Path) -> Path:
+    """Put ffmpeg and ffprobe scripts in bin_dir, for FFmpeg(bin_dir=...)."""
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for program in ["ffmpeg", "ffprobe"]:
+        script = bin_dir / program
+        script.write_text(
+            f'#!/bin/sh\nexec "{sys.executable}" "{Path(__file__).resolve()}" '
+            f'{program} "$@"\n'
+        )
+        script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    return bin_dir
+
+
+def write_recording(
+    path: Path,
+    duration: float,
+    width: int = 1920,
+    height: int = 1080,
+    frame_rate: int = 30,
+    still: list[tuple[float, float]] = (),
+) -> Path:
+    path.write_text(
+        json.dumps(
+            dict(
+                duration=duration,
+                width=width,
+                height=height,
+                frame_rate=frame_rate,
+                still=[list(span) for span in still],
+            )
+        )
+    )
+    return path
+
+
+def read_input(path: str, fmt: str | None) -> dict:
+    if fmt != "concat":
+        return json.loads(Path(path).read_text())
+
+    # Everything in a concat list is back to back
+    parts = [
+        json.loads(Path(line[len("file '") : -1]).read_text())
+        for line in Path(path).read_text().splitlines()
+        if line.startswith("file '")
+    ]
+    offset = 0.0
+    still = []
+    for part in parts:
+        still += [[offset + start, offset + end] for start, end in part["still"]]
+        offset += part["duration"]
+    return dict(parts[0], duration=offset, still=still)
+
+
+def cut(video: dict, start: float, duration: float | None) -> dict:
+    end = video["duration"] if duration is None else start + duration
+    end = min(end, video["duration"])
+    still = [
+        [max(s, start) - start, min(e, end) - start]
+        for s, e in video["still"]
+        if s < end and e > start
+    ]
+    return dict(video, duration=end - start, still=still)
+
+
+def kept_frames(video: dict) -> list[int]:
+    """The frames mpdecimate would keep, the first of every still span included."""
+    rate = video["frame_rate"]
+    duplicates = set()
+    for start, end in video["still"]:
+        duplicates.update(range(math.ceil(start * rate) + 1, math.ceil(end * rate)))
+    frames = round(video["duration"] * rate)
+    return [n for n in range(frames) if n not in duplicates]
+
+
+def option(args: list[str], name: str, before: int | None = None) -> str | None:
+    args = args[:before]
+    if name in args:
+        return args[args.index(name) + 1]
+    return None
+
+
+def ffprobe(args: list[str]) -> None:
+    video = json.loads(Path(args[-1]).read_text())
+    if "packet=pts_time,size,flags" in args:
+        # A keyframe every keyframe_secs, duplicate frames take next to nothing
+        rate = video["frame_rate"]
+        key_every = round(video.get("keyframe_secs", 2) * rate)
+        kept = set(kept_frames(video))
+        for n in range(round(video["duration"] * rate)):
+            size, flags = (30000, "K__") if n % key_every == 0 else (20000, "___")
+            if n not in kept and n % key_every:
+                size = 12
+            print(f"{n / rate:.6f},{size},{flags}")
+        return
+    if "json" not in args:
+        print(video["duration"])
+        return
+    print(
+        json.dumps(
+            dict(
+                streams=[
+                    dict(
+                        codec_name="h264",
+                        width=video["width"],
+                        height=video["height"],
+                        avg_frame_rate=f"{video['frame_rate']}/1",
+                        r_frame_rate=f"{video['frame_rate']}/1",
+                    )
+                ],
+                format=dict(duration=str(video["duration"])),
+            )
+        )
+    )
+
+
+def ffmpeg(args: list[str], settings: dict) -> None:
+    input_at = args.index("-i")
+    video = read_input(args[input_at + 1], option(args, "-f", before=input_at))
+    start = float(option(args, "-ss", before=input_at) or 0)
+    duration = option(args, "-t", before=input_at) or option(args, "-t")
+    video = cut(video, start, float(duration) if duration else None)
+
+    filters = " ".join(
+        filter(
+            None,
+            [
+                option(args, "-vf"),
+                option(args, "-filter:v"),
+                option(args, "-filter_complex"),
+            ],
+        )
+    )
+    if script := option(args, "-filter_script:v") or option(
+        args, "-filter_complex_script"
+    ):
+        filters += Path(script).read_text()
+    frames_in = round(video["duration"] * video["frame_rate"])
+    keep = kept_frames(video)
+    deduped = "mpdecimate" in filters or "select=" in filters
+    frames_out = len(keep) if deduped else frames_in
+
+    # dedupe and select_frames count the frames read in an output of its own
+    counts_reads = "[read]" in filters
+    output = args[-1]
+    if "[pts]" in filters:
+        # raw_frames writes the timestamps of its frames to a file, from the
+        # first frame at or after the seek point
+        rate = video["frame_rate"]
+        first = math.ceil(start * rate - 1e-9)
+        pts = [round(((first + n) / rate - start) * 1000) for n in range(frames_in)]
+        Path(output).write_text(
+            "#tb 0: 1/1000\n" + "".join(f"0, {t}, {t}, 1, 0, 0x0\n" for t in pts)
+        )
+        output = "-"
+    outputs = args[input_at:]
+    fmt = option(outputs[outputs.index("[out]") :] if counts_reads else outputs, "-f")
+    if output == "-" and fmt == "framecrc":
+        sys.stdout.write("#tb 0: 1/1\n")
+        sys.stdout.writelines(f"0, {n}, {n}, 1, 64, 0x00000000\n" for n in keep)
+    elif output == "-" and fmt == "rawvideo":
+        sizes = [
+            tuple(map(int, size)) for size in re.findall(r"scale=(\d+):(\d+)", filters)
+        ]
+        width, height = sizes[0]
+        if "hstack" in filters:
+            # Analysis regions side by side
+            width, height = sum(w for w, _ in sizes), max(h for _, h in sizes)
+        # A new shade for every kept frame, repeated for its duplicates
+        shade = -16
+        kept = set(keep)
+        for n in range(frames_in):
+            if n in kept:
+                shade = (shade + 16) % 256
+            sys.stdout.buffer.write(bytes([shade]) * (width * height))
+    elif fmt == "segment":
+        if split_at := option(args, "-segment_times"):
+            split_at = map(float, split_at.split(","))
+        else:
+            segment_secs = float(option(args, "-segment_time"))
+            pieces = math.ceil(video["duration"] / segment_secs)
+            split_at = [i * segment_secs for i in range(1, pieces)]
+        # Pieces start on the first keyframe at or after each requested time
+        key_secs = video.get("keyframe_secs", 2)
+        cuts = {
+            math.ceil((start + t) / key_secs - 1e-9) * key_secs - start
+            for t in split_at
+        }
+        bounds = [0.0, *sorted(t for t in cuts if 0 < t < video["duration"])]
+        bounds.append(video["duration"])
+        segment_list = option(args, "-segment_list")
+        for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+            Path(output % i).write_text(json.dumps(cut(video, start, end - start)))
+            if segment_list:
+                with open(segment_list, "a") as f:
+                    f.write(f"{Path(output % i).name},{start:.6f},{end:.6f}\n")
+    elif output != "-":
+        if deduped:
+            video = dict(video, duration=len(keep) / video["frame_rate"], still=[])
+        Path(output).write_text(json.dumps(video))
+
+    secs = settings.get("run_secs", 0)
+    if speed := settings.get("speed"):
+        secs += video["duration"] / speed
+    steps = max(1, round(secs / 0.5))
+    for step in range(1, steps + 1):
+        time.sleep(secs / steps)
+        frame = (frames_in if counts_reads else frames_out) * step // steps
+        elapsed = secs * step / steps
+        sys.stderr.write(
+            f"frame={frame}\nfps={frame / elapsed if elapsed else 0:.1f}\n"
+            f"out_time_us={int(1e6 * frames_out * step // steps / video['frame_rate'])}\n"
+            f"speed={video['duration'] / secs if secs else 0:.2f}x\n"
+            f"progress={'end' if step == steps else 'continue'}\n"
+        )
+    if counts_reads:
+        sys.stderr.write(
+            f"[out#0/null @ 0x0] [verbose] Output stream #0:0 (video): {frames_in} "
+            f"frames encoded; {frames_in} packets muxed (0 bytes);\n"
+        )
+    # Seeking starts from the keyframe before, frames up to the seek point
+    # are read and thrown away
+    skipped = round(start % video.get("keyframe_secs", 2) * video["frame_rate"])
+    sys.stderr.write(
+        f"[verbose] Input stream #0:0 (video): {frames_in + skipped} packets read "
+        f"(0 bytes); {frames_in + skipped} frames decoded; 0 decode errors;\n"
+        f"[verbose] Output stream #0:0 (video): {frames_out} frames encoded; "
+        f"{frames_out} packets muxed (0 bytes);\n"
+    )
+
+
+def main() -> None:
+    program, *args = sys.argv[1:]
+    if program == "ffprobe":
+        ffprobe(args)
+    else:
+        ffmpeg(args, json.loads(os.environ.get(ENV_VAR) or "{}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Reproducible synthetic recordings made with ffmpeg's lavfi sources.
+
+A recording is a list of spans, each written as kind:seconds:
+
+* motion: testsrc2, every frame differs
+* still: a single frame held, every frame after the first is a duplicate
+* masked: a held frame with a box blinking in the bottom strip, which the
+  dedupe mask leaves out, so these frames are duplicates too
+
+    python -m benchmarks.footage out.mkv motion:10,still:20 [--size 1920x1080]
+"""
+import argparse
+from dataclasses import dataclass
+import hashlib
+from pathlib import Path
+import shutil
+import subprocess
+
+DEFAULT_SPANS = "motion:10,still:20,masked:10,motion:10,still:10"
+SPAN_KINDS = ("motion", "still", "masked")
+
+
+@dataclass(frozen=True)
+class Footage:
+    spans: tuple[tuple[str, float], ...]
+    width: int = 1920
+    height: int = 1080
+    frame_rate: int = 30
+
+    @classmethod
+    def parse(cls, spans: str, size: str = "1920x1080", frame_rate: int = 30):
+        parsed = []
+        for span in spans.split(","):
+            kind, seconds = span.split(":")
+            if kind not in SPAN_KINDS:
+                raise ValueError(
+                    f"Unknown span {kind!r}, expected one of {', '.join(SPAN_KINDS)}"
+                )
+            parsed.append((kind, float(seconds)))
+        width, height = map(int, size.split("x"))
+        return cls(tuple(parsed), width, height, frame_rate)
+
+    @property
+    def duration(self) -> float:
+        return sum(seconds for _, seconds in self.spans)
+
+    @property
+    def key(self) -> str:
+        return hashlib.sha1(repr(self).encode()).hexdigest()[:12]
+
+    def filter_graph(self) -> str:
+        size = f"{self.width}x{self.height}"
+        sources = []
+        for i, (kind, seconds) in enumerate(self.spans):
+            frames = round(seconds * self.frame_rate)
+            source = f"testsrc2=size={size}:rate={self.frame_rate}"
+            if kind == "motion":
+                sources.append(f"{source}:duration={seconds},trim=end_frame={frames}")
+                continue
+            # Start from a different frame for each span, so spans differ
+            held = (
+                f"{source}:duration={seconds + 1},trim=start_frame={i}:end_frame={i + 1},"
+                f"tpad=stop_mode=clone:stop={frames - 1},setpts=N/{self.frame_rate}/TB"
+            )
+            if kind == "masked":
+                held += (
+                    ",drawbox=x=iw*0.3:y=ih*0.85:w=iw*0.1:h=ih*0.1:c=white:t=fill"
+                    ":enable='mod(n,2)'"
+                )
+            sources.append(held)
+
+        graph = ";".join(f"{source}[s{i}]" for i, source in enumerate(sources))
+        inputs = "".join(f"[s{i}]" for i in range(len(sources)))
+        return f"{graph};{inputs}concat=n={len(sources)}"
+
+    def make(self, out_file: Path, ffmpeg: str = "ffmpeg") -> Path:
+        subprocess.run(
+            [
+                ffmpeg,
+                "-v",
+                "error",
+                "-y",
+                "-filter_complex",
+                self.filter_graph(),
+                "-c:v",
+                "libx264",
+                "-preset",
+                "ultrafast",
+                "-threads",
+                "1",
+                out_file.as_posix(),
+            ],
+            check=True,
+        )
+        return out_file
+
+    def cached(self, cache_dir: Path, ffmpeg: str = "ffmpeg") -> Path:
+        """The recording in cache_dir, only made if it isn't there yet."""
+        out_file = cache_dir / f"{self.key}.mkv"
+        if not out_file.exists():
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_dir / f"{self.key}.tmp.mkv"
+            self.make(tmp_file, ffmpeg)
+            tmp_file.replace(out_file)
+        return out_file
+
+
+def make_folder(
+    folder: Path,
+    footage: Footage,
+    recordings: int,
+    cache_dir: Path,
+    ffmpeg: str = "ffmpeg",
+) -> list[Path]:
+    """A folder of recordings named like OBS names them, ready for process_dir."""
+    folder.mkdir(parents=True, exist_ok=True)
+    source = footage.cached(cache_dir, ffmpeg)
+    paths = []
+    for hour in range(recordings):
+        path = folder / f"2023-01-01 {hour:02}-00-00.mkv"
+        shutil.copyfile(source, path)
+        paths.append(path)
+    return paths
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("out_file", type=Path)
+    parser.add_argument("spans", nargs="?", default=DEFAULT_SPANS)
+    parser.add_argument("--size", default="1920x1080")
+    parser.add_argument("--rate", type=int, default=30)
+    args = parser.parse_args()
+    Footage.parse(args.spans, args.size, args.rate).make(args.out_file)
+
+
+if __name__ == "__main__":
+    main()
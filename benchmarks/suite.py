@@ -0,0 +1,350 @@
+"""Times vedit end to end, stage by stage and in its database.
+
+    python -m benchmarks.suite [--out results.json] [--compare old.json]
+
+Recordings are generated with benchmarks.footage and cached in
+--footage-dir, so runs on the same machine process the same video.
+"orchestration" runs process_dir against benchmarks.fake_ffmpeg to time
+everything but the encoding. Results are written as JSON; --compare prints
+how each time changed against an earlier run.
+"""
+import argparse
+from contextlib import contextmanager
+from dataclasses import asdict
+from decimal import Decimal
+from datetime import datetime, timezone
+import json
+import os
+from pathlib import Path
+import platform
+import statistics
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import time
+from typing import Callable, Iterator
+
+from benchmarks import fake_ffmpeg
+from benchmarks.footage import DEFAULT_SPANS, Footage, make_folder
+from vedit.config import Config
+from vedit.db import DB, FFmpegRun
+from vedit.ffmpeg import FFmpeg
+from vedit.regions import AnalysisRegions
+from vedit.frame_dedupe import DuplicateDetector, analysis_mask, find_frames_to_keep, np
+from vedit.logger import get_logger
+from vedit.report import open_runs
+from vedit.video_editor import process_dir
+
+SUITES = ("stages", "process_dir", "db", "orchestration")
+# Times that grew by more than this are flagged by --compare
+REGRESSION_RATIO = 1.1
+
+
+class NullQueue:
+    def put(self, message: tuple) -> None:
+        pass
+
+
+def timed(fn: Callable[[], object], repeat: int) -> dict:
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - started)
+    return dict(secs=statistics.median(runs), runs=runs)
+
+
+def bench_stages(
+    ffmpeg: FFmpeg, recording: Path, footage: Footage, tmp_path: Path, repeat: int
+) -> dict:
+    time_range = (Decimal(0), Decimal(str(footage.duration)))
+    frames = ffmpeg.analyse_duplicates(recording, time_range)
+    deduped = tmp_path / "deduped.mkv"
+    stages = {
+        "probe": lambda: ffmpeg.probe(recording),
+        "cut": lambda: ffmpeg.cut_section(recording, tmp_path, *time_range),
+        "dedupe": lambda: ffmpeg.dedupe(recording, deduped, time_range=time_range),
+        "analyse": lambda: ffmpeg.analyse_duplicates(recording, time_range),
+        "select": lambda: ffmpeg.select_frames(
+            recording, frames, tmp_path / "selected.mkv", time_range=time_range
+        ),
+        "combine": lambda: ffmpeg.combine_and_speedup(
+            [deduped], 6, tmp_path / "combined.mkv", tmp_path
+        ),
+        "merge": lambda: ffmpeg.concat(
+            [deduped, deduped], tmp_path / "merged.mkv", tmp_path / "concat.txt"
+        ),
+    }
+    if np is not None:
+        regions = AnalysisRegions()
+        detector = DuplicateDetector(analysis_mask(regions))
+        stages["numpy"] = lambda: find_frames_to_keep(
+            ffmpeg, recording, detector, time_range, regions=regions
+        )
+
+    results = {}
+    for stage, fn in stages.items():
+        try:
+            results[stage] = timed(fn, repeat)
+        except (OSError, subprocess.CalledProcessError) as e:
+            results[stage] = dict(error=repr(e))
+            continue
+        results[stage]["footage_secs"] = footage.duration
+    results["analyse"]["kept_frames"] = len(frames)
+    return results
+
+
+def bench_process_dir(
+    make_ffmpeg: Callable[[], FFmpeg],
+    footage: Footage,
+    recordings: int,
+    cache_dir: Path,
+    tmp_path: Path,
+    config: Config,
+    engines: list[str],
+    program: str = "ffmpeg",
+) -> dict:
+    results = {}
+    for engine in engines:
+        folder = tmp_path / engine
+        make_folder(folder, footage, recordings, cache_dir, program)
+        ffmpeg = make_ffmpeg()
+        engine_config = Config(**dict(asdict(config), dedupe_engine=engine))
+
+        def run() -> None:
+            process_dir(folder, NullQueue(), ffmpeg, engine_config, new_logfile=False)
+
+        results[engine] = timed(run, 1)
+        results[engine]["footage_secs"] = footage.duration * recordings
+        results[engine]["stages"] = dict(ffmpeg.stage_timings)
+    return results
+
+
+def bench_db(tmp_path: Path, files: int, file_secs: int, repeat: int) -> dict:
+    source_files = [tmp_path / f"2023-01-01 {i:02}-00-00.mkv" for i in range(files)]
+
+    def plan() -> DB:
+        (tmp_path / "db.sqlite").unlink(missing_ok=True)
+        db = DB.create_db(tmp_path / "db.sqlite")
+        for file_order, source_file in enumerate(source_files):
+            db.plan_jobs(source_file, file_order, Decimal(file_secs), Decimal(10))
+        return db
+
+    def work_through() -> None:
+        db = plan()
+        while job := db.claim_job("bench:0", 300):
+            db.complete_job(job, tmp_path / f"{job.id}.mkv")
+        for source_file in source_files:
+            db.get_merge_order(source_file)
+        db.get_total_processed_duration(source_files)
+        db.close()
+
+    run = FFmpegRun(
+        "ffmpeg",
+        "dedupe",
+        "in.mkv",
+        (Decimal(0), Decimal(10)),
+        1,
+        4,
+        2**30,
+        300,
+        30,
+        0,
+    )
+
+    def record_runs() -> None:
+        db = plan()
+        db.record_runs([run] * 1000)
+        db.close()
+
+    jobs = files * file_secs // 10
+    results = {
+        "plan": timed(lambda: plan().close(), repeat),
+        "claim_complete": timed(work_through, repeat),
+        "record_runs": timed(record_runs, repeat),
+    }
+    results["plan"]["jobs"] = results["claim_complete"]["jobs"] = jobs
+    results["record_runs"]["runs"] = 1000
+    return results
+
+
+def bench_orchestration(
+    tmp_path: Path, recordings: int, recording_secs: int, config: Config, settings: dict
+) -> dict:
+    bin_dir = fake_ffmpeg.install(tmp_path / "bin")
+    folder = tmp_path / "fake"
+    folder.mkdir()
+    for hour in range(recordings):
+        fake_ffmpeg.write_recording(
+            folder / f"2023-01-01 {hour:02}-00-00.mkv",
+            recording_secs,
+            still=[(recording_secs / 4, recording_secs / 2)],
+        )
+
+    os.environ[fake_ffmpeg.ENV_VAR] = json.dumps(settings)
+    ffmpeg = FFmpeg(bin_dir=bin_dir)
+    result = timed(
+        lambda: process_dir(folder, NullQueue(), ffmpeg, config, new_logfile=False), 1
+    )
+    conn = open_runs(folder)
+    (runs,) = conn.execute("SELECT COUNT(*) FROM ffmpeg_runs").fetchone()
+    conn.close()
+    result.update(
+        ffmpeg_runs=runs,
+        secs_per_run=result["secs"] / runs,
+        footage_secs=recordings * recording_secs,
+        stages=dict(ffmpeg.stage_timings),
+    )
+    return result
+
+
+def flatten(results: dict, prefix: str = "") -> dict[str, float]:
+    """Every "secs" in results, keyed by where it is."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            if "secs" in value:
+                flat[f"{prefix}{key}"] = value["secs"]
+            else:
+                flat.update(flatten(value, f"{prefix}{key}."))
+    return flat
+
+
+def compare(old: dict, new: dict) -> str:
+    old_secs, new_secs = flatten(old["results"]), flatten(new["results"])
+    lines = []
+    for name in sorted(old_secs.keys() & new_secs.keys()):
+        ratio = new_secs[name] / old_secs[name] if old_secs[name] else 1
+        flag = "  slower" if ratio > REGRESSION_RATIO else ""
+        lines.append(
+            f"{name:<32}{old_secs[name]:>9.3f}s{new_secs[name]:>9.3f}s"
+            f"{ratio:>8.2f}x{flag}"
+        )
+    return "\n".join(lines)
+
+
+def ffmpeg_program(ffmpeg_dir: Path | None) -> str:
+    return (ffmpeg_dir / "ffmpeg").as_posix() if ffmpeg_dir else "ffmpeg"
+
+
+def ffmpeg_version(program: str) -> str:
+    try:
+        output = subprocess.run(
+            [program, "-version"], capture_output=True, text=True
+        ).stdout
+    except FileNotFoundError:
+        return "not found"
+    return output.splitlines()[0] if output else "unknown"
+
+
+@contextmanager
+def quiet_logger(verbose: bool) -> Iterator[None]:
+    """Send the log of every ffmpeg run somewhere other than the results."""
+    logger = get_logger()
+    with open(os.devnull, "w") as devnull:
+        logger.out_stream = sys.stderr if verbose else devnull
+        try:
+            yield
+        finally:
+            logger.out_stream = sys.stdout
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", default=",".join(SUITES))
+    parser.add_argument("--out", type=Path)
+    parser.add_argument("--compare", type=Path)
+    parser.add_argument("--spans", default=DEFAULT_SPANS)
+    parser.add_argument("--size", default="1920x1080")
+    parser.add_argument("--recordings", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--engines", default="mpdecimate,two-pass")
+    parser.add_argument("--ffmpeg-dir", type=Path)
+    parser.add_argument("--footage-dir", type=Path)
+    parser.add_argument(
+        "--fake-settings",
+        default='{"run_secs": 0.01}',
+        help=f"JSON for {fake_ffmpeg.ENV_VAR}, see benchmarks.fake_ffmpeg",
+    )
+    parser.add_argument("--verbose", action="store_true", help="log ffmpeg to stderr")
+    args = parser.parse_args()
+
+    suites = args.only.split(",")
+    footage = Footage.parse(args.spans, args.size)
+    config = Config(workers=args.workers, video_split_secs=15)
+    program = ffmpeg_program(args.ffmpeg_dir)
+    results: dict[str, dict] = {}
+
+    with TemporaryDirectory() as tmp_dir, quiet_logger(args.verbose):
+        tmp_path = Path(tmp_dir)
+        cache_dir = args.footage_dir or tmp_path / "footage"
+
+        def make_ffmpeg() -> FFmpeg:
+            return FFmpeg(bin_dir=args.ffmpeg_dir)
+
+        def run_suite(name: str, bench: Callable[[Path], dict]) -> None:
+            if name not in suites:
+                return
+            suite_path = tmp_path / name
+            suite_path.mkdir()
+            try:
+                results[name] = bench(suite_path)
+            except (OSError, subprocess.CalledProcessError) as e:
+                # Most likely no ffmpeg, the other suites can still run
+                results[name] = dict(error=repr(e))
+
+        run_suite(
+            "stages",
+            lambda path: bench_stages(
+                make_ffmpeg(),
+                footage.cached(cache_dir, program),
+                footage,
+                path,
+                args.repeat,
+            ),
+        )
+        run_suite(
+            "process_dir",
+            lambda path: bench_process_dir(
+                make_ffmpeg,
+                footage,
+                args.recordings,
+                cache_dir,
+                path,
+                config,
+                args.engines.split(","),
+                program,
+            ),
+        )
+        run_suite("db", lambda path: bench_db(path, 10, 1800, args.repeat))
+        run_suite(
+            "orchestration",
+            lambda path: bench_orchestration(
+                path, 10, 600, config, json.loads(args.fake_settings)
+            ),
+        )
+
+    report = dict(
+        meta=dict(
+            timestamp=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            cpus=os.cpu_count(),
+            ffmpeg=ffmpeg_version(program),
+            footage=dict(spans=args.spans, size=args.size, key=footage.key),
+            workers=args.workers,
+        ),
+        results=results,
+    )
+    output = json.dumps(report, indent=2)
+    if args.out:
+        args.out.write_text(output)
+    else:
+        print(output)
+    if args.compare:
+        print(compare(json.loads(args.compare.read_text()), report), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
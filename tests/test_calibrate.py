@@ -0,0 +1,55 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from vedit.calibrate import (
+    Trial,
+    choose,
+    overridden_by,
+    worker_candidates,
+    write_profile,
+)
+from vedit.config import Config
+
+
+def make_trial(workers: int, wall_secs: float, peak_mb: int) -> Trial:
+    return Trial(workers, 30, "default", 60, wall_secs, peak_mb * 2**20)
+
+
+def test_quickest_trial_that_fits_in_memory_wins():
+    trials = [
+        make_trial(1, 20, 500),
+        make_trial(2, 12, 500),
+        # Quickest, but 4 x 2GB is more than 60% of 8GB
+        make_trial(4, 8, 2048),
+    ]
+    assert choose(trials, 8 * 2**30) == trials[1]
+    assert choose(trials, 2**28) is None
+
+
+def test_worker_candidates():
+    assert worker_candidates(1) == [1]
+    assert worker_candidates(6) == [1, 2, 4, 6]
+    assert worker_candidates(8) == [1, 2, 4, 8]
+
+
+def test_host_profile_fills_in_what_config_file_leaves_out():
+    with TemporaryDirectory() as tmp_dir:
+        config_file = Path(tmp_dir) / "config.toml"
+        config_file.write_text("workers = 3\nspeed_multiplier = 4\n")
+        profile = write_profile(config_file, make_trial(2, 12, 500), Path("recordings"))
+
+        config = Config.load(config_file)
+        # Set on purpose in config.toml, so kept
+        assert config.workers == 3
+        assert config.video_split_secs == 30
+        assert config.speed_multiplier == 4
+        assert overridden_by(config_file, profile) == ["workers"]
+
+
+def test_default_config_file_leaves_room_for_host_profile():
+    with TemporaryDirectory() as tmp_dir:
+        config_file = Path(tmp_dir) / "config.toml"
+        assert Config.load(config_file) == Config()
+        write_profile(config_file, make_trial(2, 12, 500), Path("recordings"))
+
+        assert Config.load(config_file).workers == 2
@@ -0,0 +1,123 @@
+from dataclasses import replace
+from decimal import Decimal
+import os
+from pathlib import Path
+from queue import Queue
+from unittest.mock import patch
+
+from benchmarks import fake_ffmpeg
+from vedit.chunk_cache import ChunkCache
+from vedit.config import Config
+from vedit.ffmpeg import FFmpeg
+from vedit.report import open_runs
+from vedit.video_editor import Segments, process_chunk, process_dir
+
+TIME_RANGE = (Decimal(0), Decimal(10))
+
+
+def test_chunks_are_reused_with_the_same_settings(tmp_path: Path):
+    cache = ChunkCache(tmp_path / "cache", max_bytes=2**20)
+    recording = tmp_path / "recording.mkv"
+    recording.write_bytes(b"video")
+    chunk = tmp_path / "chunk.mkv"
+    chunk.write_bytes(b"chunk")
+    config = Config()
+    cache.put(recording, TIME_RANGE, config, chunk)
+
+    # Wherever the recording is now
+    moved = tmp_path / "moved.mkv"
+    recording.rename(moved)
+    out_path = tmp_path / "out.mkv"
+    assert cache.get(moved, TIME_RANGE, config, out_path) == out_path
+    assert out_path.read_bytes() == b"chunk"
+    # Only the merge speeds chunks up
+    assert cache.get(moved, TIME_RANGE, replace(config, speed_multiplier=2), out_path)
+
+    assert not cache.get(moved, TIME_RANGE, replace(config, dedupe_hi=20), out_path)
+    other_regions = replace(config, analysis_exclude=[[0.5, 0, 0.5, 0.2]])
+    assert not cache.get(moved, TIME_RANGE, other_regions, out_path)
+    assert not cache.get(moved, (Decimal(0), Decimal(5)), config, out_path)
+
+
+def test_least_recently_used_chunks_are_evicted(tmp_path: Path):
+    cache = ChunkCache(tmp_path / "cache", max_bytes=25)
+    recording = tmp_path / "recording.mkv"
+    recording.write_bytes(b"video")
+    ranges = [(Decimal(i), Decimal(i + 1)) for i in range(3)]
+    chunks = [tmp_path / f"chunk{i}.mkv" for i in range(3)]
+    for chunk in chunks:
+        chunk.write_bytes(b"x" * 10)
+
+    for i in range(2):
+        cache.put(recording, ranges[i], Config(), chunks[i])
+        os.utime(cache.chunk_path(recording, ranges[i], Config()), (i, i))
+    cache.get(recording, ranges[0], Config(), tmp_path / "used.mkv")
+    cache.put(recording, ranges[2], Config(), chunks[2])
+
+    out_path = tmp_path / "out.mkv"
+    assert cache.get(recording, ranges[0], Config(), out_path)
+    assert not cache.get(recording, ranges[1], Config(), out_path)
+    assert cache.get(recording, ranges[2], Config(), out_path)
+
+
+@patch("vedit.ffmpeg.logger")
+@patch("vedit.video_editor.logger")
+def test_rerunning_with_other_merge_settings_skips_dedupe(
+    _logger, _ffmpeg_logger, tmp_path: Path
+):
+    bin_dir = fake_ffmpeg.install(tmp_path / "bin")
+    selected_dir = tmp_path / "recordings"
+    selected_dir.mkdir()
+    fake_ffmpeg.write_recording(
+        selected_dir / "2023-01-01 00-00-00.mkv", 20, still=[(5, 15)]
+    )
+    _ffmpeg_logger.out_stream = (tmp_path / "ffmpeg.log").open("w")
+    config = Config(
+        dedupe_engine="two-pass",
+        video_split_secs=10,
+        chunk_cache_dir=(tmp_path / "cache").as_posix(),
+    )
+
+    def dedupe_runs(config: Config) -> int:
+        (selected_dir / "processed.mkv").unlink(missing_ok=True)
+        process_dir(selected_dir, Queue(), FFmpeg(bin_dir=bin_dir), config)
+        conn = open_runs(selected_dir)
+        (runs,) = conn.execute(
+            "SELECT COUNT(*) FROM ffmpeg_runs WHERE stage IN ('cut', 'analyse', 'select')"
+        ).fetchone()
+        conn.close()
+        return runs
+
+    assert dedupe_runs(config) == 6
+    assert dedupe_runs(replace(config, speed_multiplier=2)) == 0
+    _ffmpeg_logger.out_stream.close()
+
+
+@patch("vedit.ffmpeg.logger")
+def test_cache_hits_remove_their_piece_of_the_source(_ffmpeg_logger, tmp_path: Path):
+    bin_dir = fake_ffmpeg.install(tmp_path / "bin")
+    recording = fake_ffmpeg.write_recording(tmp_path / "recording.mkv", 20)
+    _ffmpeg_logger.out_stream = (tmp_path / "ffmpeg.log").open("w")
+    cache = ChunkCache(tmp_path / "cache", max_bytes=2**20)
+    chunk = tmp_path / "chunk.mkv"
+    chunk.write_bytes(b"chunk")
+    config = Config()
+    cache.put(recording, TIME_RANGE, config, chunk)
+
+    ranges = [TIME_RANGE, (Decimal(10), Decimal(20))]
+    ffmpeg = FFmpeg(bin_dir=bin_dir)
+    with Segments(ffmpeg, tmp_path, {recording: ranges}) as segments:
+        out_path = process_chunk(
+            ffmpeg,
+            recording,
+            tmp_path,
+            TIME_RANGE,
+            config,
+            segments=segments,
+            cache=cache,
+        )
+        other_piece = segments.take(recording, ranges[1])
+    _ffmpeg_logger.out_stream.close()
+
+    assert out_path.read_bytes() == b"chunk"
+    assert list(tmp_path.glob("recording-piece0*")) == [other_piece]
@@ -1,12 +1,184 @@
+from contextlib import contextmanager
 from decimal import Decimal
+from io import BytesIO
 from pathlib import Path
+import stat
+import sys
+import time
+from types import SimpleNamespace
+from typing import Iterator
+from unittest.mock import MagicMock, patch
 
+import pytest
 
-from vedit.ffmpeg import FFmpeg
+from benchmarks import fake_ffmpeg
+from vedit.ffmpeg import FFmpeg, ProgressStalled, TimeLimitExceeded
+from vedit.regions import AnalysisRegions
 
 
-def test_duration():
+@patch("vedit.ffmpeg.logger")
+def test_duration(_logger, tmp_path: Path):
+    ffmpeg = FFmpeg(bin_dir=fake_ffmpeg.install(tmp_path / "bin"))
+    test_file = fake_ffmpeg.write_recording(
+        tmp_path / "2023-08-31 09-13-04.mkv", 3573.269
+    )
+
+    assert ffmpeg.get_video_duration(test_file) == Decimal("3573.269")
+
+
+def test_dedupe_uses_intermediate_codec():
+    ffmpeg = FFmpeg()
+    ffmpeg.run = MagicMock()
+
+    ffmpeg.dedupe(
+        Path("in.mkv"),
+        Path("out.mkv"),
+        time_range=(Decimal(60), Decimal(90)),
+        codec="x264-lossless",
+    )
+
+    args, kwargs = ffmpeg.run.call_args
+    assert args[:6] == ("-y", "-ss", "60", "-t", "30", "-i")
+    assert args[-7:] == (
+        "-c:v",
+        "libx264",
+        "-preset",
+        "ultrafast",
+        "-qp",
+        "0",
+        "out.mkv",
+    )
+    assert kwargs == {"stage": "dedupe", "time_range": (Decimal(60), Decimal(90))}
+
+
+def test_analyse_duplicates_reads_kept_frame_numbers():
+    commands = []
+
+    @contextmanager
+    def process(cmd: list[str], stage: str, **kwargs) -> Iterator[SimpleNamespace]:
+        commands.append(cmd)
+        yield SimpleNamespace(
+            stdout=BytesIO(
+                b"#tb 0: 1/1000\n"
+                b"#media_type 0: video\n"
+                b"0,          0,          0,        0,    57600, 0x2ce1e06c\n"
+                b"0,          7,          7,        0,    57600, 0x32b45b86\n"
+                b"0,         26,         26,        0,    57600, 0x5e07a9a0\n"
+            )
+        )
+
     ffmpeg = FFmpeg()
-    test_file = Path(__file__).parent.parent / "vids" / "2023-08-31 09-13-04.mkv"
+    ffmpeg.process = process
+
+    keep = ffmpeg.analyse_duplicates(
+        Path("in.mkv"), time_range=(Decimal(60), Decimal(90)), hi=10
+    )
+
+    assert keep == [0, 7, 26]
+    (args,) = commands
+    assert args[1:5] == ["-ss", "60", "-t", "30"]
+    assert "mpdecimate=hi=640:lo=320:frac=0.33" in args[args.index("-vf") + 1]
+
+
+def test_analysis_regions_are_cropped_side_by_side():
+    assert (
+        AnalysisRegions().filter(320, 180)
+        == "crop=iw*0.8:ih*0.8:iw*0.2:ih*0,scale=256:144,format=gray"
+    )
+
+    regions = AnalysisRegions(
+        include=((0, 0, 0.5, 0.5), (0.5, 0.5, 0.5, 0.5)),
+        exclude=((0.25, 0.25, 0.5, 0.5),),
+    )
+    assert regions.tiles(320, 180) == [(0, 0, 160, 88), (160, 0, 160, 88)]
+    assert regions.size(320, 180) == (320, 88)
+    # The excluded middle of the frame is in a corner of each tile
+    assert regions.excluded_boxes(320, 180) == [(80, 44, 80, 44), (160, 0, 80, 44)]
+    vf = regions.filter(320, 180)
+    assert vf.startswith("split=2[region0][region1];")
+    assert "[tile0][tile1]hstack=inputs=2,drawbox=x=80:y=44:w=80:h=44" in vf
+
+
+NULL_OUTPUT = ("-i", "recording.mkv", "-f", "null", "-")
+
+
+def install_ffmpeg(bin_dir: Path, then: str) -> Path:
+    """An ffmpeg that gets one frame done and then runs then."""
+    bin_dir.mkdir()
+    script = bin_dir / "ffmpeg"
+    script.write_text(
+        f"#!/bin/sh\nprintf 'frame=1\\nprogress=continue\\n' >&2\nexec {then}\n"
+    )
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    return bin_dir
+
+
+@pytest.fixture
+def log_file(tmp_path: Path):
+    with patch("vedit.ffmpeg.logger") as logger, (tmp_path / "ffmpeg.log").open(
+        "w"
+    ) as log_file:
+        logger.out_stream = log_file
+        yield log_file
+
+
+def test_stalled_ffmpeg_is_stopped(tmp_path: Path, log_file):
+    hung = install_ffmpeg(tmp_path / "bin", "sleep 30")
+    ffmpeg = FFmpeg(bin_dir=hung, stall_secs=0.5)
+
+    started = time.perf_counter()
+    with pytest.raises(ProgressStalled):
+        ffmpeg.run(*NULL_OUTPUT)
+
+    assert time.perf_counter() - started < 10
+
+
+def test_busy_ffmpeg_is_not_stalled(tmp_path: Path, log_file):
+    # Decoding a long run of duplicate frames: no output, but plenty of CPU
+    busy = f"{sys.executable} -c 'import time\nend = time.time() + 2\nwhile time.time() < end: pass'"
+    ffmpeg = FFmpeg(bin_dir=install_ffmpeg(tmp_path / "bin", busy), stall_secs=0.5)
+
+    ffmpeg.run(*NULL_OUTPUT)
+
+    (run,) = ffmpeg.take_runs()
+    assert run.returncode == 0
+
+
+def test_short_runs_record_what_they_used(tmp_path: Path, log_file):
+    # Over before the first sample is taken
+    busy = f"{sys.executable} -c 'import time\nend = time.process_time() + 0.2\nwhile time.process_time() < end: pass'"
+    ffmpeg = FFmpeg(bin_dir=install_ffmpeg(tmp_path / "bin", busy))
+
+    ffmpeg.run(*NULL_OUTPUT)
+
+    (run,) = ffmpeg.take_runs()
+    assert run.cpu_secs >= 0.2
+    assert run.peak_rss > 2**20
+
+
+@patch("vedit.ffmpeg.logger")
+def test_frames_decoded_before_the_seek_point_are_not_counted(_logger, tmp_path: Path):
+    _logger.out_stream = (tmp_path / "ffmpeg.log").open("w")
+    ffmpeg = FFmpeg(bin_dir=fake_ffmpeg.install(tmp_path / "bin"))
+    recording = fake_ffmpeg.write_recording(tmp_path / "recording.mkv", 20)
+
+    # The keyframe before 5s is at 4s
+    ffmpeg.dedupe(recording, tmp_path / "out.mkv", time_range=(Decimal(5), Decimal(10)))
+    _logger.out_stream.close()
+
+    (run,) = ffmpeg.take_runs()
+    assert run.frames_in == 5 * 30
+
+
+def test_busy_ffmpeg_is_stopped_once_its_time_is_up(tmp_path: Path, log_file):
+    # Busy forever without getting anywhere
+    busy = f"{sys.executable} -c 'while True: pass'"
+    ffmpeg = FFmpeg(bin_dir=install_ffmpeg(tmp_path / "bin", busy), stall_secs=0.5)
+
+    started = time.perf_counter()
+    with ffmpeg.time_limit(1), pytest.raises(TimeLimitExceeded):
+        ffmpeg.run(*NULL_OUTPUT)
 
-    assert ffmpeg.get_video_duration(test_file) == Decimal("3573.269000")
+    assert time.perf_counter() - started < 10
+    # The limit is for the block only
+    assert ffmpeg.local.deadline is None
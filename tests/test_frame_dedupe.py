@@ -0,0 +1,131 @@
+from contextlib import contextmanager
+from decimal import Decimal
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from vedit.frame_dedupe import (
+    INDEX_HEIGHT,
+    INDEX_WIDTH,
+    DuplicateDetector,
+    SignatureIndex,
+    analysis_mask,
+    read_frames,
+    region_mask,
+)
+from vedit.regions import AnalysisRegions
+
+
+def make_frames(values: list[int], width: int = 16, height: int = 8) -> np.ndarray:
+    return np.stack([np.full((height, width), v, dtype=np.uint8) for v in values])
+
+
+def test_read_frames_in_batches():
+    frames = make_frames(list(range(10)))
+    # Pipes hand data over in arbitrary sized pieces
+    stream = BytesIO(frames.tobytes() + b"partial frame")
+
+    batches = [batch.copy() for batch in read_frames(stream, 16, 8, batch_frames=4)]
+
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert np.array_equal(np.concatenate(batches), frames)
+
+
+def test_keeps_changes_and_drops_duplicates():
+    detector = DuplicateDetector(np.ones((8, 16), dtype=bool))
+    values = [0, 0, 0, 50, 50, 100, 150, 200, 200, 200, 200, 0]
+    frames = make_frames(values)
+
+    for batch_frames in [1, 3, 64]:
+        batches = (
+            frames[i : i + batch_frames] for i in range(0, len(frames), batch_frames)
+        )
+        assert detector.frames_to_keep(batches) == [0, 3, 5, 6, 7, 11]
+
+
+def test_slow_drift_is_compared_to_the_last_kept_frame():
+    detector = DuplicateDetector(np.ones((8, 16), dtype=bool))
+    # Every step is too small to count, but they add up
+    frames = make_frames([0, 4, 8, 12, 16])
+
+    assert detector.frames_to_keep([frames]) == [0, 2, 4]
+
+
+def test_masked_regions_are_ignored():
+    mask = region_mask(16, 8, excluded=[(0, 0, 0.5, 1)])
+    detector = DuplicateDetector(mask)
+    frames = make_frames([0, 0, 0])
+    frames[1, :, :8] = 255
+    frames[2, :, 8:] = 255
+
+    assert detector.frames_to_keep([frames]) == [0, 2]
+
+
+def test_analysis_mask_leaves_out_padding_and_excluded_regions():
+    regions = AnalysisRegions(
+        include=((0, 0, 0.5, 1), (0.5, 0, 0.5, 0.5)),
+        exclude=((0, 0, 0.25, 0.5),),
+    )
+    mask = analysis_mask(regions, 32, 16)
+
+    assert mask.shape == (16, 32)
+    assert not mask[:8, :8].any()
+    assert mask[8:, :16].all() and mask[:8, 8:16].all()
+    # The second tile is half as tall, and padded to the height of the first
+    assert mask[:8, 16:].all() and not mask[8:, 16:].any()
+
+
+class FakeFFmpeg:
+    """Decodes a recording of one frame per second whose frames are numbered.
+
+    Frame n is shown offset seconds after n.
+    """
+
+    def __init__(self, seconds: int, offset: float = 0):
+        self.frames = make_frames(list(range(seconds)), INDEX_WIDTH, INDEX_HEIGHT)
+        self.offset = offset
+
+    @contextmanager
+    def raw_frames(self, in_file, width, height, time_range=None, pts_file=None):
+        start_time, end_time = map(float, time_range)
+        frames = [
+            n
+            for n in range(len(self.frames))
+            if start_time <= n + self.offset < end_time
+        ]
+        yield BytesIO(self.frames[frames].tobytes())
+        pts = [round((n + self.offset - start_time) * 1000) for n in frames]
+        pts_file.write_text(
+            "#tb 0: 1/1000\n" + "".join(f"0, {t}, {t}, 1000\n" for t in pts)
+        )
+
+
+def test_signature_index_reads_ranges_across_segments(tmp_path: Path):
+    ffmpeg = FakeFFmpeg(10)
+    index = SignatureIndex(tmp_path)
+    source = Path("recording.mkv")
+    for time_range in [(0, 4), (4, 10), (2, 6)]:
+        index.build(ffmpeg, source, tuple(map(Decimal, time_range)))
+
+    batches = index.read(source, (Decimal(3), Decimal(9)), batch_frames=2)
+
+    # Overlapping segments are read once, in batches that never cross segments
+    assert [len(batch) for batch in batches] == [1, 2, 2, 1]
+    assert list(np.concatenate(batches)[:, 0, 0]) == [3, 4, 5, 6, 7, 8]
+    assert index.read(source, (Decimal(8), Decimal(12))) is None
+
+
+def test_signature_index_keeps_the_timestamps_of_the_source(tmp_path: Path):
+    # The first frame after 0.6s is the one at 1.5s, not one at 1s
+    ffmpeg = FakeFFmpeg(5, offset=0.5)
+    index = SignatureIndex(tmp_path)
+    source = Path("recording.mkv")
+    index.build(ffmpeg, source, (Decimal("0.6"), Decimal(5)))
+
+    batches = index.read(source, (Decimal("1.2"), Decimal(5)))
+
+    assert list(np.concatenate(batches)[:, 0, 0]) == [1, 2, 3, 4]
+    assert not list(tmp_path.glob("*/*.pts"))
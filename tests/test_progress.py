@@ -0,0 +1,39 @@
+import pytest
+
+from vedit.progress import ProgressTracker
+
+
+def test_stale_progress_is_collapsed():
+    messages = [
+        ("progress", 1, 1.0, 30),
+        ("progress", 2, 0.5, 30),
+        ("step", 0, "Processing 60s-120s"),
+        ("progress", 1, 2.0, 40),
+        ("progress", 1, None, 0),
+        ("step", 3.0, "Processed 0s-60s"),
+        ("progress", 2, 1.5, 35),
+    ]
+
+    assert ProgressTracker.collapse(messages) == [
+        ("step", 0, "Processing 60s-120s"),
+        ("progress", 1, None, 0),
+        ("step", 3.0, "Processed 0s-60s"),
+        ("progress", 2, 1.5, 35),
+    ]
+
+
+def test_running_jobs_count_towards_progress():
+    tracker = ProgressTracker()
+    tracker.handle(("step", 40, "Restarting from where we left off"), now=0)
+    tracker.handle(("progress", 1, 2.0, 30), now=1)
+    tracker.handle(("progress", 2, 3.0, 20), now=1)
+
+    assert tracker.percent == 45
+    assert tracker.fps == 50
+    # 5% in 10 seconds, not counting what was done before restarting
+    assert tracker.eta_secs(now=10) == pytest.approx(110)
+
+    tracker.handle(("progress", 1, None, 0), now=10)
+    tracker.handle(("step", 5, "Processed 0s-60s"), now=10)
+    assert tracker.percent == 48
+    assert tracker.fps == 20
@@ -0,0 +1,55 @@
+from decimal import Decimal
+from pathlib import Path
+
+from vedit.db import DB, FFmpegRun
+from vedit.report import open_runs, summarise
+from vedit.video_editor import RUNS_FILE
+
+
+def make_run(stage: str, start: int, end: int, wall_secs: float, **kwargs) -> FFmpegRun:
+    return FFmpegRun(
+        **dict(
+            program="ffmpeg",
+            stage=stage,
+            input_file="/videos/recording.mkv",
+            time_range=(Decimal(start), Decimal(end)),
+            wall_secs=wall_secs,
+            cpu_secs=wall_secs * 4,
+            peak_rss=2**30,
+            frames_in=None,
+            frames_out=None,
+            returncode=0,
+        )
+        | kwargs
+    )
+
+
+def test_report_summarises_stages(tmp_path: Path):
+    db = DB.create_db(tmp_path / "db.sqlite")
+    db.record_runs(
+        [
+            make_run("cut", 0, 60, 1),
+            make_run("dedupe", 0, 60, 20, frames_in=3600, frames_out=600),
+            make_run("dedupe", 60, 120, 40, frames_in=3600, frames_out=1200),
+            make_run("dedupe", 120, 180, 5, returncode=1),
+        ]
+    )
+    # Processing is done and the working directory is gone
+    db.export_runs(tmp_path / RUNS_FILE)
+    db.close()
+
+    lines = summarise(open_runs(tmp_path)).splitlines()
+
+    assert lines[1].split() == [
+        "dedupe",
+        "3",
+        "1",
+        "65.0s",
+        "260.0s",
+        "2.8x",
+        "28",
+        "1024",
+    ]
+    assert lines[2].split() == ["cut", "1", "0", "1.0s", "4.0s", "60.0x", "-", "1024"]
+    assert "Dedupe kept 1800 of 7200 frames decoded (25.0%)" in lines
+    assert lines[-4] == "  40.0s dedupe recording.mkv 60s-120s, 30 fps"
@@ -1,13 +1,34 @@
+from contextlib import contextmanager
+from decimal import Decimal
+import json
+from fractions import Fraction
+from multiprocessing import Process
+import os
 from pathlib import Path
+import socket
+import subprocess
+import time
 from tempfile import TemporaryDirectory
+from threading import Event, Lock, Thread
 from typing import Iterator
 from unittest.mock import MagicMock, patch
 from queue import Queue
 import pytest
+
+from benchmarks import fake_ffmpeg
 from vedit.config import Config
-from vedit.db import DB
+from vedit.db import DB, VideoInfo
+from vedit.ffmpeg import FFmpeg, MemoryLimitExceeded
+from vedit.lock import FileLock
+from vedit.report import open_runs
 
-from vedit.video_editor import process_dir
+from vedit.video_editor import (
+    Segments,
+    probe_files,
+    process_batch,
+    process_dir,
+    run_worker,
+)
 
 
 @pytest.fixture()
@@ -16,8 +37,8 @@ def tmp_dir() -> Iterator[DB]:
         yield Path(tmp_dir)
 
 
-def test_end_to_end_happy_case_mocked(tmp_dir: Path):
-    msg_queue = Queue()
+@patch("vedit.video_editor.logger")
+def test_end_to_end_happy_case_mocked(_logger, tmp_dir: Path):
     fake_files = [
         tmp_dir / ("2023-01-01 00-00-00.mkv"),
         tmp_dir / ("2023-01-02 00-00-00.mkv"),
@@ -25,35 +46,217 @@ def test_end_to_end_happy_case_mocked(tmp_dir: Path):
     for fake_file in fake_files:
         fake_file.touch()
 
-    ffmpeg = MagicMock()
+    ffmpeg = make_fake_ffmpeg()
+    db = DB.create_db(tmp_dir / "db.sqlite")
+    db.close = MagicMock()
 
-    ffmpeg.split.return_value = [tmp_dir / f"{i}.mkv" for i in range(10)]
+    process_dir(tmp_dir, Queue(), ffmpeg, Config(), db=db)
 
-    def edit_mock(file: Path, seconds: float) -> Iterator[Path]:
-        yield file.parent / f"{file.stem}_processed{file.suffix}"
+    assert not tmp_dir.joinpath(".vedit").exists()
+    ranges = [(0, 60), (60, 120), (120, 150)]
+    assert [
+        (args[0], kwargs["start_time"], kwargs["end_time"])
+        for args, kwargs in ffmpeg.cut_section.call_args_list
+    ] == [(f, Decimal(s), Decimal(e)) for f in fake_files for s, e in ranges]
+    (processed_paths,), _ = ffmpeg.combine_and_speedup.call_args
+    assert [p.name for p in processed_paths] == [
+        f"{f.stem}-{s}s-{e}s_processed.mkv" for f in fake_files for s, e in ranges
+    ]
+
+    db.conn.close()
 
-    ffmpeg.edit.side_effect = edit_mock
-    ffmpeg.combine_and_speedup.side_effect = lambda x, *args, **kw: x
 
+@patch("vedit.video_editor.logger")
+def test_end_to_end_stop_and_restart_mocked(_logger, tmp_dir: Path):
+    fake_files = [
+        tmp_dir / ("2023-01-01 00-00-00.mkv"),
+        tmp_dir / ("2023-01-02 00-00-00.mkv"),
+    ]
+    for fake_file in fake_files:
+        fake_file.touch()
+
+    ffmpeg = make_fake_ffmpeg()
+    dedupe = ffmpeg.dedupe.side_effect
+
+    # Stopped partway through the second file
+    def interrupted_dedupe(in_file: Path, output_path: Path, **kwargs) -> Path:
+        if in_file.name == f"{fake_files[1].stem}-60s-120s.mkv":
+            raise KeyboardInterrupt
+        return dedupe(in_file, output_path, **kwargs)
+
+    ffmpeg.dedupe.side_effect = interrupted_dedupe
     db = DB.create_db(tmp_dir / "db.sqlite")
     db.close = MagicMock()
 
-    process_dir(tmp_dir, msg_queue, ffmpeg, Config(), db=db)
+    with pytest.raises(KeyboardInterrupt):
+        process_dir(tmp_dir, Queue(), ffmpeg, Config(), db=db)
 
-    assert not tmp_dir.joinpath(".vedit").exists()
+    assert tmp_dir.joinpath(".vedit").exists()
+    assert db.get_total_processed_duration(fake_files) == Decimal(210)
+    ffmpeg.combine_and_speedup.assert_not_called()
 
-    assert db.read_events("split_file") == [f.as_posix() for f in fake_files]
-    assert db.read_events("edited_file") == [
-        (tmp_dir / f"{i}.mkv").as_posix() for i in range(10)
+    # Restarted as a new process, so the stopped one's lease is handed back
+    db.release_dead_leases(socket.gethostname(), lambda pid: False)
+    ffmpeg.dedupe.reset_mock()
+    ffmpeg.dedupe.side_effect = dedupe
+    process_dir(tmp_dir, Queue(), ffmpeg, Config(), db=db)
+
+    assert not tmp_dir.joinpath(".vedit").exists()
+    # Only what was left is done again
+    assert [args[0].name for args, _ in ffmpeg.dedupe.call_args_list] == [
+        f"{fake_files[1].stem}-{s}s-{e}s.mkv" for s, e in [(60, 120), (120, 150)]
     ]
-    assert db.read_events("file_for_merging") == [
-        (tmp_dir / f"{i}_processed.mkv").as_posix() for i in range(10)
+    (processed_paths,), _ = ffmpeg.combine_and_speedup.call_args
+    assert [p.name for p in processed_paths] == [
+        f"{f.stem}-{s}s-{e}s_processed.mkv"
+        for f in fake_files
+        for s, e in [(0, 60), (60, 120), (120, 150)]
     ]
 
     db.conn.close()
 
 
-def test_end_to_end_stop_and_restart_mocked(tmp_dir: Path):
+def make_fake_ffmpeg(duration: Decimal = Decimal(150)) -> MagicMock:
+    ffmpeg = MagicMock()
+    ffmpeg.probe.return_value = VideoInfo(duration, 1920, 1080, "h264", Fraction(30))
+
+    def cut_section(
+        in_file: Path,
+        tmp_path: Path,
+        start_time: Decimal,
+        end_time: Decimal,
+        name_tag: str = "",
+    ) -> Path:
+        out_file = tmp_path / f"{in_file.stem}-{start_time}s-{end_time}s{name_tag}.mkv"
+        out_file.touch()
+        return out_file
+
+    def dedupe(in_file: Path, output_path: Path, **kwargs) -> Path:
+        output_path.touch()
+        return output_path
+
+    ffmpeg.cut_section.side_effect = cut_section
+    ffmpeg.dedupe.side_effect = dedupe
+    return ffmpeg
+
+
+@patch("vedit.video_editor.logger")
+def test_chunks_are_sized_by_memory_use(
+    _logger, tmp_dir: Path, monkeypatch: pytest.MonkeyPatch
+):
+    # Where the memory use is kept for other folders
+    monkeypatch.chdir(tmp_dir)
+    fake_file = tmp_dir / "2023-01-01 00-00-00.mkv"
+    fake_file.touch()
+
+    ffmpeg = make_fake_ffmpeg()
+    peak_rss = []
+
+    # 20KB per second of footage against a budget of 1MB, anything longer
+    # than 40s runs out of memory.
+    def dedupe(in_file: Path, output_path: Path, time_range, **kwargs) -> Path:
+        start_time, end_time = time_range
+        if end_time - start_time > 40:
+            raise MemoryLimitExceeded(-9, "ffmpeg")
+        peak_rss.append(int(20_000 * (end_time - start_time)))
+        output_path.touch()
+        return output_path
+
+    ffmpeg.dedupe.side_effect = dedupe
+    ffmpeg.peak_rss.side_effect = lambda: peak_rss[-1]
+    db = DB.create_db(tmp_dir / "db.sqlite")
+    db.close = MagicMock()
+
+    config = Config(memory_budget_mb=1, dedupe_from_source=True)
+    process_dir(tmp_dir, Queue(), ffmpeg, config, db=db)
+
+    # The first chunk is halved, after that chunks are sized to fit in 60% of
+    # the budget
+    (processed_paths,), _ = ffmpeg.combine_and_speedup.call_args
+    assert [p.name for p in processed_paths] == [
+        f"{fake_file.stem}-{s}s-{e}s_processed.mkv"
+        for s, e in [(0, 30), (30, 60), (60, 91), (91, 120), (120, 150)]
+    ]
+
+
+@patch("vedit.video_editor.logger")
+def test_memory_use_is_kept_for_the_next_folder(
+    _logger, tmp_dir: Path, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.chdir(tmp_dir)
+    ffmpeg = make_fake_ffmpeg()
+    time_ranges = []
+
+    # 20KB per second of footage against a budget of 1MB
+    def dedupe(in_file: Path, output_path: Path, time_range, **kwargs) -> Path:
+        start_time, end_time = time_range
+        time_ranges.append((in_file.parent.name, start_time, end_time))
+        if end_time - start_time > 40:
+            raise MemoryLimitExceeded(-9, "ffmpeg")
+        output_path.touch()
+        return output_path
+
+    ffmpeg.dedupe.side_effect = dedupe
+    ffmpeg.peak_rss.side_effect = lambda: int(
+        20_000 * (time_ranges[-1][2] - time_ranges[-1][1])
+    )
+    config = Config(memory_budget_mb=1, dedupe_from_source=True)
+    for name in ["first", "second"]:
+        (tmp_dir / name).mkdir()
+        (tmp_dir / name / "2023-01-01 00-00-00.mkv").touch()
+        process_dir(tmp_dir / name, Queue(), ffmpeg, config)
+        assert not (tmp_dir / name / ".vedit").exists()
+
+    # Only the first folder had to find out the hard way
+    assert [(s, e) for name, s, e in time_ranges if name == "second"] == [
+        (0, 31),
+        (31, 62),
+        (62, 93),
+        (93, 124),
+        (124, 150),
+    ]
+
+
+@patch("vedit.video_editor.logger")
+def test_batch_shares_workers_between_folders(_logger, tmp_dir: Path):
+    selected_dirs = [tmp_dir / name for name in ["a", "b", "broken"]]
+    for selected_dir in selected_dirs:
+        selected_dir.mkdir()
+        (selected_dir / "2023-01-01 00-00-00.mkv").touch()
+
+    ffmpeg = make_fake_ffmpeg()
+    lock = Lock()
+    running = [0]
+    most_running = [0]
+
+    def dedupe(in_file: Path, output_path: Path, **kwargs) -> Path:
+        if in_file.parent.name == "broken":
+            raise RuntimeError("broken")
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        output_path.touch()
+        return output_path
+
+    ffmpeg.dedupe.side_effect = dedupe
+    config = Config(workers=2, dedupe_from_source=True, video_split_secs=10)
+    failures = process_batch(
+        selected_dirs, {d: NullQueue() for d in selected_dirs}, config, ffmpeg
+    )
+
+    assert list(failures) == [tmp_dir / "broken"]
+    assert most_running[0] == 2
+    assert sorted(
+        kwargs["output_path"].parent.name
+        for _, kwargs in ffmpeg.combine_and_speedup.call_args_list
+    ) == ["a", "b"]
+
+
+@patch("vedit.video_editor.logger")
+def test_parallel_workers_keep_merge_order(_logger, tmp_dir: Path):
     msg_queue = Queue()
     fake_files = [
         tmp_dir / ("2023-01-01 00-00-00.mkv"),
@@ -62,52 +265,432 @@ def test_end_to_end_stop_and_restart_mocked(tmp_dir: Path):
     for fake_file in fake_files:
         fake_file.touch()
 
-    ffmpeg = MagicMock()
+    ffmpeg = make_fake_ffmpeg()
+    db = DB.create_db(tmp_dir / "db.sqlite")
+    db.close = MagicMock()
 
-    ffmpeg.split.return_value = [tmp_dir / f"{i}.mkv" for i in range(10)]
+    process_dir(tmp_dir, msg_queue, ffmpeg, Config(workers=4), db=db)
 
-    # Editing one of the files will fail to process
-    def edit_mock(file: Path, seconds: float) -> Iterator[Path]:
-        if "5" in file.name:
-            raise KeyboardInterrupt
-        yield file.parent / f"{file.stem}_processed{file.suffix}"
+    (processed_paths,), _ = ffmpeg.combine_and_speedup.call_args
+    assert [p.name for p in processed_paths] == [
+        f"{f.stem}-{s}s-{e}s_processed.mkv"
+        for f in fake_files
+        for s, e in [(0, 60), (60, 120), (120, 150)]
+    ]
+    assert not tmp_dir.joinpath(".vedit").exists()
+
+    db.conn.close()
+
+
+@patch("vedit.video_editor.logger")
+def test_parallel_workers_retry_failed_ranges(_logger, tmp_dir: Path):
+    msg_queue = Queue()
+    fake_file = tmp_dir / ("2023-01-01 00-00-00.mkv")
+    fake_file.touch()
+
+    ffmpeg = make_fake_ffmpeg()
+    dedupe = ffmpeg.dedupe.side_effect
 
-    ffmpeg.edit.side_effect = edit_mock
-    ffmpeg.combine_and_speedup.side_effect = lambda x, *args, **kw: x
+    def flaky_dedupe(in_file: Path, output_path: Path, **kwargs) -> Path:
+        if in_file.name.endswith("-0s-60s.mkv"):
+            raise subprocess.CalledProcessError(1, "ffmpeg")
+        return dedupe(in_file, output_path, **kwargs)
 
+    ffmpeg.dedupe.side_effect = flaky_dedupe
     db = DB.create_db(tmp_dir / "db.sqlite")
     db.close = MagicMock()
 
-    try:
-        process_dir(tmp_dir, msg_queue, ffmpeg, Config(), db=db)
-    except KeyboardInterrupt:
-        pass
+    process_dir(tmp_dir, msg_queue, ffmpeg, Config(workers=3), db=db)
 
-    assert tmp_dir.joinpath(".vedit").exists()
+    assert db.get_total_processed_duration([fake_file]) == Decimal(150)
+    assert db.read_ranges(fake_file, status="failed") == [(Decimal(0), Decimal(60))]
+    (processed_paths,), _ = ffmpeg.combine_and_speedup.call_args
+    assert [p.name for p in processed_paths] == [
+        f"{fake_file.stem}-{s}s-{e}s_processed.mkv"
+        for s, e in [(0, 30), (30, 60), (60, 120), (120, 150)]
+    ]
+
+    db.conn.close()
+
+
+@patch("vedit.video_editor.logger")
+def test_dedupe_from_source_skips_cutting(_logger, tmp_dir: Path):
+    msg_queue = Queue()
+    fake_file = tmp_dir / ("2023-01-01 00-00-00.mkv")
+    fake_file.touch()
 
-    assert db.read_events("split_file") == [f.as_posix() for f in fake_files]
-    assert db.read_events("edited_file") == [
-        (tmp_dir / f"{i}.mkv").as_posix() for i in range(5)
+    ffmpeg = make_fake_ffmpeg()
+    db = DB.create_db(tmp_dir / "db.sqlite")
+    db.close = MagicMock()
+
+    process_dir(tmp_dir, msg_queue, ffmpeg, Config(dedupe_from_source=True), db=db)
+
+    ffmpeg.cut_section.assert_not_called()
+    assert [
+        (args[0], kwargs["time_range"]) for args, kwargs in ffmpeg.dedupe.call_args_list
+    ] == [
+        (fake_file, (Decimal(s), Decimal(e)))
+        for s, e in [(0, 60), (60, 120), (120, 150)]
     ]
-    assert db.read_events("file_for_merging") == [
-        (tmp_dir / f"{i}_processed.mkv").as_posix() for i in range(5)
+    assert db.get_total_processed_duration([fake_file]) == Decimal(150)
+
+    db.conn.close()
+
+
+@patch("vedit.video_editor.logger")
+def test_speedup_per_chunk_merges_with_stream_copy(_logger, tmp_dir: Path):
+    msg_queue = Queue()
+    fake_files = [
+        tmp_dir / ("2023-01-01 00-00-00.mkv"),
+        tmp_dir / ("2023-01-02 00-00-00.mkv"),
     ]
+    for fake_file in fake_files:
+        fake_file.touch()
 
-    # pretend whatever issue caused the failure the first time was fixed
-    def edit_mock(file: Path, seconds: float) -> Iterator[Path]:
-        yield file.parent / f"{file.stem}_processed{file.suffix}"
+    ffmpeg = make_fake_ffmpeg()
+    ffmpeg.concat.side_effect = lambda paths, output_path, concat_file: output_path
+    db = DB.create_db(tmp_dir / "db.sqlite")
+    db.close = MagicMock()
 
-    ffmpeg.edit.side_effect = edit_mock
+    config = Config(speed_multiplier=4, speedup_per_chunk=True, workers=2)
+    process_dir(tmp_dir, msg_queue, ffmpeg, config, db=db)
 
-    process_dir(tmp_dir, msg_queue, ffmpeg, Config(), db=db)
+    ffmpeg.combine_and_speedup.assert_not_called()
+    assert {
+        kwargs["speed_multiplier"] for _, kwargs in ffmpeg.dedupe.call_args_list
+    } == {4}
 
-    assert not tmp_dir.joinpath(".vedit").exists()
-    assert db.read_events("split_file") == [f.as_posix() for f in fake_files]
-    assert db.read_events("edited_file") == [
-        (tmp_dir / f"{i}.mkv").as_posix() for i in range(10)
+    *file_merges, final_merge = ffmpeg.concat.call_args_list
+    assert sorted(
+        [p.name for p in merged_paths] for (merged_paths,), _ in file_merges
+    ) == [
+        [
+            f"{f.stem}-{s}s-{e}s_processed.mkv"
+            for s, e in [(0, 60), (60, 120), (120, 150)]
+        ]
+        for f in fake_files
     ]
-    assert db.read_events("file_for_merging") == [
-        (tmp_dir / f"{i}_processed.mkv").as_posix() for i in range(10)
+    (merged_paths,), kwargs = final_merge
+    assert [p.name for p in merged_paths] == [
+        f"{f.stem}_merged.mkv" for f in fake_files
     ]
+    assert kwargs["output_path"] == tmp_dir / "processed.mkv"
 
     db.conn.close()
+
+
+def test_probe_results_are_cached(tmp_dir: Path):
+    fake_files = [tmp_dir / f"2023-01-0{i} 00-00-00.mkv" for i in range(1, 4)]
+    for fake_file in fake_files:
+        fake_file.write_bytes(b"recording")
+
+    ffmpeg = make_fake_ffmpeg()
+    db = DB.create_db(tmp_dir / "db.sqlite")
+
+    infos = probe_files(ffmpeg, db, fake_files)
+    assert infos == {f: ffmpeg.probe.return_value for f in fake_files}
+    assert ffmpeg.probe.call_count == 3
+
+    assert probe_files(ffmpeg, db, fake_files) == infos
+    assert ffmpeg.probe.call_count == 3
+
+    # A file that is still being recorded into has to be probed again
+    fake_files[1].write_bytes(b"recording with more footage")
+    probe_files(ffmpeg, db, fake_files)
+    assert ffmpeg.probe.call_args_list[-1].args == (fake_files[1],)
+    assert ffmpeg.probe.call_count == 4
+
+    db.close()
+
+
+class NullQueue:
+    def put(self, message: tuple) -> None:
+        pass
+
+
+class SlowFakeFFmpeg:
+    def dedupe(self, in_file: Path, output_path: Path, **kwargs) -> Path:
+        time.sleep(0.01)
+        output_path.touch()
+        return output_path
+
+    def log_stage_timings(self) -> None:
+        pass
+
+    def take_runs(self) -> list:
+        return []
+
+    @contextmanager
+    def progress_to(self, callback) -> Iterator[None]:
+        yield
+
+    @contextmanager
+    def time_limit(self, secs) -> Iterator[None]:
+        yield
+
+
+def test_workers_share_a_directory(tmp_dir: Path):
+    fake_files = [
+        tmp_dir / ("2023-01-01 00-00-00.mkv"),
+        tmp_dir / ("2023-01-02 00-00-00.mkv"),
+    ]
+    for fake_file in fake_files:
+        fake_file.touch()
+
+    tmp_path = tmp_dir / ".vedit"
+    tmp_path.mkdir()
+    db = DB.create_db(tmp_path / "db.sqlite", shared_as="coordinator:0")
+    for file_order, fake_file in enumerate(fake_files):
+        db.plan_jobs(fake_file, file_order, Decimal(300), Decimal(10))
+
+    config = Config(multi_host=True, dedupe_from_source=True, workers=2)
+    with patch("vedit.video_editor.POLL_SECS", 0.01):
+        workers = [
+            Process(
+                target=run_worker,
+                args=(tmp_dir, NullQueue(), SlowFakeFFmpeg(), config),
+            )
+            for _ in range(3)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(timeout=60)
+
+    assert [worker.exitcode for worker in workers] == [0, 0, 0]
+    assert db.count_jobs() == {"done": 60}
+    for fake_file in fake_files:
+        chunks = db.get_merge_order(fake_file)
+        assert len(chunks) == 30
+        assert all(chunk.exists() for chunk in chunks)
+        assert db.get_total_processed_duration([fake_file]) == Decimal(300)
+
+    db.close()
+
+
+def test_stale_lock_is_broken(tmp_dir: Path):
+    lock_path = tmp_dir / "db.lock"
+    lock_path.write_text("crashed:1")
+    os.utime(lock_path, (0, 0))
+
+    lock = FileLock(lock_path, owner="me:2", stale_secs=60)
+    with lock:
+        assert lock_path.read_text() == "me:2"
+        with lock:
+            pass
+        assert lock_path.exists()
+    assert not lock_path.exists()
+
+
+def test_lock_of_running_process_is_not_broken(tmp_dir: Path):
+    lock_path = tmp_dir / "db.lock"
+    lock_path.write_text(f"{socket.gethostname()}:{os.getpid()}")
+    os.utime(lock_path, (0, 0))
+
+    assert not FileLock(lock_path, owner="me:2").try_acquire()
+    assert lock_path.exists()
+
+
+def test_lock_of_exited_process_is_broken_at_once(tmp_dir: Path):
+    exited = subprocess.Popen(["true"])
+    exited.wait()
+    lock_path = tmp_dir / "db.lock"
+    lock_path.write_text(f"{socket.gethostname()}:{exited.pid}")
+
+    lock = FileLock(lock_path, owner="me:2")
+    assert not lock.try_acquire()
+    assert lock.try_acquire()
+
+
+def test_held_lock_is_kept_fresh(tmp_dir: Path):
+    lock_path = tmp_dir / "db.lock"
+    with FileLock(lock_path, owner="me:2", stale_secs=0.3):
+        time.sleep(1)
+        assert not FileLock(lock_path, owner="other:3", stale_secs=0.3).try_acquire()
+        assert lock_path.read_text() == "me:2"
+    assert not lock_path.exists()
+
+
+def test_lock_is_held_by_one_thread_at_a_time(tmp_dir: Path):
+    lock = FileLock(tmp_dir / "db.lock", owner="me:2")
+    holders = []
+
+    def hold() -> None:
+        with lock:
+            holders.append("in")
+            time.sleep(0.05)
+            holders.append("out")
+
+    threads = [Thread(target=hold) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert holders == ["in", "out"] * 4
+
+
+def test_shared_db_reads_wait_for_the_lock(tmp_dir: Path):
+    db = DB.create_db(tmp_dir / "db.sqlite", shared_as="me:2")
+    db.plan_jobs(tmp_dir / "recording.mkv", 0, Decimal(60), Decimal(10))
+    held = Event()
+
+    # Another machine, halfway through a write
+    def write() -> None:
+        with FileLock(tmp_dir / "db.lock", owner="other:3"):
+            held.set()
+            time.sleep(0.3)
+
+    writer = Thread(target=write)
+    writer.start()
+    held.wait()
+    started = time.perf_counter()
+    assert db.count_jobs() == {"pending": 6}
+    assert time.perf_counter() - started >= 0.2
+    writer.join()
+    db.conn.close()
+
+
+@patch("vedit.ffmpeg.logger")
+@patch("vedit.video_editor.logger")
+def test_process_dir_with_fake_ffmpeg(_logger, _ffmpeg_logger, tmp_dir: Path):
+    bin_dir = fake_ffmpeg.install(tmp_dir / "bin")
+    selected_dir = tmp_dir / "recordings"
+    selected_dir.mkdir()
+    for hour in range(2):
+        fake_ffmpeg.write_recording(
+            selected_dir / f"2023-01-01 0{hour}-00-00.mkv", 20, still=[(5, 15)]
+        )
+    _ffmpeg_logger.out_stream = (tmp_dir / "ffmpeg.log").open("w")
+
+    config = Config(dedupe_engine="two-pass", video_split_secs=10, workers=2)
+    process_dir(selected_dir, Queue(), FFmpeg(bin_dir=bin_dir), config)
+
+    # Each recording keeps 10s of motion and the first frame of the still span
+    # in both of its chunks
+    output = json.loads((selected_dir / "processed.mkv").read_text())
+    assert output["duration"] == pytest.approx(2 * (10 + 2 / 30))
+    _ffmpeg_logger.out_stream.close()
+
+
+@patch("vedit.ffmpeg.logger")
+@patch("vedit.video_editor.logger")
+def test_progress_is_by_what_has_been_read(
+    _logger, _ffmpeg_logger, tmp_dir: Path, monkeypatch
+):
+    bin_dir = fake_ffmpeg.install(tmp_dir / "bin")
+    selected_dir = tmp_dir / "recordings"
+    selected_dir.mkdir()
+    fake_ffmpeg.write_recording(
+        selected_dir / "2023-01-01 00-00-00.mkv", 20, still=[(5, 15)]
+    )
+    monkeypatch.setenv(fake_ffmpeg.ENV_VAR, '{"run_secs": 1}')
+    _ffmpeg_logger.out_stream = (tmp_dir / "ffmpeg.log").open("w")
+
+    message_queue = Queue()
+    config = Config(video_split_secs=10, speedup_per_chunk=True, speed_multiplier=2)
+    process_dir(selected_dir, message_queue, FFmpeg(bin_dir=bin_dir), config)
+
+    progress: dict[int, list[float]] = {}
+    while not message_queue.empty():
+        match message_queue.get():
+            case ("progress", job, percent, _) if percent is not None:
+                progress.setdefault(job, []).append(percent)
+    # Neither set back by cutting the chunk first nor held back by the frames
+    # dropped and sped up
+    assert len(progress) == 2
+    for percents in progress.values():
+        assert percents == sorted(percents)
+        assert percents[-1] == pytest.approx(95 * 10 / 20)
+    _ffmpeg_logger.out_stream.close()
+
+
+@patch("vedit.ffmpeg.logger")
+@patch("vedit.video_editor.logger")
+def test_split_sources_reads_each_recording_once(
+    _logger, _ffmpeg_logger, tmp_dir: Path
+):
+    bin_dir = fake_ffmpeg.install(tmp_dir / "bin")
+    selected_dir = tmp_dir / "recordings"
+    selected_dir.mkdir()
+    for hour in range(2):
+        fake_ffmpeg.write_recording(
+            selected_dir / f"2023-01-01 0{hour}-00-00.mkv", 20, still=[(5, 15)]
+        )
+    _ffmpeg_logger.out_stream = (tmp_dir / "ffmpeg.log").open("w")
+
+    config = Config(
+        dedupe_engine="two-pass", video_split_secs=5, workers=2, split_sources=True
+    )
+    process_dir(selected_dir, Queue(), FFmpeg(bin_dir=bin_dir), config)
+    _ffmpeg_logger.out_stream.close()
+
+    # Split on the keyframes at 4, 10 and 14s, the still span is in three
+    # chunks that each keep its first frame
+    output = json.loads((selected_dir / "processed.mkv").read_text())
+    assert output["duration"] == pytest.approx(2 * (10 + 3 / 30))
+    conn = open_runs(selected_dir)
+    stages = dict(
+        conn.execute("SELECT stage, COUNT(*) FROM ffmpeg_runs GROUP BY stage")
+    )
+    conn.close()
+    assert stages["split"] == 2
+    assert "cut" not in stages
+
+
+@patch("vedit.ffmpeg.logger")
+def test_segments_are_matched_to_jobs_by_their_times(_ffmpeg_logger, tmp_dir: Path):
+    bin_dir = fake_ffmpeg.install(tmp_dir / "bin")
+    video_file = fake_ffmpeg.write_recording(tmp_dir / "recording.mkv", 20)
+    _ffmpeg_logger.out_stream = (tmp_dir / "ffmpeg.log").open("w")
+
+    # Keyframes are every 2s, so the split lands on 6, 10 and 14s
+    ranges = [
+        (Decimal(s), Decimal(e)) for s, e in [(0, 5), (5, 10), (10, 14), (15, 20)]
+    ]
+    with Segments(FFmpeg(bin_dir=bin_dir), tmp_dir, {video_file: ranges}) as segments:
+        pieces = [segments.take(video_file, time_range) for time_range in ranges]
+    _ffmpeg_logger.out_stream.close()
+
+    assert pieces[:2] == [None, None]
+    assert json.loads(pieces[2].read_text())["duration"] == pytest.approx(4)
+    assert pieces[3] is None
+    # Pieces no job takes are gone, the one spanning 10-14s is left for its job
+    assert [p.name for p in tmp_dir.glob("recording-piece0*")] == [pieces[2].name]
+
+
+@patch("vedit.ffmpeg.logger")
+@patch("vedit.video_editor.logger")
+def test_disk_budget_merges_parts_in_scratch_dir(
+    _logger, _ffmpeg_logger, tmp_dir: Path
+):
+    bin_dir = fake_ffmpeg.install(tmp_dir / "bin")
+    selected_dir = tmp_dir / "recordings"
+    selected_dir.mkdir()
+    for hour in range(2):
+        fake_ffmpeg.write_recording(
+            selected_dir / f"2023-01-01 0{hour}-00-00.mkv", 20, still=[(5, 15)]
+        )
+    _ffmpeg_logger.out_stream = (tmp_dir / "ffmpeg.log").open("w")
+
+    scratch_dir = tmp_dir / "scratch"
+    config = Config(
+        dedupe_engine="two-pass",
+        video_split_secs=10,
+        workers=2,
+        scratch_dir=scratch_dir.as_posix(),
+        disk_budget_mb=1,
+    )
+    process_dir(selected_dir, Queue(), FFmpeg(bin_dir=bin_dir), config)
+    _ffmpeg_logger.out_stream.close()
+
+    output = json.loads((selected_dir / "processed.mkv").read_text())
+    assert output["duration"] == pytest.approx(2 * (10 + 2 / 30))
+    conn = open_runs(selected_dir)
+    stages = dict(
+        conn.execute("SELECT stage, COUNT(*) FROM ffmpeg_runs GROUP BY stage")
+    )
+    conn.close()
+    # A part for each recording, stream copied together at the end
+    assert (stages["combine"], stages["merge"]) == (2, 1)
+    assert list(scratch_dir.iterdir()) == []
@@ -1,105 +1,311 @@
 from decimal import Decimal
 from pathlib import Path
+import sqlite3
 from tempfile import TemporaryDirectory
 from typing import Iterator
+from unittest.mock import patch
 
 import pytest
 
-from vedit.db import DB, EditingTracker
+from vedit.db import DB, IntervalSet
+from vedit.frame_dedupe import static_runs, static_spans
 
 dummpy_path = Path("dummy")
 
 
+def test_interval_set_merges_incrementally():
+    intervals = IntervalSet()
+    for r in [(5, 6), (1, 2), (8, 9), (2, 3), (4, 5)]:
+        intervals.add((Decimal(r[0]), Decimal(r[1])))
+
+    assert intervals.intervals == [
+        (Decimal(1), Decimal(3)),
+        (Decimal(4), Decimal(6)),
+        (Decimal(8), Decimal(9)),
+    ]
+    assert list(intervals.gaps((Decimal(0), Decimal(10)))) == [
+        (Decimal(0), Decimal(1)),
+        (Decimal(3), Decimal(4)),
+        (Decimal(6), Decimal(8)),
+        (Decimal(9), Decimal(10)),
+    ]
+
+    intervals.add((Decimal(2), Decimal(8)))
+    assert intervals.intervals == [(Decimal(1), Decimal(9))]
+
+
+def test_migrates_text_process_log():
+    with TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / "db.sqlite"
+        with sqlite3.connect(db_path) as conn:
+            conn.execute(
+                """CREATE TABLE process_log (
+                    timestamp TEXT, source_file TEXT, output_file TEXT, start_time TEXT, end_time TEXT, status TEXT
+                )"""
+            )
+            for start, end in [("0", "60"), ("60", "120"), ("120", "150.5")]:
+                conn.execute(
+                    "INSERT INTO process_log VALUES ('', 'a.mkv', :out, :start, :end, 'success')",
+                    dict(out=f"{start}.mkv", start=start, end=end),
+                )
+        conn.close()
+
+        db = DB.create_db(db_path)
+        assert db.get_total_processed_duration([Path("a.mkv")]) == Decimal("150.5")
+        assert db.get_merge_order(Path("a.mkv")) == [
+            Path("0.mkv"),
+            Path("60.mkv"),
+            Path("120.mkv"),
+        ]
+        db.close()
+
+        # Opening it again must not try to migrate a second time
+        db = DB.create_db(db_path)
+        assert db.read_ranges(Path("a.mkv"), "success")[-1] == (
+            Decimal(120),
+            Decimal("150.5"),
+        )
+        db.close()
+
+
 @pytest.fixture()
-def tracker() -> Iterator[DB]:
+def db() -> Iterator[DB]:
     with TemporaryDirectory() as tmp_dir:
         db = DB.create_db(Path(tmp_dir) / "db.sqlite")
-        tracker = EditingTracker(
-            Path("."), Decimal(10), Decimal(5), split_factor=Decimal(2), db=db
-        )
-        yield tracker
+        yield db
         db.close()
 
 
-def test_simple_logic(tracker: EditingTracker):
-    range1 = tracker.next()
-    assert range1 == (Decimal(0), Decimal(5))
-    tracker.success(dummpy_path, range1)
-    range2 = tracker.next()
-    assert range2 == (Decimal(5), Decimal(10))
-    tracker.success(dummpy_path, range2)
+def test_jobs_are_claimed_in_order(db: DB):
+    first, second = Path("first.mkv"), Path("second.mkv")
+    db.plan_jobs(second, 1, Decimal(7), Decimal(5))
+    db.plan_jobs(first, 0, Decimal(10), Decimal(5))
+    # Planning twice must not duplicate anything
+    db.plan_jobs(first, 0, Decimal(10), Decimal(5))
+
+    claimed = [db.claim_job("worker", lease_secs=60, now=0) for _ in range(5)]
+    assert [(job.source_file, job.time_range) for job in claimed[:4]] == [
+        (first, (Decimal(0), Decimal(5))),
+        (first, (Decimal(5), Decimal(10))),
+        (second, (Decimal(0), Decimal(5))),
+        (second, (Decimal(5), Decimal(7))),
+    ]
+    assert claimed[4] is None
+    assert db.count_jobs() == {"leased": 4}
+
+
+def test_expired_leases_are_reclaimed(db: DB):
+    db.plan_jobs(dummpy_path, 0, Decimal(10), Decimal(10))
+
+    job = db.claim_job("crashed", lease_secs=60, now=0)
+    assert db.claim_job("other", lease_secs=60, now=30) is None
+    db.renew_leases("crashed", [job], lease_secs=60, now=30)
+    assert db.claim_job("other", lease_secs=60, now=80) is None
+
+    reclaimed = db.claim_job("other", lease_secs=60, now=100)
+    assert reclaimed == job
+    assert db.complete_job(reclaimed, Path("other.mkv"))
+    # The original owner finishing late must not count twice
+    assert not db.complete_job(job, Path("crashed.mkv"))
+    assert db.get_merge_order(dummpy_path) == [Path("other.mkv")]
+    assert db.file_done(dummpy_path)
+
+
+def test_failed_jobs_are_split(db: DB):
+    db.plan_jobs(dummpy_path, 0, Decimal(10), Decimal(10))
+
+    db.fail_job(db.claim_job("worker", lease_secs=60))
+    first_half = db.claim_job("worker", lease_secs=60)
+    second_half = db.claim_job("worker", lease_secs=60)
+    assert first_half.time_range == (Decimal(0), Decimal(5))
+    assert second_half.time_range == (Decimal(5), Decimal(10))
+    assert not db.file_done(dummpy_path)
+
+    db.complete_job(second_half, Path("second.mkv"))
+    db.complete_job(first_half, Path("first.mkv"))
+    assert db.file_done(dummpy_path)
+    assert db.get_merge_order(dummpy_path) == [Path("first.mkv"), Path("second.mkv")]
+    assert db.count_jobs() == {"done": 2, "failed": 1}
 
-    assert tracker.done()
-    assert tracker.next() is None
 
+def claim_all(db: DB) -> list[tuple[Decimal, Decimal]]:
+    return [job.time_range for job in iter(lambda: db.claim_job("w", 60), None)]
 
-def test_with_some_failures(tracker: EditingTracker):
-    first_range = (Decimal(0), Decimal(5))
-    assert tracker.next() == first_range
-    tracker.failed(first_range)
 
-    second_range = tracker.next()
-    assert second_range == (Decimal(0), Decimal("2.5"))
-    second_range = tracker.next()
-    tracker.success(dummpy_path, second_range)
+def test_jobs_cover_the_file(db: DB):
+    db.plan_jobs(dummpy_path, 0, Decimal(10), Decimal(5))
 
-    third_range = tracker.next()
-    assert third_range == (Decimal("2.5"), Decimal("7.5"))
-    tracker.success(dummpy_path, third_range)
+    first, second = db.claim_job("w", 60), db.claim_job("w", 60)
+    assert first.time_range == (Decimal(0), Decimal(5))
+    assert second.time_range == (Decimal(5), Decimal(10))
+    assert db.claim_job("w", 60) is None
+    assert not db.file_done(dummpy_path)
 
-    fouth_range = tracker.next()
-    assert fouth_range == (Decimal("7.5"), Decimal("10"))
-    tracker.success(dummpy_path, fouth_range)
+    db.complete_job(first, dummpy_path)
+    db.complete_job(second, dummpy_path)
+    assert db.file_done(dummpy_path)
 
-    assert tracker.done()
-    assert tracker.next() is None
 
+def test_planning_resumes_around_logged_ranges(db: DB):
+    # Earlier failures are tried again, whatever succeeded is not
+    db.log_status(dummpy_path, dummpy_path, (Decimal("2.5"), Decimal(5)), "success")
+    db.log_status(dummpy_path, None, (Decimal(0), Decimal("7.5")), "failed")
 
-def test_handles_resumption(tracker: EditingTracker):
-    tracker.db.log_status(
-        tracker.path, dummpy_path, (Decimal(0), Decimal(5)), "success"
-    )
-    tracker.db.log_status(tracker.path, None, (Decimal(0), Decimal(7.5)), "failed")
+    db.plan_jobs(dummpy_path, 0, Decimal(10), Decimal(5))
 
-    first_range = (Decimal(5), Decimal(10))
-    assert tracker.next() == first_range
-    tracker.success(dummpy_path, first_range)
+    assert claim_all(db) == [
+        (Decimal(0), Decimal("2.5")),
+        (Decimal(5), Decimal(10)),
+    ]
 
-    assert tracker.done()
-    assert tracker.next() is None
 
+def test_pending_jobs_are_replanned_for_a_new_split_time(db: DB):
+    db.plan_jobs(dummpy_path, 0, Decimal(40), Decimal(10))
+    started = db.claim_job("w", 60)
+    db.fail_job(db.claim_job("w", 60))
+
+    # Same length, nothing changes
+    db.plan_jobs(dummpy_path, 0, Decimal(40), Decimal(10))
+    assert db.count_jobs() == {"pending": 4, "leased": 1, "failed": 1}
+
+    db.plan_jobs(dummpy_path, 0, Decimal(40), Decimal(25))
+    assert claim_all(db) == [
+        (Decimal(10), Decimal(35)),
+        (Decimal(35), Decimal(40)),
+    ]
+    assert started.time_range == (Decimal(0), Decimal(10))
+    assert db.complete_job(started, dummpy_path)
+
+
+def test_planning_skips_already_processed_ranges(db: DB):
+    db.log_status(dummpy_path, dummpy_path, (Decimal(0), Decimal(5)), "success")
+
+    db.plan_jobs(dummpy_path, 0, Decimal(12), Decimal(5))
+
+    assert [db.claim_job("worker", lease_secs=60).time_range for _ in range(2)] == [
+        (Decimal(5), Decimal(10)),
+        (Decimal(10), Decimal(12)),
+    ]
+
+
+def test_jobs_are_resized_to_fit_in_memory(db: DB):
+    db.plan_jobs(dummpy_path, 0, Decimal(60), Decimal(20))
+
+    db.fail_job(db.claim_job("worker", lease_secs=60), max_secs=Decimal(8))
+    db.split_pending_jobs([dummpy_path], Decimal(15))
+
+    assert [job.time_range for job in iter(lambda: db.claim_job("w", 60), None)] == [
+        (Decimal(0), Decimal(8)),
+        (Decimal(8), Decimal(16)),
+        (Decimal(16), Decimal(20)),
+        (Decimal(20), Decimal(35)),
+        (Decimal(35), Decimal(40)),
+        (Decimal(40), Decimal(55)),
+        (Decimal(55), Decimal(60)),
+    ]
+
+
+def test_jobs_are_split_on_keyframes(db: DB):
+    with TemporaryDirectory() as tmp_dir:
+        video_file = Path(tmp_dir) / "recording.mkv"
+        video_file.touch()
+        assert db.get_keyframes(video_file) is None
+        keyframes = [Decimal(t) for t in ["0", "4.5", "9", "13.5", "18", "22.5"]]
+        db.save_keyframes(video_file, keyframes)
+        assert db.get_keyframes(video_file) == keyframes
+
+        db.plan_jobs(video_file, 0, Decimal(25), Decimal(10))
+        db.fail_job(db.claim_job("worker", lease_secs=60))
+
+        assert [
+            job.time_range for job in iter(lambda: db.claim_job("w", 60), None)
+        ] == [
+            (Decimal(0), Decimal("4.5")),
+            (Decimal("4.5"), Decimal(9)),
+            (Decimal(9), Decimal(18)),
+            (Decimal(18), Decimal(25)),
+        ]
+
+
+@patch("vedit.db.logger")
+def test_missing_keyframes_are_logged_once(logger, db: DB):
+    db.plan_jobs(dummpy_path, 0, Decimal(20), Decimal(10))
+    db.fail_job(db.claim_job("w", 60))
+
+    assert claim_all(db) == [
+        (Decimal(0), Decimal(5)),
+        (Decimal(5), Decimal(10)),
+        (Decimal(10), Decimal(20)),
+    ]
+    (call,) = logger.writeline.call_args_list
+    assert call.args[0].startswith("No keyframes indexed for dummy")
+
+
+def test_static_spans_are_left_out_of_jobs(db: DB):
+    # Packets every half second with a keyframe every 4s. Something moves
+    # until 9s, then the picture stays the same until 30s.
+    packets = [
+        (
+            Decimal(n) / 2,
+            30000 if n % 8 == 0 else 12 if 18 < n < 60 else 20000,
+            n % 8 == 0,
+        )
+        for n in range(80)
+    ]
+    keyframes = [time for time, _, keyframe in packets if keyframe]
 
-def test_handles_resumption_when_ended_at_failure(tracker: EditingTracker):
-    tracker.db.log_status(tracker.path, None, (Decimal(0), Decimal(5)), "failed")
+    runs = static_runs(packets, 128, Decimal(40))
+    # The first keyframe after the change ends a run, the ones after it are
+    # the same picture again
+    assert runs == [
+        (Decimal("9.5"), Decimal(12)),
+        (Decimal("12.5"), Decimal(30)),
+    ]
+    spans = static_spans(runs, keyframes, Decimal(5))
+    assert spans == [(Decimal("12.5"), Decimal(28))]
 
-    first_range = (Decimal(0), Decimal(2.5))
-    assert tracker.next() == first_range
-    tracker.success(dummpy_path, first_range)
+    db.plan_jobs(dummpy_path, 0, Decimal(40), Decimal(10), static=spans)
+    db.plan_jobs(dummpy_path, 0, Decimal(40), Decimal(10), static=spans)
+    assert [job.time_range for job in iter(lambda: db.claim_job("w", 60), None)] == [
+        (Decimal(0), Decimal(10)),
+        (Decimal(10), Decimal("12.5")),
+        (Decimal(28), Decimal(38)),
+        (Decimal(38), Decimal(40)),
+    ]
+    # Static spans count as done, without anything to merge
+    assert db.get_total_processed_duration([dummpy_path]) == Decimal("15.5")
+    assert db.get_merge_order(dummpy_path) == []
 
-    second_range = (Decimal(2.5), Decimal(7.5))
-    assert tracker.next() == second_range
-    tracker.success(dummpy_path, second_range)
 
-    third_range = (Decimal(7.5), Decimal(10))
-    assert tracker.next() == third_range
-    tracker.success(dummpy_path, third_range)
+def test_chunks_are_merged_into_parts_in_order(db: DB):
+    db.plan_jobs(dummpy_path, 0, Decimal(40), Decimal(10))
+    jobs = [db.claim_job("w", 60) for _ in range(4)]
+    db.complete_job(jobs[0], Path("0.mkv"))
+    db.complete_job(jobs[2], Path("2.mkv"))
 
-    assert tracker.done()
-    assert tracker.next() is None
+    # The third chunk waits for the second
+    chunks = db.next_chunks_to_merge(dummpy_path)
+    assert chunks == [((Decimal(0), Decimal(10)), Path("0.mkv"))]
+    db.record_part(dummpy_path, chunks, Path("part0.mkv"))
+    db.complete_job(jobs[1], Path("1.mkv"))
+    assert [chunk for _, chunk in db.next_chunks_to_merge(dummpy_path)] == [
+        Path("1.mkv"),
+        Path("2.mkv"),
+    ]
 
+    # A lost part is done again
+    db.requeue_missing_outputs(lambda path: path.name != "part0.mkv")
+    assert db.claim_job("w", 60).time_range == (Decimal(0), Decimal(10))
+    assert db.get_parts(dummpy_path) == []
+    assert db.get_total_processed_duration([dummpy_path]) == Decimal(20)
 
-def test_handles_gaps(tracker: EditingTracker):
-    tracker.db.log_status(
-        tracker.path, dummpy_path, (Decimal(2.5), Decimal(5)), "success"
-    )
 
-    first_range = (Decimal(0), Decimal(2.5))
-    assert tracker.next() == first_range
-    tracker.success(dummpy_path, first_range)
+def test_memory_model_separates_fixed_overhead(db: DB):
+    assert db.get_memory_model(1920, 1080) is None
 
-    second_range = (Decimal(5), Decimal(10))
-    assert tracker.next() == second_range
-    tracker.success(dummpy_path, second_range)
+    db.record_memory_usage(1920, 1080, Decimal(10), 300)
+    assert db.get_memory_model(1920, 1080) == (0.0, 30.0)
 
-    assert tracker.done()
-    assert tracker.next() is None
+    db.record_memory_usage(1920, 1080, Decimal(30), 700)
+    db.record_memory_usage(1280, 720, Decimal(30), 10_000)
+    assert db.get_memory_model(1920, 1080) == pytest.approx((100.0, 20.0))
@@ -0,0 +1,155 @@
+from decimal import Decimal
+from fractions import Fraction
+import os
+from pathlib import Path
+from queue import Queue
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+import time
+from typing import Callable, Iterator
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from vedit.config import Config
+from vedit.db import VideoInfo
+from vedit.watch import (
+    MANIFEST_FILE,
+    extend_output,
+    finished_recordings,
+    join_parts,
+    pending_parts,
+    watch_dirs,
+)
+
+
+@pytest.fixture()
+def tmp_dir() -> Iterator[Path]:
+    with TemporaryDirectory() as tmp_dir:
+        yield Path(tmp_dir)
+
+
+def make_fake_ffmpeg() -> MagicMock:
+    ffmpeg = MagicMock()
+    ffmpeg.probe.return_value = VideoInfo(Decimal(30), 1920, 1080, "h264", Fraction(30))
+
+    def dedupe(in_file: Path, output_path: Path, **kwargs) -> Path:
+        output_path.touch()
+        return output_path
+
+    def combine_and_speedup(paths: list[Path], output_path: Path, **kwargs) -> Path:
+        output_path.write_text("".join(f"{p.name}\n" for p in paths))
+        return output_path
+
+    def concat(paths: list[Path], output_path: Path, **kwargs) -> Path:
+        output_path.write_text("".join(p.read_text() for p in paths))
+        return output_path
+
+    ffmpeg.dedupe.side_effect = dedupe
+    ffmpeg.combine_and_speedup.side_effect = combine_and_speedup
+    ffmpeg.concat.side_effect = concat
+    return ffmpeg
+
+
+def test_recordings_are_finished_once_they_stop_changing(tmp_dir: Path):
+    config = Config(watch_settle_secs=60)
+    old = tmp_dir / "2023-01-01 00-00-00.mkv"
+    old.write_bytes(b"x" * 10)
+    os.utime(old, (time.time() - 120, time.time() - 120))
+    recording = tmp_dir / "2023-01-01 01-00-00.mkv"
+    recording.write_bytes(b"x" * 10)
+
+    sizes: dict[Path, int] = {}
+    # Sizes are only known from the second check on
+    assert finished_recordings(tmp_dir, sizes, config) == []
+    assert finished_recordings(tmp_dir, sizes, config) == [old]
+
+    (tmp_dir / MANIFEST_FILE).write_text(f"{old.name}\n")
+    assert finished_recordings(tmp_dir, sizes, config) == []
+
+
+@patch("vedit.video_editor.logger")
+def test_new_recordings_are_added_onto_the_output(_logger, tmp_dir: Path):
+    config = Config(dedupe_from_source=True)
+    ffmpeg = make_fake_ffmpeg()
+    first, second, third = [
+        tmp_dir / f"2023-01-01 0{hour}-00-00.mkv" for hour in range(3)
+    ]
+    first.touch()
+
+    out_path = extend_output(tmp_dir, [first], Queue(), config, ffmpeg)
+    second.touch()
+    extend_output(tmp_dir, [second], Queue(), config, ffmpeg)
+    third.touch()
+    extend_output(tmp_dir, [third], Queue(), config, ffmpeg)
+
+    # Later recordings wait to be added all at once
+    assert out_path.read_text().splitlines() == [f"{first.stem}-0s-30s_processed.mkv"]
+    assert [p.name for p in pending_parts(tmp_dir)] == [
+        "part-00000.mkv",
+        "part-00001.mkv",
+    ]
+    assert (tmp_dir / MANIFEST_FILE).read_text().splitlines() == [
+        first.name,
+        second.name,
+        third.name,
+    ]
+    ffmpeg.concat.assert_not_called()
+
+    join_parts(tmp_dir, Queue(), ffmpeg)
+
+    # Only the new recording is edited each time, and processed.mkv is only
+    # copied once
+    assert out_path.read_text().splitlines() == [
+        f"{first.stem}-0s-30s_processed.mkv",
+        f"{second.stem}-0s-30s_processed.mkv",
+        f"{third.stem}-0s-30s_processed.mkv",
+    ]
+    assert ffmpeg.concat.call_count == 1
+    assert sorted(p.name for p in tmp_dir.iterdir()) == sorted(
+        [
+            first.name,
+            second.name,
+            third.name,
+            out_path.name,
+            MANIFEST_FILE,
+            "processed.runs.sqlite",
+        ]
+    )
+
+
+@patch("vedit.video_editor.logger")
+@patch("vedit.watch.logger")
+def test_parts_are_joined_when_watching_stops(_logger, _watch_logger, tmp_dir: Path):
+    config = Config(dedupe_from_source=True, watch_settle_secs=0, watch_join_secs=0)
+    ffmpeg = make_fake_ffmpeg()
+    first, second = [tmp_dir / f"2023-01-01 0{hour}-00-00.mkv" for hour in range(2)]
+    first.touch()
+    stop = Event()
+    manifest = tmp_dir / MANIFEST_FILE
+
+    def wait_for(condition: Callable[[], bool]) -> None:
+        deadline = time.monotonic() + 10
+        while not condition():
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+    with patch("vedit.watch.WATCH_POLL_SECS", 0.01):
+        watching = Thread(
+            target=watch_dirs,
+            args=([tmp_dir], {tmp_dir: Queue()}, config, ffmpeg, stop),
+        )
+        watching.start()
+        wait_for(lambda: manifest.exists())
+        second.touch()
+        wait_for(lambda: second.name in manifest.read_text())
+        # Not joined while watching with watch_join_secs = 0
+        assert pending_parts(tmp_dir)
+        stop.set()
+        watching.join()
+
+    assert (tmp_dir / "processed.mkv").read_text().splitlines() == [
+        f"{first.stem}-0s-30s_processed.mkv",
+        f"{second.stem}-0s-30s_processed.mkv",
+    ]
+    assert pending_parts(tmp_dir) == []
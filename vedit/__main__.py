@@ -1,13 +1,5 @@
-import os
+import sys
 
-from vedit.logger import Logger
-from vedit.gui import VEditGUI
+from vedit.cli import main
 
-if os.name == "nt":
-    from ctypes import windll
-
-    windll.shcore.SetProcessDpiAwareness(1)
-
-logger = Logger()
-app = VEditGUI()
-app.run()
+main(sys.argv[1:])
@@ -0,0 +1,234 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from datetime import datetime
+from decimal import Decimal
+import os
+from pathlib import Path
+import tempfile
+import time
+import tomllib
+from typing import Callable
+
+import psutil
+
+from vedit.codecs import INTERMEDIATE_CODECS
+from vedit.config import Config, host_profile, to_toml_value
+from vedit.db import TimeRange, VideoInfo, split_range
+from vedit.ffmpeg import FFmpeg
+from vedit.video_editor import (
+    MEMORY_TARGET,
+    OUTPUT_FILE,
+    make_ffmpeg,
+    parse_filename,
+    process_chunk_measured,
+)
+
+# Seconds of footage each trial processes, at least. Trials with more workers
+# than chunks would only measure idle workers, so they get more.
+CALIBRATE_SAMPLE_SECS = 60
+# The chunk length every encoder is tried with
+CALIBRATE_CODEC_SPLIT_SECS = 30
+SPLIT_CANDIDATES = (15, 30, 60)
+
+
+@dataclass(frozen=True)
+class Trial:
+    workers: int
+    video_split_secs: int
+    intermediate_codec: str
+    footage_secs: float
+    wall_secs: float
+    # Most memory one ffmpeg used
+    peak_rss: int
+
+    @property
+    def speed(self) -> float:
+        """Seconds of footage processed per second."""
+        return self.footage_secs / self.wall_secs
+
+    @property
+    def total_rss(self) -> int:
+        """Roughly the most memory all the workers use at once."""
+        return self.peak_rss * self.workers
+
+    def describe(self) -> str:
+        return (
+            f"{self.workers} workers, {self.video_split_secs}s chunks, "
+            f"{self.intermediate_codec}: {self.speed:.1f}x realtime, "
+            f"{self.total_rss / 2**20:.0f}MB"
+        )
+
+
+def worker_candidates(cpus: int) -> list[int]:
+    """1, 2, 4... up to the number of cores, and the number of cores itself."""
+    candidates = {cpus}
+    workers = 1
+    while workers < cpus:
+        candidates.add(workers)
+        workers *= 2
+    return sorted(candidates)
+
+
+def sample_range(info: VideoInfo, secs: int) -> TimeRange:
+    """secs from the middle of the recording, or all of it if it is shorter."""
+    secs = min(Decimal(secs), info.duration)
+    start_time = ((info.duration - secs) / 2).quantize(Decimal(1))
+    return start_time, start_time + secs
+
+
+def run_trial(
+    ffmpeg: FFmpeg,
+    video_file: Path,
+    info: VideoInfo,
+    config: Config,
+    tmp_path: Path,
+    sample_secs: int = CALIBRATE_SAMPLE_SECS,
+) -> Trial:
+    time_range = sample_range(
+        info, max(sample_secs, config.workers * config.video_split_secs)
+    )
+    chunks = split_range(time_range, Decimal(config.video_split_secs))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=config.workers) as pool:
+        results = list(
+            pool.map(
+                lambda chunk: process_chunk_measured(
+                    ffmpeg,
+                    video_file,
+                    tmp_path,
+                    chunk,
+                    config,
+                    frame_size=(info.width, info.height),
+                ),
+                chunks,
+            )
+        )
+    wall_secs = time.perf_counter() - started
+
+    for out_path, _ in results:
+        out_path.unlink(missing_ok=True)
+    return Trial(
+        workers=config.workers,
+        video_split_secs=config.video_split_secs,
+        intermediate_codec=config.intermediate_codec,
+        footage_secs=float(time_range[1] - time_range[0]),
+        wall_secs=wall_secs,
+        peak_rss=max(peak_rss for _, peak_rss in results),
+    )
+
+
+def choose(trials: list[Trial], memory_bytes: int) -> Trial | None:
+    """The quickest trial that leaves the machine enough memory, if any does."""
+    fitting = [t for t in trials if t.total_rss <= memory_bytes * MEMORY_TARGET]
+    return max(fitting, key=lambda t: t.speed, default=None)
+
+
+def calibrate(
+    selected_dir: Path,
+    config: Config,
+    on_trial: Callable[[Trial], None] = lambda trial: None,
+    sample_secs: int = CALIBRATE_SAMPLE_SECS,
+    ffmpeg: FFmpeg | None = None,
+) -> Trial:
+    """Find the quickest settings for this machine by processing some of the footage.
+
+    Encoders are compared on one worker first, then worker counts and chunk
+    lengths with the quickest encoder.
+    """
+    # The index would make repeat trials of the same footage free, and a
+    # memory limit would stop the trials that show where the limit is.
+    config = replace(config, signature_index=False, memory_budget_mb=0)
+    ffmpeg = ffmpeg or make_ffmpeg(config)
+    video_files = [
+        video_file
+        for video_file in sorted(selected_dir.glob("*.mkv"), key=parse_filename)
+        if video_file.name != OUTPUT_FILE
+    ]
+    if not video_files:
+        raise FileNotFoundError(f"No recordings in {selected_dir} to calibrate with")
+    infos = {video_file: ffmpeg.probe(video_file) for video_file in video_files}
+    video_file = max(video_files, key=lambda f: infos[f].duration)
+
+    # The chunks are the final video then, so their encoder isn't up for tuning
+    codecs = (
+        [config.intermediate_codec]
+        if config.speedup_per_chunk
+        else list(INTERMEDIATE_CODECS)
+    )
+    memory_bytes = psutil.virtual_memory().total
+    trials: dict[tuple, Trial] = {}
+
+    def trial(**settings) -> Trial:
+        key = tuple(sorted(settings.items()))
+        if key in trials:
+            return trials[key]
+        result = run_trial(
+            ffmpeg,
+            video_file,
+            infos[video_file],
+            replace(config, **settings),
+            tmp_path,
+            sample_secs,
+        )
+        on_trial(result)
+        trials[key] = result
+        return result
+
+    with tempfile.TemporaryDirectory(dir=selected_dir) as tmp_dir:
+        tmp_path = Path(tmp_dir)
+        codec_trials = [
+            trial(
+                workers=1,
+                video_split_secs=CALIBRATE_CODEC_SPLIT_SECS,
+                intermediate_codec=codec,
+            )
+            for codec in codecs
+        ]
+        codec = (
+            choose(codec_trials, memory_bytes) or codec_trials[0]
+        ).intermediate_codec
+        for workers in worker_candidates(os.cpu_count() or 1):
+            for split_secs in SPLIT_CANDIDATES:
+                trial(
+                    workers=workers,
+                    video_split_secs=split_secs,
+                    intermediate_codec=codec,
+                )
+
+    best = choose(list(trials.values()), memory_bytes)
+    if best is None:
+        raise RuntimeError(
+            "Every setting tried needs more memory than this machine has, "
+            "use the two-pass dedupe_engine or shorter video_split_secs"
+        )
+    return best
+
+
+def write_profile(config_file: Path, best: Trial, selected_dir: Path) -> Path:
+    profile = host_profile(config_file)
+    settings = dict(
+        workers=best.workers,
+        video_split_secs=best.video_split_secs,
+        intermediate_codec=best.intermediate_codec,
+    )
+    profile.write_text(
+        "\n".join(
+            [
+                f"# Written by `python -m vedit calibrate {selected_dir}` on "
+                f"{datetime.now():%Y-%m-%d %H:%M}",
+                f"# {best.describe()}",
+                *(f"{key} = {to_toml_value(value)}" for key, value in settings.items()),
+                "",
+            ]
+        )
+    )
+    return profile
+
+
+def overridden_by(config_file: Path, profile: Path) -> list[str]:
+    """Settings in profile that config_file sets itself, which win over them."""
+    if not config_file.exists():
+        return []
+    own = tomllib.loads(config_file.read_text())
+    return [key for key in tomllib.loads(profile.read_text()) if key in own]
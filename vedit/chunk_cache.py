@@ -0,0 +1,162 @@
+from dataclasses import asdict
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+from threading import Lock, get_ident
+
+from vedit.config import Config
+from vedit.db import TimeRange
+from vedit.logger import get_logger
+
+logger = get_logger()
+
+# Bump when chunks made by the same settings would come out differently
+CACHE_VERSION = 2
+# How much of each end of a source goes into its fingerprint
+FINGERPRINT_BYTES = 2**20
+# Settings that change what a processed chunk looks like. The rest, like
+# speed_multiplier without speedup_per_chunk, only matter to the merge.
+CHUNK_SETTINGS = (
+    "dedupe_engine",
+    "dedupe_hi",
+    "dedupe_lo",
+    "dedupe_frac",
+    "dedupe_from_source",
+    "signature_index",
+    "intermediate_codec",
+    "speedup_per_chunk",
+)
+
+
+def fingerprint(video_file: Path) -> str:
+    """Identifies a recording by its content, wherever it is and however it got there.
+
+    Reads its size and both ends rather than all of it, which is plenty for
+    recordings as they all start and end differently.
+    """
+    size = video_file.stat().st_size
+    digest = hashlib.sha1(str(size).encode())
+    with video_file.open("rb") as f:
+        digest.update(f.read(FINGERPRINT_BYTES))
+        f.seek(max(size - FINGERPRINT_BYTES, 0))
+        digest.update(f.read(FINGERPRINT_BYTES))
+    return digest.hexdigest()
+
+
+def chunk_settings(config: Config) -> dict:
+    settings = {
+        name: value for name, value in asdict(config).items() if name in CHUNK_SETTINGS
+    }
+    if config.speedup_per_chunk:
+        settings["speed_multiplier"] = config.speed_multiplier
+    # As resolved, so a profile shares chunks with the same regions set directly
+    settings["regions"] = asdict(config.regions)
+    return settings
+
+
+class ChunkCache:
+    """Processed chunks kept between runs, so they are only deduped once.
+
+    Chunks are files named after a hash of their source's fingerprint, their
+    range and the settings they were made with. Every use marks a chunk as
+    recently used, and the least recently used ones are deleted whenever the
+    cache grows past max_bytes. Chunks are hard linked in and out when the
+    cache is on the same drive as the recordings, and copied otherwise.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fingerprints: dict[tuple[Path, int, float], str] = {}
+        self.lock = Lock()
+        self.hits = 0
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def chunk_path(
+        self, video_file: Path, time_range: TimeRange, config: Config
+    ) -> Path:
+        stat = video_file.stat()
+        identity = (video_file, stat.st_size, stat.st_mtime)
+        with self.lock:
+            source = self.fingerprints.get(identity)
+        if source is None:
+            source = fingerprint(video_file)
+            with self.lock:
+                self.fingerprints[identity] = source
+
+        start_time, end_time = time_range
+        key = json.dumps(
+            dict(
+                version=CACHE_VERSION,
+                source=source,
+                start_time=str(start_time),
+                end_time=str(end_time),
+                **chunk_settings(config),
+            ),
+            sort_keys=True,
+        )
+        return self.cache_dir / (
+            hashlib.sha1(key.encode()).hexdigest() + video_file.suffix
+        )
+
+    def get(
+        self, video_file: Path, time_range: TimeRange, config: Config, out_path: Path
+    ) -> Path | None:
+        """The cached chunk put at out_path, or None if there isn't one."""
+        cached = self.chunk_path(video_file, time_range, config)
+        try:
+            link_or_copy(cached, out_path)
+            os.utime(cached)
+        except FileNotFoundError:
+            # Never made, or evicted by another run in the meantime
+            return None
+        with self.lock:
+            self.hits += 1
+        start_time, end_time = time_range
+        logger.writeline(
+            f"Reusing {cached.name} for {start_time}s-{end_time}s of {video_file}"
+        )
+        return out_path
+
+    def put(
+        self, video_file: Path, time_range: TimeRange, config: Config, chunk: Path
+    ) -> None:
+        cached = self.chunk_path(video_file, time_range, config)
+        tmp_path = cached.with_suffix(f".{os.getpid()}-{get_ident()}.tmp")
+        link_or_copy(chunk, tmp_path)
+        # Whole chunks only, whoever else is using the cache
+        tmp_path.replace(cached)
+        self.evict()
+
+    def evict(self) -> None:
+        """Delete the least recently used chunks until the cache fits in max_bytes."""
+        with self.lock:
+            chunks = []
+            for path in self.cache_dir.iterdir():
+                # Still being added
+                if path.suffix == ".tmp":
+                    continue
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                chunks.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in chunks)
+            for _, size, path in sorted(chunks):
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        # Another drive, or a filesystem without hard links
+        shutil.copyfile(src, dst)
@@ -0,0 +1,242 @@
+import argparse
+from glob import glob
+import json
+import os
+from pathlib import Path
+import sys
+from threading import Lock
+import time
+
+from vedit.calibrate import (
+    CALIBRATE_SAMPLE_SECS,
+    calibrate,
+    overridden_by,
+    write_profile,
+)
+from vedit.config import Config
+from vedit.logger import get_logger
+from vedit.progress import ProgressTracker
+from vedit.report import print_report
+from vedit.video_editor import process_batch, run_worker
+from vedit.watch import watch_dirs
+
+logger = get_logger()
+
+# How often a folder's progress is printed in batch mode
+BATCH_PROGRESS_SECS = 10
+
+
+class ConsoleQueue:
+    """Takes the place of the GUI's message queue and logs progress instead."""
+
+    def put(self, message: tuple) -> None:
+        match message:
+            case ("step", _, text):
+                logger.writeline(text)
+            case ("done", path):
+                logger.writeline(f"Done: {path}")
+            case ("skipped", path):
+                logger.writeline(f"{path} already exists, nothing to do.")
+
+
+class BatchReporter:
+    """Prints one folder's progress to the terminal in batch mode.
+
+    Output goes to the real stdout, stdout itself is redirected to the log.
+    With as_json every line is a JSON object for other programs to follow.
+    """
+
+    def __init__(self, selected_dir: Path, as_json: bool, lock: Lock) -> None:
+        self.selected_dir = selected_dir
+        self.as_json = as_json
+        self.lock = lock
+        self.progress = ProgressTracker()
+        self.last_printed = 0.0
+
+    def put(self, message: tuple) -> None:
+        now = time.monotonic()
+        self.progress.handle(message, now)
+        match message:
+            case ("step", _, text):
+                self.print("step", message=text)
+            case ("progress", *_) if now - self.last_printed >= BATCH_PROGRESS_SECS:
+                self.print("progress")
+            case ("done", path):
+                self.print("done", output=str(path))
+                # Watched folders start again with their next recordings
+                self.progress = ProgressTracker()
+            case ("failed", error):
+                self.print("failed", message=repr(error))
+            case ("skipped", path):
+                self.print("skipped", output=str(path))
+            case _:
+                return
+        self.last_printed = now
+
+    def print(self, event: str, **fields: str) -> None:
+        eta = self.progress.eta_secs()
+        if self.as_json:
+            line = json.dumps(
+                {
+                    "directory": str(self.selected_dir),
+                    "event": event,
+                    "percent": round(self.progress.percent, 1),
+                    "fps": round(self.progress.fps, 1),
+                    "eta_secs": None if eta is None else round(eta),
+                    **fields,
+                }
+            )
+        else:
+            text = fields.get("message") or fields.get("output") or ""
+            if event == "progress":
+                text = f"{self.progress.fps:.0f} fps"
+                if eta is not None:
+                    text += f", {int(eta // 60)} min left"
+            elif event in ("done", "skipped"):
+                text = f"{event}: {text}"
+            line = f"[{self.selected_dir.name}] {self.progress.percent:5.1f}% {text}"
+
+        with self.lock:
+            print(line, file=logger.original_stdout, flush=True)
+
+
+def expand_dirs(patterns: list[str]) -> list[Path]:
+    """Folders matching any of patterns, each once and in the order given."""
+    dirs: dict[Path, None] = {}
+    for pattern in patterns:
+        for match in sorted(glob(pattern)) or [pattern]:
+            if Path(match).is_dir():
+                dirs[Path(match).resolve()] = None
+    return list(dirs)
+
+
+def run_batch(patterns: list[str], as_json: bool) -> int:
+    selected_dirs = expand_dirs(patterns)
+    if not selected_dirs:
+        print(f"No folders match {' '.join(patterns)}", file=sys.stderr)
+        return 2
+
+    lock = Lock()
+    reporters = {
+        selected_dir: BatchReporter(selected_dir, as_json, lock)
+        for selected_dir in selected_dirs
+    }
+    failures = process_batch(selected_dirs, reporters)
+    for selected_dir, error in failures.items():
+        reporters[selected_dir].print("failed", message=repr(error))
+    return 1 if failures else 0
+
+
+def run_watch(patterns: list[str], as_json: bool) -> int:
+    selected_dirs = expand_dirs(patterns)
+    if not selected_dirs:
+        print(f"No folders match {' '.join(patterns)}", file=sys.stderr)
+        return 2
+
+    lock = Lock()
+    reporters = {
+        selected_dir: BatchReporter(selected_dir, as_json, lock)
+        for selected_dir in selected_dirs
+    }
+    watch_dirs(selected_dirs, reporters)
+    return 0
+
+
+def run_calibrate(selected_dir: Path, sample_secs: int) -> None:
+    config_file = Path("config.toml")
+    config = Config.load(config_file)
+    # Keep ffmpeg's output in the log and the trials on screen
+    logger.make_new_logfile()
+
+    def show(trial) -> None:
+        print(trial.describe(), file=logger.original_stdout, flush=True)
+
+    best = calibrate(selected_dir, config, show, sample_secs)
+    profile = write_profile(config_file, best, selected_dir)
+    print(
+        f"Best: {best.describe()}\nWritten to {profile}",
+        file=logger.original_stdout,
+    )
+    if overridden := overridden_by(config_file, profile):
+        print(
+            f"{config_file} sets {', '.join(overridden)} itself, which wins over "
+            f"{profile}. Leave them out of {config_file} to use what was found.",
+            file=logger.original_stdout,
+        )
+
+
+def run_gui() -> None:
+    # Only import tkinter when it is needed, servers often don't have it.
+    from vedit.gui import VEditGUI
+
+    if os.name == "nt":
+        from ctypes import windll
+
+        windll.shcore.SetProcessDpiAwareness(1)
+
+    app = VEditGUI()
+    app.run()
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="vedit", description="Opens the GUI when no command is given."
+    )
+    commands = parser.add_subparsers(dest="command")
+
+    worker = commands.add_parser(
+        "worker",
+        help="help process a shared folder that another machine is coordinating",
+    )
+    worker.add_argument("directory", type=Path)
+
+    batch = commands.add_parser(
+        "batch",
+        help="process folders without the GUI, sharing the workers between them",
+    )
+    batch.add_argument("directories", nargs="+", help="folders or glob patterns")
+    batch.add_argument(
+        "--json", action="store_true", help="print progress as JSON lines"
+    )
+
+    watch = commands.add_parser(
+        "watch",
+        help="keep adding new recordings in folders to their processed.mkv",
+    )
+    watch.add_argument("directories", nargs="+", help="folders or glob patterns")
+    watch.add_argument(
+        "--json", action="store_true", help="print progress as JSON lines"
+    )
+
+    calibrate_command = commands.add_parser(
+        "calibrate",
+        help="try settings on some of a folder's footage and keep the quickest "
+        "for this machine",
+    )
+    calibrate_command.add_argument("directory", type=Path)
+    calibrate_command.add_argument(
+        "--sample-secs",
+        type=int,
+        default=CALIBRATE_SAMPLE_SECS,
+        help="seconds of footage each trial processes",
+    )
+
+    report = commands.add_parser(
+        "report", help="summarise where the time went when processing a folder"
+    )
+    report.add_argument("directory", type=Path)
+
+    args = parser.parse_args(argv)
+    match args.command:
+        case "worker":
+            run_worker(args.directory, ConsoleQueue(), config=Config.load())
+        case "batch":
+            sys.exit(run_batch(args.directories, args.json))
+        case "watch":
+            sys.exit(run_watch(args.directories, args.json))
+        case "calibrate":
+            run_calibrate(args.directory, args.sample_secs)
+        case "report":
+            print_report(args.directory)
+        case _:
+            run_gui()
@@ -0,0 +1,13 @@
+# Encoder settings for processed chunks. These only live until the final merge,
+# which does the real delivery encode, so speed matters more than size here.
+# Kept out of vedit.ffmpeg so that config can check them without importing it.
+INTERMEDIATE_CODECS: dict[str, list[str]] = {
+    "default": [],
+    # Lossless, and large
+    "x264-lossless": ["-c:v", "libx264", "-preset", "ultrafast", "-qp", "0"],
+    # Near-lossless, not lossless: far smaller, with losses too small to see
+    # once the final merge has encoded it again
+    "x264-ultrafast": ["-c:v", "libx264", "-preset", "ultrafast", "-crf", "12"],
+    # Lossless, slower to write than x264 but quick to decode
+    "ffv1": ["-c:v", "ffv1", "-level", "3", "-threads", "4", "-slices", "4"],
+}
@@ -1,25 +1,143 @@
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, field
+import json
+import socket
 import tomllib
 from pathlib import Path
-from typing import Self
+from typing import Any, Self, Sequence
+
+from vedit.codecs import INTERMEDIATE_CODECS
+from vedit.logger import get_logger
+from vedit.regions import DEFAULT_INCLUDED_REGIONS, AnalysisRegions
+
+logger = get_logger()
+
+DEDUPE_ENGINES = ("mpdecimate", "two-pass", "numpy")
+
+
+def to_toml_value(value: Any) -> str:
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, (str, list, tuple)):
+        # JSON strings and arrays of them are valid TOML too.
+        return json.dumps(value)
+    if isinstance(value, dict):
+        items = ", ".join(
+            f"{json.dumps(k)} = {to_toml_value(v)}" for k, v in value.items()
+        )
+        return f"{{{items}}}"
+    return str(value)
+
+
+def host_profile(config_file: Path) -> Path:
+    """Settings `python -m vedit calibrate` found for this machine."""
+    return config_file.with_name(
+        f"{config_file.stem}.{socket.gethostname()}{config_file.suffix}"
+    )
+
+
+def host_memory_usage(config_file: Path = Path("config.toml")) -> Path:
+    """How much memory chunks needed on this machine, in every folder so far."""
+    return host_profile(config_file).with_suffix(".sqlite")
 
 
 @dataclass(frozen=True)
 class Config:
     video_split_secs: int = 60
     speed_multiplier: int = 6
+    workers: int = 1
+    dedupe_from_source: bool = False
+    intermediate_codec: str = "default"
+    speedup_per_chunk: bool = False
+    multi_host: bool = False
+    dedupe_engine: str = "mpdecimate"
+    dedupe_hi: float = 12
+    dedupe_lo: float = 5
+    dedupe_frac: float = 0.33
+    signature_index: bool = False
+    memory_budget_mb: int = 0
+    watch_settle_secs: int = 60
+    watch_join_secs: int = 3600
+    ffmpeg_dir: str = ""
+    split_sources: bool = False
+    static_span_secs: int = 0
+    static_packet_bytes: int = 128
+    chunk_cache_dir: str = ""
+    chunk_cache_mb: int = 10240
+    scratch_dir: str = ""
+    disk_budget_mb: int = 0
+    analysis_include: Sequence[Sequence[float]] = DEFAULT_INCLUDED_REGIONS
+    analysis_exclude: Sequence[Sequence[float]] = ()
+    analysis_profile: str = ""
+    analysis_profiles: dict[str, dict] = field(default_factory=dict)
+    ffmpeg_stall_secs: int = 300
+    ffmpeg_timeout_factor: float = 20
+
+    def __post_init__(self) -> None:
+        if self.dedupe_engine not in DEDUPE_ENGINES:
+            raise ValueError(
+                f"Unknown dedupe_engine {self.dedupe_engine!r}, "
+                f"expected one of {', '.join(DEDUPE_ENGINES)}"
+            )
+        if self.signature_index and self.dedupe_engine != "numpy":
+            raise ValueError("signature_index only works with the numpy dedupe_engine")
+        if self.intermediate_codec not in INTERMEDIATE_CODECS:
+            raise ValueError(
+                f"Unknown intermediate_codec {self.intermediate_codec!r}, "
+                f"expected one of {', '.join(INTERMEDIATE_CODECS)}"
+            )
+        if (
+            self.analysis_profile
+            and self.analysis_profile not in self.analysis_profiles
+        ):
+            raise ValueError(
+                f"Unknown analysis_profile {self.analysis_profile!r}, expected one of "
+                f"{', '.join(self.analysis_profiles) or 'the analysis_profiles'}"
+            )
+        # Bad regions fail here rather than halfway through a run
+        self.regions
+
+    @property
+    def regions(self) -> AnalysisRegions:
+        """The parts of the frame duplicates are looked for in.
+
+        A profile, one of analysis_profiles with its own include and exclude
+        lists, takes the place of analysis_include and analysis_exclude.
+        """
+        if not self.analysis_profile:
+            return AnalysisRegions.parse(self.analysis_include, self.analysis_exclude)
+        profile = self.analysis_profiles[self.analysis_profile]
+        return AnalysisRegions.parse(
+            profile.get("include", DEFAULT_INCLUDED_REGIONS), profile.get("exclude", ())
+        )
 
     @staticmethod
     def load(config_file: Path | None = None) -> Self:
         config_file: Path = config_file or Path("config.toml")
 
         if config_file.exists():
-            config = Config(**tomllib.loads(config_file.read_text()))
+            settings = tomllib.loads(config_file.read_text())
         else:
-            config = Config()
+            settings = {}
+            # Commented out so that calibrated settings can still fill them in
             default_toml = "\n".join(
-                f"{key} = {value}" for key, value in asdict(config).items()
+                [
+                    "# The defaults, uncomment a setting to change it",
+                    *(
+                        f"# {key} = {to_toml_value(value)}"
+                        for key, value in asdict(Config()).items()
+                    ),
+                ]
             )
             config_file.write_text(default_toml)
+        sources = dict.fromkeys(settings, config_file)
+
+        # Calibrated settings only fill in what config.toml leaves out, what it
+        # does set was chosen on purpose
+        if (profile := host_profile(config_file)).exists():
+            calibrated = tomllib.loads(profile.read_text())
+            sources = dict.fromkeys(calibrated, profile) | sources
+            settings = calibrated | settings
 
-        return config
+        for key, value in settings.items():
+            logger.writeline(f"{key} = {to_toml_value(value)} from {sources[key]}")
+        return Config(**settings)
@@ -1,9 +1,153 @@
+from bisect import bisect_left, bisect_right
+from contextlib import AbstractContextManager, nullcontext
+from dataclasses import asdict, dataclass
 from decimal import Decimal
+from fractions import Fraction
+from functools import wraps
+import socket
 import sqlite3
 from pathlib import Path
+import time
+from typing import Callable, Iterable, Iterator
+
+from vedit.lock import FileLock
+from vedit.logger import get_logger
+
+logger = get_logger()
 
 TimeRange = tuple[Decimal, Decimal]
 
+# Each entry upgrades the schema by one version, tracked in PRAGMA user_version.
+# Never edit an existing entry, append a new one instead.
+MIGRATIONS: list[str] = [
+    # 1: typed and indexed process_log. Databases from older versions stored
+    # the times as TEXT, so they get copied across.
+    """CREATE TABLE IF NOT EXISTS process_log (
+        timestamp TEXT, source_file TEXT, output_file TEXT, start_time TEXT, end_time TEXT, status TEXT
+    );
+    ALTER TABLE process_log RENAME TO process_log_v0;
+    CREATE TABLE process_log (
+        timestamp TEXT, source_file TEXT NOT NULL, output_file TEXT, start_time REAL NOT NULL, end_time REAL NOT NULL, status TEXT NOT NULL
+    );
+    INSERT INTO process_log
+        SELECT timestamp, source_file, output_file, CAST(start_time AS REAL), CAST(end_time AS REAL), status
+        FROM process_log_v0;
+    DROP TABLE process_log_v0;
+    CREATE INDEX process_log_source_status ON process_log (source_file, status, start_time);""",
+    # 2: ffprobe results
+    """CREATE TABLE IF NOT EXISTS probe_cache (
+        path TEXT PRIMARY KEY, size INTEGER, mtime REAL, duration TEXT, width INTEGER, height INTEGER, codec TEXT, frame_rate TEXT
+    );""",
+    # 3: every chunk of work, planned up front so that workers can claim them
+    """CREATE TABLE jobs (
+        id INTEGER PRIMARY KEY, source_file TEXT NOT NULL, file_order INTEGER NOT NULL, start_time REAL NOT NULL, end_time REAL NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending', lease_owner TEXT, lease_expires REAL, output_file TEXT
+    );
+    CREATE INDEX jobs_claim ON jobs (status, file_order, start_time);
+    CREATE INDEX jobs_source_status ON jobs (source_file, status);""",
+    # 4: peak memory use of ffmpeg against the length of the chunk it worked on
+    """CREATE TABLE memory_usage (
+        width INTEGER NOT NULL, height INTEGER NOT NULL, footage_secs REAL NOT NULL, peak_rss INTEGER NOT NULL
+    );
+    CREATE INDEX memory_usage_resolution ON memory_usage (width, height);""",
+    # 5: what every ffmpeg and ffprobe invocation cost
+    """CREATE TABLE ffmpeg_runs (
+        id INTEGER PRIMARY KEY, timestamp TEXT, program TEXT NOT NULL, stage TEXT NOT NULL, input_file TEXT, start_time REAL, end_time REAL,
+        wall_secs REAL NOT NULL, cpu_secs REAL NOT NULL, peak_rss INTEGER NOT NULL, frames_in INTEGER, frames_out INTEGER, fps REAL, returncode INTEGER NOT NULL
+    );""",
+    # 6: where each source file's keyframes are, space separated seconds
+    """CREATE TABLE keyframe_index (
+        path TEXT PRIMARY KEY, size INTEGER, mtime REAL, times TEXT NOT NULL
+    );""",
+    # 7: runs of packets too small to have changed the picture, found with
+    # packets of at most max_bytes, as space separated start:end seconds
+    """CREATE TABLE static_runs (
+        path TEXT PRIMARY KEY, size INTEGER, mtime REAL, max_bytes INTEGER NOT NULL, runs TEXT NOT NULL
+    );""",
+    # 8: the chunk length each file's jobs were planned with
+    """CREATE TABLE planned_files (
+        source_file TEXT PRIMARY KEY, split_secs REAL NOT NULL
+    );""",
+    # 9: which machine measured each memory_usage row, NULL for rows brought in
+    # from its memory usage file
+    """ALTER TABLE memory_usage ADD COLUMN host TEXT;""",
+]
+
+
+def to_seconds(value: float) -> Decimal:
+    # Keep whole seconds looking like whole seconds, they end up in file names.
+    value = float(value)
+    if value.is_integer():
+        return Decimal(int(value))
+    return Decimal(repr(value))
+
+
+@dataclass(frozen=True)
+class Job:
+    id: int
+    source_file: Path
+    time_range: TimeRange
+
+
+@dataclass(frozen=True)
+class VideoInfo:
+    duration: Decimal
+    width: int
+    height: int
+    codec: str
+    frame_rate: Fraction
+
+
+@dataclass(frozen=True)
+class FFmpegRun:
+    program: str
+    stage: str
+    input_file: str
+    time_range: TimeRange | None
+    wall_secs: float
+    cpu_secs: float
+    peak_rss: int
+    # Video frames decoded and encoded, as ffmpeg reports them when it's done
+    frames_in: int | None
+    frames_out: int | None
+    returncode: int
+
+
+def snap_to_keyframe(
+    keyframes: list[Decimal], time_range: TimeRange, split: Decimal
+) -> Decimal:
+    """The last keyframe inside time_range at or before split.
+
+    Failing that the first one after it, and split itself if the range has
+    no keyframes to split on.
+    """
+    start, end = time_range
+    i = bisect_right(keyframes, split)
+    if i and keyframes[i - 1] > start:
+        return keyframes[i - 1]
+    if i < len(keyframes) and keyframes[i] < end:
+        return keyframes[i]
+    return split
+
+
+def split_range(
+    time_range: TimeRange, max_secs: Decimal, keyframes: list[Decimal] = ()
+) -> list[TimeRange]:
+    """Pieces of time_range at most max_secs long, or split on keyframes if given.
+
+    Splitting on keyframes lets every piece be cut exactly with a stream copy,
+    at the cost of pieces being up to a keyframe interval shorter or longer.
+    """
+    start, end = time_range
+    ranges = []
+    while start < end:
+        split = min(start + max_secs, end)
+        if split < end and keyframes:
+            split = snap_to_keyframe(keyframes, (start, end), split)
+        ranges.append((start, split))
+        start = split
+    return ranges
+
 
 def merge_intervals(intervals: set[TimeRange]) -> list[TimeRange]:
     # Sort intervals based on the start time
@@ -50,23 +194,224 @@ def find_uncovered_gaps(
     return uncovered_gaps
 
 
+class IntervalSet:
+    """Sorted, non-overlapping time ranges that can be grown one range at a time."""
+
+    def __init__(self, intervals: Iterable[TimeRange] = ()):
+        self.intervals: list[TimeRange] = merge_intervals(set(intervals))
+
+    def add(self, interval: TimeRange) -> None:
+        start, end = interval
+        lo = bisect_left(self.intervals, start, key=lambda r: r[0])
+        if lo > 0 and self.intervals[lo - 1][1] >= start:
+            lo -= 1
+        hi = lo
+        while hi < len(self.intervals) and self.intervals[hi][0] <= end:
+            hi += 1
+
+        if lo < hi:
+            start = min(start, self.intervals[lo][0])
+            end = max(end, self.intervals[hi - 1][1])
+        self.intervals[lo:hi] = [(start, end)]
+
+    def gaps(self, max_range: TimeRange) -> Iterator[TimeRange]:
+        position, upper = max_range
+        for start, end in self.intervals:
+            if start >= upper:
+                break
+            if start > position:
+                yield position, start
+            position = max(position, end)
+
+        if position < upper:
+            yield position, upper
+
+
+def write_transaction(method: Callable) -> Callable:
+    @wraps(method)
+    def wrapper(self: "DB", *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+# Reads hold the lock too: a share's byte range locks can't be relied on to
+# keep them from seeing another machine's write halfway through.
+read_transaction = write_transaction
+
+
 class DB:
-    def __init__(self, conn: sqlite3.Connection):
+    def __init__(
+        self,
+        conn: sqlite3.Connection,
+        lock: AbstractContextManager | None = None,
+    ):
         self.conn = conn
+        self.lock = lock or nullcontext()
+        # Files keyframes_of had nothing for, so that is only logged once
+        self.unindexed: set[str] = set()
 
     def close(self) -> None:
         self.conn.close()
 
     @classmethod
-    def create_db(cls, db_path: Path) -> "DB":
-        with sqlite3.connect(db_path) as conn:
-            conn.execute(
-                """CREATE TABLE IF NOT EXISTS process_log (
-                    timestamp TEXT, source_file TEXT, output_file TEXT, start_time TEXT, end_time TEXT, status TEXT
-                )"""
+    def create_db(cls, db_path: Path, shared_as: str | None = None) -> "DB":
+        """Open (and create or upgrade) the db.
+
+        Pass shared_as (a worker id) when processes on other machines use the
+        same file over a network share. WAL needs shared memory between all
+        processes, so that falls back to the rollback journal and guards
+        reads and writes with a lock file as well.
+        """
+        if shared_as is None:
+            conn = sqlite3.connect(db_path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            lock = None
+        else:
+            conn = sqlite3.connect(db_path, timeout=60)
+            conn.execute("PRAGMA journal_mode=DELETE")
+            lock = FileLock(db_path.with_suffix(".lock"), owner=shared_as)
+
+        db = cls(conn, lock)
+        with db.lock:
+            cls.migrate(conn)
+        return db
+
+    @staticmethod
+    def migrate(conn: sqlite3.Connection) -> None:
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+        for new_version, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.executescript(
+                f"BEGIN; {script} PRAGMA user_version = {new_version}; COMMIT;"
             )
-        return cls(conn)
 
+    @read_transaction
+    def get_video_info(self, video_file: Path) -> VideoInfo | None:
+        # A cached probe is only valid while the file looks the same as when
+        # it was probed, which catches recordings that were still being written.
+        stat = video_file.stat()
+        cursor = self.conn.execute(
+            """SELECT duration, width, height, codec, frame_rate
+            FROM probe_cache
+            WHERE path = :path AND size = :size AND mtime = :mtime""",
+            dict(path=video_file.as_posix(), size=stat.st_size, mtime=stat.st_mtime),
+        )
+        if (row := cursor.fetchone()) is None:
+            return None
+
+        duration, width, height, codec, frame_rate = row
+        return VideoInfo(Decimal(duration), width, height, codec, Fraction(frame_rate))
+
+    @write_transaction
+    def save_video_info(self, video_file: Path, info: VideoInfo) -> None:
+        stat = video_file.stat()
+        self.conn.execute(
+            """INSERT OR REPLACE INTO probe_cache (path, size, mtime, duration, width, height, codec, frame_rate)
+            VALUES (:path, :size, :mtime, :duration, :width, :height, :codec, :frame_rate)""",
+            dict(
+                path=video_file.as_posix(),
+                size=stat.st_size,
+                mtime=stat.st_mtime,
+                duration=str(info.duration),
+                width=info.width,
+                height=info.height,
+                codec=info.codec,
+                frame_rate=str(info.frame_rate),
+            ),
+        )
+        self.conn.commit()
+
+    @read_transaction
+    def get_keyframes(self, video_file: Path) -> list[Decimal] | None:
+        """Cached keyframe times, if video_file hasn't changed since."""
+        stat = video_file.stat()
+        cursor = self.conn.execute(
+            """SELECT times FROM keyframe_index
+            WHERE path = :path AND size = :size AND mtime = :mtime""",
+            dict(path=video_file.as_posix(), size=stat.st_size, mtime=stat.st_mtime),
+        )
+        if (row := cursor.fetchone()) is None:
+            return None
+        return [to_seconds(t) for t in row[0].split()]
+
+    @write_transaction
+    def save_keyframes(self, video_file: Path, keyframes: list[Decimal]) -> None:
+        stat = video_file.stat()
+        self.conn.execute(
+            """INSERT OR REPLACE INTO keyframe_index (path, size, mtime, times)
+            VALUES (:path, :size, :mtime, :times)""",
+            dict(
+                path=video_file.as_posix(),
+                size=stat.st_size,
+                mtime=stat.st_mtime,
+                times=" ".join(str(t) for t in keyframes),
+            ),
+        )
+        self.conn.commit()
+
+    @read_transaction
+    def get_static_runs(
+        self, video_file: Path, max_bytes: int
+    ) -> list[TimeRange] | None:
+        """Cached static runs, if video_file was scanned for them with max_bytes."""
+        stat = video_file.stat()
+        cursor = self.conn.execute(
+            """SELECT runs FROM static_runs
+            WHERE path = :path AND size = :size AND mtime = :mtime AND max_bytes = :max_bytes""",
+            dict(
+                path=video_file.as_posix(),
+                size=stat.st_size,
+                mtime=stat.st_mtime,
+                max_bytes=max_bytes,
+            ),
+        )
+        if (row := cursor.fetchone()) is None:
+            return None
+        return [
+            (to_seconds(start), to_seconds(end))
+            for start, end in (run.split(":") for run in row[0].split())
+        ]
+
+    @write_transaction
+    def save_static_runs(
+        self, video_file: Path, max_bytes: int, runs: list[TimeRange]
+    ) -> None:
+        stat = video_file.stat()
+        self.conn.execute(
+            """INSERT OR REPLACE INTO static_runs (path, size, mtime, max_bytes, runs)
+            VALUES (:path, :size, :mtime, :max_bytes, :runs)""",
+            dict(
+                path=video_file.as_posix(),
+                size=stat.st_size,
+                mtime=stat.st_mtime,
+                max_bytes=max_bytes,
+                runs=" ".join(f"{start}:{end}" for start, end in runs),
+            ),
+        )
+        self.conn.commit()
+
+    def keyframes_of(self, source_file: Path | str) -> list[Decimal]:
+        """Keyframes to split source_file's jobs on, none if it wasn't indexed.
+
+        Unlike get_keyframes this doesn't look at the file, which workers on
+        other machines may not see under the same path.
+        """
+        path = source_file.as_posix() if isinstance(source_file, Path) else source_file
+        cursor = self.conn.execute(
+            "SELECT times FROM keyframe_index WHERE path = ?", [path]
+        )
+        if (row := cursor.fetchone()) is None:
+            if path not in self.unindexed:
+                self.unindexed.add(path)
+                logger.writeline(
+                    f"No keyframes indexed for {path}, its chunks won't start on "
+                    "keyframes and cutting them may repeat or skip a little"
+                )
+            return []
+        return [to_seconds(t) for t in row[0].split()]
+
+    @write_transaction
     def log_status(
         self,
         source_file: Path,
@@ -81,13 +426,14 @@ class DB:
             dict(
                 source_file=source_file.as_posix(),
                 output_file=output_file.as_posix() if output_file else None,
-                start=str(start),
-                end=str(end),
+                start=float(start),
+                end=float(end),
                 status=status,
             ),
         )
         self.conn.commit()
 
+    @read_transaction
     def read_ranges(self, source_file: Path, status: str) -> list[TimeRange]:
         cursor = self.conn.execute(
             """SELECT start_time, end_time
@@ -96,19 +442,32 @@ class DB:
             ORDER BY start_time""",
             dict(source_file=source_file.as_posix(), status=status),
         )
-        return [(Decimal(s), Decimal(e)) for (s, e) in cursor.fetchall()]
+        return [(to_seconds(s), to_seconds(e)) for (s, e) in cursor.fetchall()]
 
+    @read_transaction
+    def pending_ranges(self, source_file: Path) -> list[TimeRange]:
+        """Ranges of source_file's jobs that nobody has started on yet."""
+        cursor = self.conn.execute(
+            """SELECT start_time, end_time FROM jobs
+            WHERE source_file = :source_file AND status = 'pending'
+            ORDER BY start_time""",
+            dict(source_file=source_file.as_posix()),
+        )
+        return [(to_seconds(s), to_seconds(e)) for (s, e) in cursor.fetchall()]
+
+    @read_transaction
     def get_total_processed_duration(self, source_files: list[Path]) -> Decimal:
         cursor = self.conn.execute(
             f"""SELECT SUM(end_time - start_time)
             FROM process_log
-            WHERE source_file IN ({", ".join( "?"* len(source_files))}) AND status = 'success'""",
+            WHERE source_file IN ({", ".join( "?"* len(source_files))}) AND status IN ('success', 'static', 'merged')""",
             [s.as_posix() for s in source_files],
         )
         ans, *_ = cursor.fetchone()
 
-        return Decimal(ans or 0)
+        return to_seconds(round(ans or 0.0, 6))
 
+    @read_transaction
     def get_merge_order(self, source_file: Path) -> list[Path]:
         cursor = self.conn.execute(
             """SELECT output_file
@@ -119,51 +478,476 @@ class DB:
         )
         return [Path(v) for (v,) in cursor.fetchall()]
 
+    @read_transaction
+    def next_chunks_to_merge(self, source_file: Path) -> list[tuple[TimeRange, Path]]:
+        """Finished chunks carrying on from the start of the file or its last part.
 
-class EditingTracker:
-    def __init__(
+        Chunks after a range that is still being worked on wait for it, so
+        parts always come out in order.
+        """
+        cursor = self.conn.execute(
+            """SELECT start_time, end_time, output_file, status FROM process_log
+            WHERE source_file = :source_file AND status IN ('success', 'static', 'merged')
+            ORDER BY start_time""",
+            dict(source_file=source_file.as_posix()),
+        )
+        frontier = Decimal(0)
+        chunks = []
+        for start, end, output_file, status in cursor.fetchall():
+            start, end = to_seconds(start), to_seconds(end)
+            if start > frontier:
+                break
+            if status == "success":
+                chunks.append(((start, end), Path(output_file)))
+            frontier = max(frontier, end)
+        return chunks
+
+    @read_transaction
+    def get_chunks(self, source_file: Path) -> list[tuple[TimeRange, Path]]:
+        """Every finished chunk not merged into a part yet, in order."""
+        cursor = self.conn.execute(
+            """SELECT start_time, end_time, output_file FROM process_log
+            WHERE source_file = :source_file AND status = 'success'
+            ORDER BY start_time""",
+            dict(source_file=source_file.as_posix()),
+        )
+        return [
+            ((to_seconds(s), to_seconds(e)), Path(v)) for s, e, v in cursor.fetchall()
+        ]
+
+    @read_transaction
+    def get_parts(self, source_file: Path) -> list[Path]:
+        cursor = self.conn.execute(
+            """SELECT output_file FROM process_log
+            WHERE source_file = :source_file AND status = 'merged'
+            ORDER BY start_time""",
+            dict(source_file=source_file.as_posix()),
+        )
+        return [Path(v) for (v,) in cursor.fetchall()]
+
+    @write_transaction
+    def record_part(
+        self, source_file: Path, chunks: list[tuple[TimeRange, Path]], part: Path
+    ) -> None:
+        """Replace chunks with the part they were merged into."""
+        outputs = [chunk.as_posix() for _, chunk in chunks]
+        placeholders = ", ".join("?" * len(outputs))
+        self.conn.execute(
+            f"""DELETE FROM process_log
+            WHERE source_file = ? AND status = 'success' AND output_file IN ({placeholders})""",
+            [source_file.as_posix(), *outputs],
+        )
+        self.conn.execute(
+            f"""UPDATE jobs SET output_file = ?
+            WHERE source_file = ? AND status = 'done' AND output_file IN ({placeholders})""",
+            [part.as_posix(), source_file.as_posix(), *outputs],
+        )
+        (start, _), _ = chunks[0]
+        (_, end), _ = chunks[-1]
+        self.log_status(source_file, part, (start, end), "merged")
+
+    @write_transaction
+    def requeue_missing_outputs(self, exists: Callable[[Path], bool]) -> None:
+        """Put jobs whose chunk or part has gone missing back in the queue.
+
+        Chunks in a scratch_dir on a RAM disk don't survive a restart.
+        """
+        cursor = self.conn.execute(
+            "SELECT DISTINCT output_file FROM jobs WHERE status = 'done'"
+        )
+        missing = [
+            dict(output_file=output_file)
+            for (output_file,) in cursor.fetchall()
+            if not exists(Path(output_file))
+        ]
+        self.conn.executemany(
+            """UPDATE jobs SET status = 'pending', output_file = NULL, lease_owner = NULL, lease_expires = NULL
+            WHERE status = 'done' AND output_file = :output_file""",
+            missing,
+        )
+        self.conn.executemany(
+            """DELETE FROM process_log
+            WHERE status IN ('success', 'merged') AND output_file = :output_file""",
+            missing,
+        )
+        self.conn.commit()
+
+    @write_transaction
+    def plan_jobs(
         self,
-        path: Path,
+        source_file: Path,
+        file_order: int,
         video_duration: Decimal,
         split_time: Decimal,
-        db: DB,
-        split_factor: Decimal = 2,
-    ):
-        self.path = path
-        self.video_duration = video_duration
-        self.split_time = split_time
-        self.split_factor = split_factor
+        static: list[TimeRange] = (),
+    ) -> None:
+        """Split whatever is left of a file into pending jobs, once per file.
+
+        Ranges that already succeeded in process_log are left out, so
+        databases from before the job table resume where they left off.
+        So are the static ranges, which are logged as done without any output.
+        Planning a file again with another split_time replans the jobs nobody
+        has started on yet.
+        """
+        params = dict(
+            source_file=source_file.as_posix(),
+            file_order=file_order,
+            split_secs=float(split_time),
+        )
+        if self.conn.execute(
+            "SELECT 1 FROM jobs WHERE source_file = :source_file LIMIT 1", params
+        ).fetchone():
+            # Already planned, the order of files may have changed though
+            self.conn.execute(
+                "UPDATE jobs SET file_order = :file_order WHERE source_file = :source_file",
+                params,
+            )
+            planned = self.conn.execute(
+                "SELECT split_secs FROM planned_files WHERE source_file = :source_file",
+                params,
+            ).fetchone()
+            # Databases from before planned_files keep the jobs they have
+            if planned and to_seconds(planned[0]) != split_time:
+                self.replan_pending_jobs(source_file, file_order, split_time)
+            self.record_plan(params)
+            self.conn.commit()
+            return
+
+        logged = self.read_ranges(source_file, "static")
+        for time_range in static:
+            if time_range not in logged:
+                self.log_status(source_file, None, time_range, "static")
+        succeeded = IntervalSet(
+            self.read_ranges(source_file, "success")
+            + self.read_ranges(source_file, "static")
+        )
+        jobs = [
+            dict(params, start=float(start), end=float(end))
+            for gap in succeeded.gaps((Decimal(0), video_duration))
+            for start, end in split_range(
+                gap, split_time, self.keyframes_of(source_file)
+            )
+        ]
+
+        self.conn.executemany(
+            """INSERT INTO jobs (source_file, file_order, start_time, end_time)
+            VALUES (:source_file, :file_order, :start, :end)""",
+            jobs,
+        )
+        self.record_plan(params)
+        self.conn.commit()
 
-        self.db = db
+    def record_plan(self, params: dict) -> None:
+        self.conn.execute(
+            """INSERT OR REPLACE INTO planned_files (source_file, split_secs)
+            VALUES (:source_file, :split_secs)""",
+            params,
+        )
 
-    def next(self) -> TimeRange | None:
-        current_range = self.current_range()
-        if current_range is None:
+    def replan_pending_jobs(
+        self, source_file: Path, file_order: int, split_time: Decimal
+    ) -> None:
+        """Replace the pending jobs of source_file with ones of split_time.
+
+        Neighbouring pending jobs are joined up first, so they can get longer
+        as well as shorter.
+        """
+        cursor = self.conn.execute(
+            """DELETE FROM jobs WHERE source_file = ? AND status = 'pending'
+            RETURNING start_time, end_time""",
+            [source_file.as_posix()],
+        )
+        pending = IntervalSet(
+            (to_seconds(start), to_seconds(end)) for start, end in cursor.fetchall()
+        )
+        keyframes = self.keyframes_of(source_file)
+        self.conn.executemany(
+            """INSERT INTO jobs (source_file, file_order, start_time, end_time)
+            VALUES (?, ?, ?, ?)""",
+            [
+                (source_file.as_posix(), file_order, float(start), float(end))
+                for time_range in pending.intervals
+                for start, end in split_range(time_range, split_time, keyframes)
+            ],
+        )
+
+    @write_transaction
+    def claim_job(
+        self, owner: str, lease_secs: float, now: float | None = None
+    ) -> Job | None:
+        """Atomically lease the next job, including ones whose lease ran out."""
+        now = time.time() if now is None else now
+        cursor = self.conn.execute(
+            """UPDATE jobs SET status = 'leased', lease_owner = :owner, lease_expires = :expires
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE status = 'pending' OR (status = 'leased' AND lease_expires < :now)
+                ORDER BY file_order, start_time
+                LIMIT 1
+            )
+            RETURNING id, source_file, start_time, end_time""",
+            dict(owner=owner, expires=now + lease_secs, now=now),
+        )
+        row = cursor.fetchone()
+        self.conn.commit()
+        if row is None:
             return None
 
-        start, range_duration = current_range
-        next = min(start + self.split_time, range_duration)
+        job_id, source_file, start, end = row
+        return Job(job_id, Path(source_file), (to_seconds(start), to_seconds(end)))
+
+    @write_transaction
+    def renew_leases(
+        self, owner: str, jobs: list[Job], lease_secs: float, now: float | None = None
+    ) -> None:
+        now = time.time() if now is None else now
+        self.conn.executemany(
+            """UPDATE jobs SET lease_expires = :expires
+            WHERE id = :id AND lease_owner = :owner AND status = 'leased'""",
+            [dict(id=job.id, owner=owner, expires=now + lease_secs) for job in jobs],
+        )
+        self.conn.commit()
+
+    @write_transaction
+    def complete_job(self, job: Job, output_file: Path) -> bool:
+        """Mark a job as done, unless someone else finished it first.
+
+        That can only happen if our lease expired and the job was claimed
+        again, in which case the caller should throw its output away.
+        """
+        cursor = self.conn.execute(
+            """UPDATE jobs SET status = 'done', output_file = :output_file, lease_owner = NULL
+            WHERE id = :id AND status = 'leased'""",
+            dict(id=job.id, output_file=output_file.as_posix()),
+        )
+        if cursor.rowcount == 0:
+            self.conn.rollback()
+            return False
+
+        self.log_status(job.source_file, output_file, job.time_range, "success")
+        return True
+
+    @write_transaction
+    def fail_job(
+        self, job: Job, split_factor: Decimal = 2, max_secs: Decimal | None = None
+    ) -> None:
+        """Replace a failed job with smaller ones covering the same range.
+
+        The range is split in two, or into pieces of max_secs if that is
+        smaller still.
+        """
+        start, end = job.time_range
+        keyframes = self.keyframes_of(job.source_file)
+        split = start + (end - start) / split_factor
+        if max_secs is not None and max_secs < split - start:
+            ranges = split_range(job.time_range, max_secs, keyframes)
+        else:
+            split = snap_to_keyframe(keyframes, job.time_range, split)
+            ranges = [(start, split), (split, end)]
+        cursor = self.conn.execute(
+            """UPDATE jobs SET status = 'failed', lease_owner = NULL
+            WHERE id = :id AND status = 'leased'""",
+            dict(id=job.id),
+        )
+        if cursor.rowcount == 0:
+            self.conn.rollback()
+            return
+
+        self.conn.executemany(
+            """INSERT INTO jobs (source_file, file_order, start_time, end_time)
+            SELECT source_file, file_order, :start, :end FROM jobs WHERE id = :id""",
+            [dict(id=job.id, start=float(s), end=float(e)) for s, e in ranges],
+        )
+        self.log_status(job.source_file, None, job.time_range, "failed")
+
+    @write_transaction
+    def split_pending_jobs(self, source_files: list[Path], max_secs: Decimal) -> None:
+        """Split jobs nobody has started on yet into pieces of at most max_secs."""
+        cursor = self.conn.execute(
+            f"""SELECT id, source_file, file_order, start_time, end_time FROM jobs
+            WHERE source_file IN ({", ".join("?" * len(source_files))})
+            AND status = 'pending' AND end_time - start_time > ?""",
+            [s.as_posix() for s in source_files] + [float(max_secs)],
+        )
+        keyframes: dict[str, list[Decimal]] = {}
+        for job_id, source_file, file_order, start, end in cursor.fetchall():
+            # Someone may have claimed it in the meantime
+            if not self.conn.execute(
+                "DELETE FROM jobs WHERE id = ? AND status = 'pending'", [job_id]
+            ).rowcount:
+                continue
+            if source_file not in keyframes:
+                keyframes[source_file] = self.keyframes_of(source_file)
+            self.conn.executemany(
+                """INSERT INTO jobs (source_file, file_order, start_time, end_time)
+                VALUES (?, ?, ?, ?)""",
+                [
+                    (source_file, file_order, float(s), float(e))
+                    for s, e in split_range(
+                        (to_seconds(start), to_seconds(end)),
+                        max_secs,
+                        keyframes[source_file],
+                    )
+                ],
+            )
+        self.conn.commit()
 
-        if attempted_ranges := [
-            e for s, e in self.db.read_ranges(self.path, status="failed") if s == start
-        ]:
-            next = (min(attempted_ranges) + start) / self.split_factor
+    @write_transaction
+    def record_memory_usage(
+        self, width: int, height: int, footage_secs: Decimal, peak_rss: int
+    ) -> None:
+        self.conn.execute(
+            """INSERT INTO memory_usage (width, height, footage_secs, peak_rss, host)
+            VALUES (?, ?, ?, ?, ?)""",
+            [width, height, float(footage_secs), peak_rss, socket.gethostname()],
+        )
+        self.conn.commit()
 
-        return start, next
+    @write_transaction
+    def import_memory_usage(self, path: Path) -> None:
+        """Start from what path knows about memory use, unless that was done already."""
+        (imported,) = self.conn.execute(
+            "SELECT COUNT(*) FROM memory_usage WHERE host IS NULL"
+        ).fetchone()
+        if imported or not path.exists():
+            return
+        self.conn.execute("ATTACH DATABASE ? AS host", [path.as_posix()])
+        self.conn.execute(
+            """INSERT INTO memory_usage (width, height, footage_secs, peak_rss)
+            SELECT width, height, footage_secs, peak_rss FROM host.memory_usage"""
+        )
+        self.conn.commit()
+        self.conn.execute("DETACH DATABASE host")
 
-    def success(self, out_path: Path, completed_range: TimeRange) -> None:
-        self.db.log_status(self.path, out_path, completed_range, "success")
+    @read_transaction
+    def export_memory_usage(self, path: Path) -> None:
+        """Add the memory use measured on this machine to path, to keep after cleaning up."""
+        self.conn.execute("ATTACH DATABASE ? AS host", [path.as_posix()])
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS host.memory_usage (
+                width INTEGER NOT NULL, height INTEGER NOT NULL, footage_secs REAL NOT NULL, peak_rss INTEGER NOT NULL
+            )"""
+        )
+        self.conn.execute(
+            """INSERT INTO host.memory_usage
+            SELECT width, height, footage_secs, peak_rss FROM memory_usage WHERE host = ?""",
+            [socket.gethostname()],
+        )
+        self.conn.commit()
+        self.conn.execute("DETACH DATABASE host")
 
-    def failed(self, bad_range: TimeRange) -> None:
-        self.db.log_status(self.path, None, bad_range, "failed")
+    @read_transaction
+    def get_memory_model(self, width: int, height: int) -> tuple[float, float] | None:
+        """Fixed bytes plus bytes per second of footage that ffmpeg needs.
 
-    def current_range(self) -> TimeRange | None:
-        full_time_range = (Decimal(0), self.video_duration)
-        succeeded_ranges = self.db.read_ranges(self.path, status="success")
-        uncovered_ranges = find_uncovered_gaps(succeeded_ranges, full_time_range)
-        if not uncovered_ranges:
+        A least squares fit over every chunk processed at this resolution.
+        With only one chunk length to go on, all of it counts per second.
+        """
+        cursor = self.conn.execute(
+            """SELECT COUNT(*), SUM(footage_secs), SUM(peak_rss), SUM(footage_secs * footage_secs),
+                SUM(footage_secs * peak_rss), MAX(footage_secs) - MIN(footage_secs), MAX(peak_rss * 1.0 / footage_secs)
+            FROM memory_usage
+            WHERE width = ? AND height = ? AND footage_secs > 0""",
+            [width, height],
+        )
+        n, sum_x, sum_y, sum_xx, sum_xy, spread, max_rate = cursor.fetchone()
+        if not n:
             return None
-        return uncovered_ranges[0]
+        if spread < 1:
+            return 0.0, max_rate
+
+        bytes_per_sec = (n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x * sum_x)
+        if bytes_per_sec <= 0:
+            return 0.0, max_rate
+        fixed_bytes = max((sum_y - bytes_per_sec * sum_x) / n, 0.0)
+        return fixed_bytes, bytes_per_sec
+
+    @read_transaction
+    def file_done(self, source_file: Path) -> bool:
+        cursor = self.conn.execute(
+            """SELECT COUNT(*) FROM jobs
+            WHERE source_file = :source_file AND status IN ('pending', 'leased')""",
+            dict(source_file=source_file.as_posix()),
+        )
+        (remaining,) = cursor.fetchone()
+        return remaining == 0
+
+    @write_transaction
+    def release_dead_leases(self, host: str, is_alive: Callable[[int], bool]) -> None:
+        """Hand back jobs leased by processes on this host that no longer exist.
+
+        Lease expiry covers crashed workers anywhere, this just saves waiting
+        for it when restarting on the same machine.
+        """
+        cursor = self.conn.execute(
+            """SELECT id, lease_owner FROM jobs
+            WHERE status = 'leased' AND lease_owner LIKE :pattern""",
+            dict(pattern=f"{host}:%"),
+        )
+        dead_jobs = [
+            dict(id=job_id)
+            for job_id, owner in cursor.fetchall()
+            if not is_alive(int(owner.rsplit(":", 1)[1]))
+        ]
+        self.conn.executemany(
+            """UPDATE jobs SET status = 'pending', lease_owner = NULL, lease_expires = NULL
+            WHERE id = :id""",
+            dead_jobs,
+        )
+        self.conn.commit()
+
+    @read_transaction
+    def get_total_planned_duration(self) -> Decimal:
+        cursor = self.conn.execute(
+            "SELECT SUM(end_time - start_time) FROM jobs WHERE status != 'failed'"
+        )
+        ans, *_ = cursor.fetchone()
+
+        return to_seconds(round(ans or 0.0, 6))
+
+    @write_transaction
+    def record_runs(self, runs: list[FFmpegRun]) -> None:
+        self.conn.executemany(
+            """INSERT INTO ffmpeg_runs (timestamp, program, stage, input_file, start_time, end_time,
+                wall_secs, cpu_secs, peak_rss, frames_in, frames_out, fps, returncode)
+            VALUES (strftime('%Y-%m-%d %H-%M-%f','now'), :program, :stage, :input_file, :start, :end,
+                :wall_secs, :cpu_secs, :peak_rss, :frames_in, :frames_out, :fps, :returncode)""",
+            [
+                dict(
+                    asdict(run),
+                    start=float(run.time_range[0]) if run.time_range else None,
+                    end=float(run.time_range[1]) if run.time_range else None,
+                    fps=(
+                        run.frames_out / run.wall_secs
+                        if run.frames_out is not None and run.wall_secs
+                        else None
+                    ),
+                )
+                for run in runs
+            ],
+        )
+        self.conn.commit()
+
+    @read_transaction
+    def export_runs(self, path: Path, append: bool = False) -> None:
+        """Copy ffmpeg_runs to a db of their own, to keep after cleaning up."""
+        if not append:
+            path.unlink(missing_ok=True)
+        self.conn.execute("ATTACH DATABASE ? AS export", [path.as_posix()])
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS export.ffmpeg_runs AS
+            SELECT * FROM ffmpeg_runs WHERE 0"""
+        )
+        self.conn.execute("INSERT INTO export.ffmpeg_runs SELECT * FROM ffmpeg_runs")
+        self.conn.commit()
+        self.conn.execute("DETACH DATABASE export")
+
+    @read_transaction
+    def get_source_files(self) -> list[Path]:
+        cursor = self.conn.execute("SELECT DISTINCT source_file FROM jobs")
+        return [Path(v) for (v,) in cursor.fetchall()]
 
-    def done(self) -> bool:
-        return self.current_range() is None
+    @read_transaction
+    def count_jobs(self) -> dict[str, int]:
+        cursor = self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return dict(cursor.fetchall())
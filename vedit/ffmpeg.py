@@ -1,28 +1,487 @@
+from collections import Counter
+from contextlib import contextmanager
 from decimal import Decimal
+from fractions import Fraction
+import io
+import json
+import os
+import re
 import subprocess
 from pathlib import Path
-from typing import Iterator
+import sys
+from threading import Event, Lock, Thread, local
+import time
+from typing import IO, BinaryIO, Callable, Iterator
+
+import psutil
 
 from vedit.logger import get_logger
-from vedit.db import DB
+from vedit.db import DB, FFmpegRun, TimeRange, VideoInfo, to_seconds
+from vedit.progress import Progress
+from vedit.codecs import INTERMEDIATE_CODECS
+from vedit.regions import ANALYSIS_HEIGHT, ANALYSIS_WIDTH, AnalysisRegions
 
 logger = get_logger()
 
+# Keeps Windows from opening a console for every ffmpeg, other platforms
+# don't have one to open.
+CREATE_NO_WINDOW = getattr(subprocess, "CREATE_NO_WINDOW", 0)
+
+# How often the memory use of a running ffmpeg is checked
+MEMORY_POLL_SECS = 0.25
+# ffmpeg is stopped once it uses this much of its memory limit, before the
+# machine starts swapping.
+MEMORY_KILL_AT = 0.9
+# CPU time an ffmpeg has to use between two samples to count as still working.
+# While it drops a long run of duplicate frames it decodes without writing
+# anything, so its -progress output alone doesn't move.
+STALL_CPU_SECS = 0.01
+# What getrusage's ru_maxrss is counted in
+MAXRSS_BYTES = 1 if sys.platform == "darwin" else 1024
+
+# ffmpeg's log levels, most severe first. Every line is tagged with its level
+# so that lines can be kept out of the log after reading them.
+LOG_LEVELS = ["panic", "fatal", "error", "warning", "info", "verbose", "debug", "trace"]
+LEVEL_TAG = re.compile(rf"\[({'|'.join(LOG_LEVELS)})\] ")
+# Summaries ffmpeg logs at verbose level when it finishes. Stream copies only
+# read and mux packets.
+INPUT_SUMMARY = re.compile(
+    r"Input stream #\S+ \(video\): (\d+) packets read[^;]*;(?: (\d+) frames decoded)?"
+)
+OUTPUT_SUMMARY = re.compile(
+    r"Output stream #\S+ \(video\): (?:(\d+) frames encoded; )?(\d+) packets muxed"
+)
+# -progress writes blocks of key=value lines, each ending in progress=...
+PROGRESS_LINE = re.compile(r"(\w+)=\s*(\S*)")
+# dedupe and select_frames write duplicate frames nowhere, so how far they
+# have got is told by an output that gets every frame read. It comes first,
+# -progress counts frame= for the first output.
+FRAMES_READ_OUTPUT = ("-map", "[read]", "-f", "null", "-")
+NULL_MUXER = "/null @"
+# Stages whose progress is passed on. Others go over the same part of the
+# input again, which would make it jump back.
+PROGRESS_STAGES = {"dedupe", "select"}
+
+
+def seek_args(time_range: TimeRange | None) -> list[str]:
+    if time_range is None:
+        return []
+    start_time, end_time = time_range
+    return ["-ss", str(start_time), "-t", str(end_time - start_time)]
+
+
+def framecrc_pts(text: str) -> list[Fraction]:
+    """Timestamps in seconds of the frames in framecrc output."""
+    time_base = Fraction(1)
+    pts = []
+    # Lines are "stream, dts, pts, duration, size, hash", after a # header
+    # that gives the time base
+    for line in text.splitlines():
+        if line.startswith("#tb 0:"):
+            time_base = Fraction(line.split(":", 1)[1].strip())
+        elif line and not line.startswith("#"):
+            pts.append(int(line.split(",")[2]) * time_base)
+    return pts
+
+
+def select_expression(frames: list[int]) -> str:
+    """A select filter expression that passes exactly the given frame numbers.
+
+    Consecutive frames are grouped into runs, which are then searched as a
+    balanced tree so each frame costs a handful of comparisons no matter how
+    many runs there are.
+    """
+    runs: list[tuple[int, int]] = []
+    for frame in sorted(frames):
+        if runs and runs[-1][1] == frame - 1:
+            runs[-1] = (runs[-1][0], frame)
+        else:
+            runs.append((frame, frame))
+
+    def search(runs: list[tuple[int, int]]) -> str:
+        if len(runs) == 1:
+            ((first, last),) = runs
+            return f"between(n,{first},{last})"
+        middle = len(runs) // 2
+        return (
+            f"if(lt(n,{runs[middle][0]}),{search(runs[:middle])},"
+            f"{search(runs[middle:])})"
+        )
+
+    return search(runs) if runs else "0"
+
+
+class MemoryLimitExceeded(subprocess.CalledProcessError):
+    """ffmpeg was stopped because it was about to use more memory than allowed."""
+
+
+class ProgressStalled(subprocess.CalledProcessError):
+    """ffmpeg was stopped because its progress stopped moving, it was most likely hung."""
+
+
+class TimeLimitExceeded(subprocess.CalledProcessError):
+    """ffmpeg was stopped because it ran for longer than it was given."""
+
+
+class Monitor:
+    """Keeps track of a running ffmpeg or ffprobe, from its stderr and samples of it.
+
+    Picks out the frame counts ffmpeg reports when it finishes and copies the
+    rest of stderr into the log down to log_level. Decides when to stop it:
+    once it nears memory_limit, once neither its -progress output nor its CPU
+    time have moved for stall_secs, or once it has run for timeout seconds.
+    Which of those it was is left in stopped_for.
+    """
+
+    def __init__(
+        self,
+        memory_limit: int | None,
+        log_level: str,
+        on_progress: Callable[[Progress], None] | None = None,
+        stall_secs: float = 0,
+        timeout: float | None = None,
+    ):
+        self.memory_limit = memory_limit
+        self.max_level = LOG_LEVELS.index(log_level)
+        self.on_progress = on_progress
+        self.stall_secs = stall_secs
+        self.timeout = timeout
+        self.peak_rss = 0
+        self.cpu_secs = 0.0
+        self.frames_decoded: int | None = None
+        self.frames_read: int | None = None
+        self.frames_out: int | None = None
+        self.stopped_for: type[subprocess.CalledProcessError] | None = None
+
+        self.progress: dict[str, str] = {}
+        self.position: tuple[str | None, str | None] = (None, None)
+        self.started = self.last_moved = time.monotonic()
+
+    def check(self, usage: psutil.Process) -> bool:
+        """Sample usage, True if it should be stopped."""
+        memory = usage.memory_info()
+        cpu = usage.cpu_times()
+        cpu_secs = cpu.user + cpu.system
+        if cpu_secs - self.cpu_secs >= STALL_CPU_SECS:
+            self.last_moved = time.monotonic()
+        self.cpu_secs = cpu_secs
+        # Windows keeps track of the peak itself
+        self.peak_rss = max(self.peak_rss, memory.rss, getattr(memory, "peak_wset", 0))
+
+        now = time.monotonic()
+        if self.memory_limit and memory.rss > self.memory_limit * MEMORY_KILL_AT:
+            self.stopped_for = MemoryLimitExceeded
+            logger.writeline(
+                f"Stopped ffmpeg using {memory.rss / 2**20:.0f}MB of memory, "
+                f"the limit is {self.memory_limit / 2**20:.0f}MB"
+            )
+        elif self.stall_secs and now - self.last_moved > self.stall_secs:
+            self.stopped_for = ProgressStalled
+            logger.writeline(
+                f"Stopped ffmpeg after {now - self.last_moved:.0f}s without progress "
+                "or CPU use"
+            )
+        elif self.timeout is not None and now - self.started > self.timeout:
+            self.stopped_for = TimeLimitExceeded
+            logger.writeline(f"Stopped ffmpeg after its {self.timeout:.0f}s were up")
+        return self.stopped_for is not None
+
+    def error(
+        self, returncode: int, cmd: list[str]
+    ) -> subprocess.CalledProcessError | None:
+        if self.stopped_for:
+            return self.stopped_for(returncode, cmd)
+        if returncode:
+            return subprocess.CalledProcessError(returncode, cmd)
+        return None
+
+    def handle_line(self, line: str) -> None:
+        if match := PROGRESS_LINE.fullmatch(line.rstrip()):
+            key, value = match.groups()
+            self.progress[key] = value
+            if key == "progress":
+                self.moved(self.progress)
+                self.report_progress(self.progress)
+                self.progress = {}
+            return
+
+        level = "info"
+        if match := LEVEL_TAG.search(line):
+            level = match[1]
+            line = line[: match.start()] + line[match.end() :]
+
+        if match := INPUT_SUMMARY.search(line):
+            packets, decoded = match.groups()
+            self.frames_decoded = (self.frames_decoded or 0) + int(decoded or packets)
+        elif match := OUTPUT_SUMMARY.search(line):
+            encoded, packets = match.groups()
+            if NULL_MUXER not in line:
+                self.frames_out = (self.frames_out or 0) + int(encoded or packets)
+            elif self.frames_read is None:
+                self.frames_read = int(encoded or packets)
+
+        if LOG_LEVELS.index(level) <= self.max_level:
+            logger.out_stream.write(line)
+
+    @property
+    def frames_in(self) -> int | None:
+        """Frames read, without the ones decoded on the way to a seek point.
+
+        Only the frames read output of dedupe and select_frames tells them
+        apart.
+        """
+        return self.frames_decoded if self.frames_read is None else self.frames_read
+
+    def moved(self, progress: dict[str, str]) -> None:
+        # Progress is written every half a second or so whether or not
+        # anything happened in between.
+        position = (progress.get("frame"), progress.get("out_time_us"))
+        if position != self.position:
+            self.position = position
+            self.last_moved = time.monotonic()
+
+    def report_progress(self, progress: dict[str, str]) -> None:
+        if self.on_progress is None or "frame" not in progress:
+            return
+        out_time = progress.get("out_time_us", "N/A")
+        speed = progress.get("speed", "N/A").rstrip("x")
+        self.on_progress(
+            Progress(
+                out_secs=0 if out_time == "N/A" else int(out_time) / 1_000_000,
+                frame=int(progress.get("frame", 0)),
+                fps=float(progress.get("fps", 0)),
+                speed=None if speed == "N/A" else float(speed),
+            )
+        )
+
+
+class ProcessMonitor(Monitor):
+    """A Monitor with a thread sampling process and one reading its stderr."""
+
+    def __init__(self, process: subprocess.Popen, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.process = process
+        self.exited = Event()
+        self.threads = [
+            Thread(target=self.sample, daemon=True),
+            Thread(target=self.read_stderr, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def sample(self) -> None:
+        try:
+            usage = psutil.Process(self.process.pid)
+            while not self.exited.wait(MEMORY_POLL_SECS):
+                if self.check(usage):
+                    self.process.kill()
+                    return
+        except psutil.Error:
+            # Exited between checks
+            pass
+
+    def read_stderr(self) -> None:
+        # Progress updates end in \r, they are passed on as they come
+        for line in io.TextIOWrapper(
+            self.process.stderr, encoding="utf-8", errors="replace", newline=""
+        ):
+            self.handle_line(line)
+        logger.out_stream.flush()
+
+    def wait(self) -> int:
+        # Samples miss whatever happened since the last one, and all of a
+        # run shorter than MEMORY_POLL_SECS. What the kernel kept count of
+        # is exact.
+        try:
+            _, status, usage = os.wait4(self.process.pid, 0)
+        except (AttributeError, ChildProcessError):
+            # Windows, or killing it reaped it already
+            returncode = self.process.wait()
+            self.stop_threads()
+            return returncode
+
+        self.process.returncode = os.waitstatus_to_exitcode(status)
+        self.stop_threads()
+        self.cpu_secs = usage.ru_utime + usage.ru_stime
+        self.peak_rss = max(self.peak_rss, usage.ru_maxrss * MAXRSS_BYTES)
+        return self.process.returncode
+
+    def stop_threads(self) -> None:
+        self.exited.set()
+        for thread in self.threads:
+            thread.join()
+
 
 class FFmpeg:
-    def run(self, *args: str, program: str = "ffmpeg") -> None:
-        cmd = [program, *args]
+    def __init__(
+        self,
+        memory_limit: int | None = None,
+        bin_dir: Path | None = None,
+        stall_secs: float = 0,
+    ) -> None:
+        # Wall time per stage, summed over every invocation (and every worker).
+        self.stage_timings: Counter[str] = Counter()
+        self.timings_lock = Lock()
+        # Bytes of memory each ffmpeg process may use, None for no limit.
+        self.memory_limit = memory_limit
+        # Peak memory use, where progress goes and time limits are per worker thread
+        self.local = local()
+        # Every invocation, until they are saved to the db with take_runs
+        self.runs: list[FFmpegRun] = []
+        # Where ffmpeg and ffprobe are, None to find them on PATH
+        self.bin_dir = bin_dir
+        # ffmpeg is stopped once its progress hasn't moved for this long, 0 for never
+        self.stall_secs = stall_secs
+
+    def record_timing(self, stage: str, seconds: float) -> None:
+        with self.timings_lock:
+            self.stage_timings[stage] += seconds
+
+    def log_stage_timings(self) -> None:
+        with self.timings_lock:
+            timings = ", ".join(
+                f"{stage} {seconds:.2f}s"
+                for stage, seconds in self.stage_timings.items()
+            )
+        logger.writeline(f"Time spent per stage: {timings}")
+
+    def take_runs(self) -> list[FFmpegRun]:
+        with self.timings_lock:
+            runs, self.runs = self.runs, []
+        return runs
+
+    def reset_peak_rss(self) -> None:
+        self.local.rss = 0
+
+    def peak_rss(self) -> int:
+        """Most memory used by one ffmpeg on this thread since reset_peak_rss."""
+        return getattr(self.local, "rss", 0)
+
+    @contextmanager
+    def progress_to(self, callback: Callable[[Progress], None]) -> Iterator[None]:
+        """Pass the progress of dedupe and select_frames on this thread to callback.
+
+        It is called from another thread while ffmpeg runs.
+        """
+        self.local.on_progress = callback
+        try:
+            yield
+        finally:
+            self.local.on_progress = None
+
+    @contextmanager
+    def time_limit(self, secs: float | None) -> Iterator[None]:
+        """Stop what runs on this thread once secs are up, with TimeLimitExceeded.
+
+        The limit is for every run in the block together, None for no limit.
+        """
+        self.local.deadline = None if secs is None else time.monotonic() + secs
+        try:
+            yield
+        finally:
+            self.local.deadline = None
+
+    @contextmanager
+    def process(
+        self,
+        cmd: list[str],
+        stage: str,
+        time_range: TimeRange | None = None,
+        stdout: IO | int | None = None,
+        log_level: str = "info",
+    ) -> Iterator[subprocess.Popen]:
+        """Start cmd, raising once it is done with if it failed.
+
+        What it cost is recorded whether it worked or not, see FFmpegRun.
+        Output goes to the log unless stdout says otherwise.
+        """
+        program, *args = cmd
+        cmd = self.command(cmd)
         logger.writeline(f"Running command: {' '.join(cmd)}")
 
-        res = subprocess.run(
-            args=cmd,
-            stdout=logger.out_stream,
-            stderr=logger.out_stream,
-            creationflags=subprocess.CREATE_NO_WINDOW,
+        deadline = getattr(self.local, "deadline", None)
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            cmd,
+            stdout=stdout or logger.out_stream,
+            stderr=subprocess.PIPE,
+            creationflags=CREATE_NO_WINDOW,
+        )
+        monitor = ProcessMonitor(
+            process,
+            self.memory_limit,
+            log_level,
+            on_progress=(
+                getattr(self.local, "on_progress", None)
+                if stage in PROGRESS_STAGES
+                else None
+            ),
+            # ffprobe has no progress to go by
+            stall_secs=self.stall_secs if program == "ffmpeg" else 0,
+            timeout=None if deadline is None else max(deadline - time.monotonic(), 0),
+        )
+        try:
+            yield process
+        finally:
+            if process.stdout:
+                process.stdout.close()
+            returncode = monitor.wait()
+            elapsed = time.perf_counter() - started
+            self.local.rss = max(self.peak_rss(), monitor.peak_rss)
+            self.record_run(
+                program, args, stage, time_range, elapsed, monitor, returncode
+            )
+
+        if error := monitor.error(returncode, cmd):
+            raise error
+        logger.writeline(f"{program} finished successfully in {elapsed:.2f}s!")
+
+    def command(self, cmd: list[str]) -> list[str]:
+        """cmd the way it is run."""
+        program, *args = cmd
+        if program == "ffmpeg":
+            # The frame counts are only logged at verbose level, progress is
+            # picked out of stderr along with them.
+            cmd = [program, "-loglevel", "+level+verbose", "-progress", "pipe:2", *args]
+        if self.bin_dir:
+            cmd = [(self.bin_dir / program).as_posix(), *cmd[1:]]
+        return cmd
+
+    def record_run(
+        self,
+        program: str,
+        args: list[str],
+        stage: str,
+        time_range: TimeRange | None,
+        elapsed: float,
+        monitor: Monitor,
+        returncode: int,
+    ) -> None:
+        self.record_timing(stage, elapsed)
+        run = FFmpegRun(
+            program=program,
+            stage=stage,
+            input_file=args[args.index("-i") + 1] if "-i" in args else args[-1],
+            time_range=time_range,
+            wall_secs=elapsed,
+            cpu_secs=monitor.cpu_secs,
+            peak_rss=monitor.peak_rss,
+            frames_in=monitor.frames_in,
+            frames_out=monitor.frames_out,
+            returncode=returncode,
         )
+        with self.timings_lock:
+            self.runs.append(run)
 
-        res.check_returncode()
-        logger.writeline("ffmpeg finished successfully!")
+    def run(
+        self,
+        *args: str,
+        program: str = "ffmpeg",
+        stage: str = "ffmpeg",
+        time_range: TimeRange | None = None,
+    ) -> None:
+        with self.process([program, *args], stage, time_range=time_range):
+            pass
 
     def get_video_duration(self, video_file: Path) -> Decimal:
         cmd = [
@@ -35,41 +494,123 @@ class FFmpeg:
             "default=noprint_wrappers=1:nokey=1",
             video_file.as_posix(),
         ]
-        logger.writeline(f"Running command: {' '.join(cmd)}")
+        with self.process(cmd, "probe", stdout=subprocess.PIPE) as process:
+            output = process.stdout.read()
+        return Decimal(output.decode())
 
-        res = subprocess.run(
-            args=cmd, capture_output=True, creationflags=subprocess.CREATE_NO_WINDOW
+    def probe(self, video_file: Path) -> VideoInfo:
+        cmd = [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "format=duration:stream=codec_name,width,height,avg_frame_rate,r_frame_rate",
+            "-of",
+            "json",
+            video_file.as_posix(),
+        ]
+        with self.process(cmd, "probe", stdout=subprocess.PIPE) as process:
+            output = process.stdout.read()
+
+        probe = json.loads(output.decode())
+        stream, *_ = probe["streams"]
+        frame_rate = stream["avg_frame_rate"]
+        if frame_rate == "0/0":
+            frame_rate = stream["r_frame_rate"]
+
+        return VideoInfo(
+            duration=Decimal(probe["format"]["duration"]),
+            width=stream["width"],
+            height=stream["height"],
+            codec=stream["codec_name"],
+            frame_rate=Fraction(frame_rate),
         )
-        res.check_returncode()
-        logger.writeline("ffprobe finished successfully!")
-        return Decimal(res.stdout.decode())
+
+    def packets(self, video_file: Path) -> list[tuple[Decimal, int, bool]]:
+        """Time, size and whether it is a keyframe, of every video packet.
+
+        Read from the container, so nothing is decoded.
+        """
+        cmd = [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "packet=pts_time,size,flags",
+            "-of",
+            "csv=p=0",
+            video_file.as_posix(),
+        ]
+        with self.process(cmd, "probe", stdout=subprocess.PIPE) as process:
+            output = process.stdout.read()
+
+        packets = []
+        for line in output.decode().splitlines():
+            pts_time, size, flags, *_ = line.split(",") + ["", ""]
+            if pts_time not in ("", "N/A"):
+                packets.append((to_seconds(pts_time), int(size or 0), "K" in flags))
+        return sorted(packets)
 
     def split(
-        self, in_file: Path, tmp_path: Path, seconds: int, prefix: str = ""
+        self,
+        in_file: Path,
+        tmp_path: Path,
+        seconds: int | None = None,
+        prefix: str = "",
+        split_at: list[Decimal] = (),
+        time_range: TimeRange | None = None,
+        segment_list: Path | None = None,
     ) -> list[Path]:
+        """Cut in_file into pieces in one read, every `seconds` or at split_at.
+
+        split_at is counted from the start of time_range. segment_list gets a
+        line for each piece as soon as it is written.
+        """
+        if split_at:
+            split_args = ["-segment_times", ",".join(str(t) for t in split_at)]
+        else:
+            split_args = ["-segment_time", str(seconds)]
+        if segment_list:
+            split_args += [
+                "-segment_list",
+                segment_list.as_posix(),
+                "-segment_list_type",
+                "csv",
+            ]
         self.run(
             "-y",
+            *seek_args(time_range),
             "-i",
             in_file.as_posix(),
             "-c",
             "copy",
             "-map",
             "0:v",
-            "-segment_time",
-            str(seconds),
+            *split_args,
             "-f",
             "segment",
             "-reset_timestamps",
             "1",
             tmp_path.joinpath(f"{prefix}%04d{in_file.suffix}").as_posix(),
+            stage="split",
+            time_range=time_range,
         )
         return sorted(tmp_path.glob(f"{prefix}*{in_file.suffix}"), key=lambda f: f.name)
 
     def cut_section(
-        self, in_file: Path, tmp_path: Path, start_time: Decimal, end_time: Decimal
+        self,
+        in_file: Path,
+        tmp_path: Path,
+        start_time: Decimal,
+        end_time: Decimal,
+        name_tag: str = "",
     ) -> list[Path]:
         out_file = tmp_path.joinpath(
-            f"{in_file.stem}-{start_time}s-{end_time}s{in_file.suffix}"
+            f"{in_file.stem}-{start_time}s-{end_time}s{name_tag}{in_file.suffix}"
         )
         self.run(
             "-y",
@@ -86,9 +627,15 @@ class FFmpeg:
             "-avoid_negative_ts",
             "make_zero",
             out_file.as_posix(),
+            stage="cut",
+            time_range=(start_time, end_time),
         )
         return out_file
 
+    def write_concat_file(self, paths: list[Path], concat_file: Path) -> Path:
+        concat_file.write_text("\r\n".join([f"file '{f.as_posix()}'" for f in paths]))
+        return concat_file
+
     def combine_and_speedup(
         self,
         processed_paths: list[Path],
@@ -96,10 +643,7 @@ class FFmpeg:
         output_path: Path,
         tmp_path: Path,
     ) -> Path:
-        concat_file = tmp_path / "concat.txt"
-        concat_file.write_text(
-            "\r\n".join([f"file '{f.as_posix()}'" for f in processed_paths])
-        )
+        concat_file = self.write_concat_file(processed_paths, tmp_path / "concat.txt")
 
         self.run(
             "-y",
@@ -113,23 +657,222 @@ class FFmpeg:
             f"setpts={1/speed_multiplier}*PTS",
             "-an",
             output_path.as_posix(),
+            stage="combine",
+        )
+        return output_path
+
+    def concat(
+        self, processed_paths: list[Path], output_path: Path, concat_file: Path
+    ) -> Path:
+        self.write_concat_file(processed_paths, concat_file)
+
+        self.run(
+            "-y",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            concat_file.as_posix(),
+            "-c",
+            "copy",
+            "-an",
+            output_path.as_posix(),
+            stage="merge",
         )
         return output_path
 
-    def dedupe(self, in_file: Path, output_path: Path) -> Path:
+    def dedupe(
+        self,
+        in_file: Path,
+        output_path: Path,
+        time_range: TimeRange | None = None,
+        codec: str = "default",
+        speed_multiplier: int = 1,
+        regions: AnalysisRegions = AnalysisRegions(),
+        frame_size: tuple[int, int] | None = None,
+    ) -> Path:
+        """Drop duplicate frames in one go, looking only at regions.
+
+        mpdecimate decides on the analysis image, and the full frames are laid
+        over the ones it keeps, so those are scaled back up to frame_size
+        first. Without frame_size, mpdecimate looks at the full frame with
+        everything outside regions painted over.
+        """
+        if frame_size:
+            width, height = frame_size
+            analysis = (
+                f"{regions.filter(ANALYSIS_WIDTH, ANALYSIS_HEIGHT)},"
+                # Back in the shape and format full frames come out of
+                # overlay in, recordings have square pixels.
+                f"mpdecimate,scale={width}:{height},setsar=1,format=yuv420p"
+            )
+        else:
+            analysis = f"{regions.paint_filter()},mpdecimate"
         self.run(
             "-y",
+            *seek_args(time_range),
             "-i",
             in_file.as_posix(),
-            "-vf",
+            "-filter_complex",
             ";".join(
                 [
-                    "split=2[full][masked]",
-                    "[masked]drawbox=w=iw*0.2:h=ih:x=0:y=0:t=fill:c=white,drawbox=w=iw:h=ih*0.2:x=0:y=ih*0.8:t=fill:c=white,mpdecimate[deduped]",
-                    "[deduped][full]overlay=shortest=1,setpts=N/FRAME_RATE/TB",
+                    "split=3[full][masked][read]",
+                    f"[masked]{analysis}[deduped]",
+                    "[deduped][full]overlay=shortest=1,"
+                    f"setpts=N/(FRAME_RATE*{speed_multiplier})/TB[out]",
                 ],
             ),
-            "-an",
+            *FRAMES_READ_OUTPUT,
+            "-map",
+            "[out]",
+            *INTERMEDIATE_CODECS[codec],
             output_path.as_posix(),
+            stage="dedupe",
+            time_range=time_range,
         )
         return output_path
+
+    @contextmanager
+    def raw_frames(
+        self,
+        in_file: Path,
+        width: int,
+        height: int,
+        time_range: TimeRange | None = None,
+        regions: AnalysisRegions | None = None,
+        pts_file: Path | None = None,
+    ) -> Iterator[BinaryIO]:
+        """Stream of downscaled 8 bit grayscale frames, width * height bytes each.
+
+        With regions, frames are their analysis image instead, which is
+        regions.size(width, height). With pts_file, the timestamps of the
+        frames are written to it as framecrc, from the start of time_range in
+        the source's own time base (see framecrc_pts). It is complete once
+        the stream is done with.
+        """
+        vf = (
+            regions.filter(width, height)
+            if regions
+            else f"scale={width}:{height},format=gray"
+        )
+        frames = ["-f", "rawvideo", "-pix_fmt", "gray", "-"]
+        outputs = ["-vf", vf, *frames]
+        if pts_file:
+            # One frame for every timestamp, neither rounded to the frame rate
+            exact = ["-fps_mode", "passthrough", "-enc_time_base:v", "demux"]
+            outputs = [
+                "-filter_complex",
+                f"[0:v]{vf},split[frames][pts]",
+                "-map",
+                "[frames]",
+                *exact,
+                *frames,
+                "-map",
+                "[pts]",
+                *exact,
+                "-f",
+                "framecrc",
+                pts_file.as_posix(),
+            ]
+        cmd = [
+            "ffmpeg",
+            "-y",
+            *seek_args(time_range),
+            "-i",
+            in_file.as_posix(),
+            "-an",
+            *outputs,
+        ]
+        with self.process(
+            cmd,
+            "analyse",
+            time_range=time_range,
+            stdout=subprocess.PIPE,
+            log_level="error",
+        ) as process:
+            yield process.stdout
+
+    def select_frames(
+        self,
+        in_file: Path,
+        frames: list[int],
+        output_path: Path,
+        time_range: TimeRange | None = None,
+        codec: str = "default",
+        speed_multiplier: int = 1,
+    ) -> Path:
+        """Encode only the given frame numbers (counted from the start of time_range)."""
+        # The expression gets long for long chunks, so it goes in a file rather
+        # than on the command line.
+        filter_script = output_path.with_suffix(".filter")
+        filter_script.write_text(
+            f"split=2[kept][read];[kept]select='{select_expression(frames)}',"
+            f"setpts=N/(FRAME_RATE*{speed_multiplier})/TB[out]"
+        )
+        try:
+            self.run(
+                "-y",
+                *seek_args(time_range),
+                "-i",
+                in_file.as_posix(),
+                "-filter_complex_script",
+                filter_script.as_posix(),
+                *FRAMES_READ_OUTPUT,
+                "-map",
+                "[out]",
+                *INTERMEDIATE_CODECS[codec],
+                output_path.as_posix(),
+                stage="select",
+                time_range=time_range,
+            )
+        finally:
+            filter_script.unlink(missing_ok=True)
+        return output_path
+
+    def analyse_duplicates(
+        self,
+        in_file: Path,
+        time_range: TimeRange | None = None,
+        hi: float = 12,
+        lo: float = 5,
+        frac: float = 0.33,
+        regions: AnalysisRegions = AnalysisRegions(),
+    ) -> list[int]:
+        """Numbers of the frames mpdecimate keeps, looking at the analysis image of regions.
+
+        Nothing at full resolution is buffered, so memory use doesn't grow with
+        the length of the input. hi and lo are per pixel, mpdecimate wants them
+        per 8x8 block.
+        """
+        cmd = [
+            "ffmpeg",
+            *seek_args(time_range),
+            "-i",
+            in_file.as_posix(),
+            "-an",
+            "-vf",
+            # Numbering frames by their timestamps survives mpdecimate
+            f"setpts=N,{regions.filter(ANALYSIS_WIDTH, ANALYSIS_HEIGHT)},"
+            f"mpdecimate=hi={64 * hi}:lo={64 * lo}:frac={frac}",
+            "-fps_mode",
+            "passthrough",
+            "-f",
+            "framecrc",
+            "-",
+        ]
+        with self.process(
+            cmd,
+            "analyse",
+            time_range=time_range,
+            stdout=subprocess.PIPE,
+            log_level="error",
+        ) as process:
+            output = process.stdout.read()
+
+        # Lines are "stream, dts, pts, duration, size, hash", after a # header
+        return [
+            int(line.split(",")[2])
+            for line in output.decode().splitlines()
+            if line and not line.startswith("#")
+        ]
@@ -0,0 +1,382 @@
+from dataclasses import dataclass
+from decimal import Decimal
+from fractions import Fraction
+from functools import cached_property
+import os
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import BinaryIO, Iterator
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for the "numpy" dedupe engine
+    np = None
+
+from vedit.db import IntervalSet, TimeRange, snap_to_keyframe
+from vedit.ffmpeg import FFmpeg, framecrc_pts
+from vedit.regions import ANALYSIS_HEIGHT, ANALYSIS_WIDTH, AnalysisRegions, Region
+
+BLOCK_SIZE = 4
+BATCH_FRAMES = 64
+
+# Size of the signatures kept in the index. An hour at 60fps takes about 500MB,
+# which still shows a mouse moving across the screen.
+INDEX_WIDTH = 64
+INDEX_HEIGHT = 36
+# Timestamps are ffmpeg's, so they only differ by rounding between ranges
+# that were analysed separately.
+PTS_EPSILON = 1e-6
+
+# Keyframes within this fraction of the size of the one before them are
+# taken to be the same picture again, so they don't end a static run.
+STATIC_KEYFRAME_TOLERANCE = 0.05
+# What has to be left between two static spans to be worth processing on its
+# own, anything shorter is processed along with the span before it.
+MIN_STATIC_GAP_SECS = 5
+
+
+def require_numpy() -> None:
+    if np is None:
+        raise RuntimeError(
+            "The numpy dedupe engine needs numpy, install it with `pip install numpy`"
+        )
+
+
+def region_mask(
+    width: int,
+    height: int,
+    excluded: tuple[Region, ...] = (),
+    included: tuple[Region, ...] = ((0, 0, 1, 1),),
+) -> "np.ndarray":
+    """Which pixels of a width x height copy of the whole frame count."""
+    mask = np.zeros((height, width), dtype=bool)
+    for regions, counts in [(included, True), (excluded, False)]:
+        for x, y, w, h in regions:
+            left, top = round(x * width), round(y * height)
+            mask[top : top + round(h * height), left : left + round(w * width)] = counts
+    return mask
+
+
+def analysis_mask(
+    regions: AnalysisRegions,
+    width: int = ANALYSIS_WIDTH,
+    height: int = ANALYSIS_HEIGHT,
+) -> "np.ndarray":
+    """Which pixels of the analysis image of regions count, leaving out padding."""
+    image_width, image_height = regions.size(width, height)
+    mask = np.zeros((image_height, image_width), dtype=bool)
+    for boxes, counts in [
+        (regions.tiles(width, height), True),
+        (regions.excluded_boxes(width, height), False),
+    ]:
+        for left, top, w, h in boxes:
+            mask[top : top + h, left : left + w] = counts
+    return mask
+
+
+def static_runs(
+    packets: list[tuple[Decimal, int, bool]], max_bytes: int, end_time: Decimal
+) -> list[TimeRange]:
+    """Runs of packets too small to have changed the picture, from FFmpeg.packets.
+
+    Inter frames of at most max_bytes only repeat what came before them. A
+    keyframe ends a run unless it is the same size as the last keyframe
+    since anything changed, as then it is most likely the same picture.
+    """
+    runs = []
+    start = None
+    key_size = None
+    for time, size, keyframe in packets:
+        if keyframe:
+            if (
+                start is not None
+                and key_size is not None
+                and abs(size - key_size) <= key_size * STATIC_KEYFRAME_TOLERANCE
+            ):
+                continue
+            key_size = size
+        elif size <= max_bytes:
+            if start is None:
+                start = time
+            continue
+        else:
+            key_size = None
+        if start is not None:
+            runs.append((start, time))
+            start = None
+    if start is not None:
+        runs.append((start, end_time))
+    return runs
+
+
+def static_spans(
+    runs: list[TimeRange], keyframes: list[Decimal], min_secs: Decimal
+) -> list[TimeRange]:
+    """The static runs worth leaving out of the jobs.
+
+    Each ends on the last keyframe in it, so the job after it can be cut
+    exactly, and has to be at least min_secs long after that.
+    """
+    spans = []
+    for start, end in runs:
+        end = snap_to_keyframe(keyframes, (start, end), end)
+        if end - start < min_secs:
+            continue
+        if spans and start - spans[-1][1] < MIN_STATIC_GAP_SECS:
+            # Better processed along with the span before than on its own
+            spans.pop()
+        spans.append((start, end))
+    return spans
+
+
+def read_frames(
+    stream: BinaryIO, width: int, height: int, batch_frames: int = BATCH_FRAMES
+) -> Iterator["np.ndarray"]:
+    """Read raw gray frames in batches, straight into one reused buffer.
+
+    Each batch is only valid until the next one is read.
+    """
+    frame_size = width * height
+    buffer = np.empty((batch_frames, height, width), dtype=np.uint8)
+    view = memoryview(buffer).cast("B")
+
+    while True:
+        filled = 0
+        while filled < len(view):
+            read = stream.readinto(view[filled:])
+            if not read:
+                break
+            filled += read
+
+        if frames := filled // frame_size:
+            yield buffer[:frames]
+        if filled < len(view):
+            return
+
+
+@dataclass(frozen=True, eq=False)
+class DuplicateDetector:
+    """Decides which frames to keep the same way mpdecimate does.
+
+    Frames are compared to the last kept frame in blocks of block_size pixels.
+    A frame is a duplicate unless some block differs by more than hi, or at
+    least frac of the blocks differ by more than lo. Unlike mpdecimate, hi and
+    lo are the mean absolute difference per pixel, so they don't depend on
+    the block size (mpdecimate's defaults of 64*12 and 64*5 are 12 and 5).
+    """
+
+    mask: "np.ndarray"
+    hi: float = 12
+    lo: float = 5
+    frac: float = 0.33
+    block_size: int = BLOCK_SIZE
+
+    def block_differences(
+        self, frames: "np.ndarray", reference: "np.ndarray"
+    ) -> "np.ndarray":
+        height, width = self.mask.shape
+        b = self.block_size
+        diff = np.abs(frames.astype(np.int16) - reference.astype(np.int16))
+        diff *= self.mask
+        blocks = diff.reshape(len(frames), height // b, b, width // b, b)
+        return blocks.sum(axis=(2, 4)) / (b * b)
+
+    def differs(self, frames: "np.ndarray", reference: "np.ndarray") -> "np.ndarray":
+        blocks = self.block_differences(frames, reference)
+        blocks = blocks.reshape(len(frames), -1)[:, self.counted_blocks]
+        over_hi = (blocks > self.hi).any(axis=1)
+        over_lo = (blocks > self.lo).mean(axis=1) >= self.frac
+        return over_hi | over_lo
+
+    @cached_property
+    def counted_blocks(self) -> "np.ndarray":
+        # Blocks that are entirely masked out don't count towards frac
+        height, width = self.mask.shape
+        b = self.block_size
+        blocks = self.mask.reshape(height // b, b, width // b, b).any(axis=(1, 3))
+        return blocks.reshape(-1)
+
+    def frames_to_keep(self, batches: Iterator["np.ndarray"]) -> list[int]:
+        keep: list[int] = []
+        reference: "np.ndarray | None" = None
+        offset = 0
+        for frames in batches:
+            # Whether each frame differs from the one before it. That is the
+            # answer for every frame straight after a kept one, which covers
+            # anything with motion in a single vectorised pass.
+            previous = np.concatenate(
+                [frames[:1] if reference is None else reference[None], frames[:-1]]
+            )
+            changed = self.differs(frames, previous)
+            if reference is None:
+                changed[0] = True
+
+            i = 0
+            while i < len(frames):
+                # Nothing is moving, look for the next frame that differs from
+                # the last kept one in growing windows. Still spans take a few
+                # vectorised passes and a lone duplicate costs one comparison.
+                if reference is not None:
+                    window = 1
+                    while i < len(frames):
+                        (hits,) = np.nonzero(
+                            self.differs(frames[i : i + window], reference)
+                        )
+                        if len(hits):
+                            i += int(hits[0])
+                            break
+                        i += window
+                        window *= 2
+                    else:
+                        break
+
+                keep.append(offset + i)
+                i += 1
+                while i < len(frames) and changed[i]:
+                    keep.append(offset + i)
+                    i += 1
+                reference = frames[i - 1].copy()
+
+            offset += len(frames)
+
+        return keep
+
+
+def find_frames_to_keep(
+    ffmpeg: FFmpeg,
+    in_file: Path,
+    detector: DuplicateDetector,
+    time_range: TimeRange | None = None,
+    regions: AnalysisRegions | None = None,
+) -> list[int]:
+    """Frames to keep, from the whole frame or from the analysis image of regions.
+
+    With regions, detector's mask is their analysis_mask.
+    """
+    require_numpy()
+    height, width = detector.mask.shape
+    scale = (ANALYSIS_WIDTH, ANALYSIS_HEIGHT) if regions else (width, height)
+    with ffmpeg.raw_frames(
+        in_file, *scale, time_range=time_range, regions=regions
+    ) as stream:
+        return detector.frames_to_keep(read_frames(stream, width, height))
+
+
+def signature_dtype() -> "np.dtype":
+    return np.dtype([("pts", "<f8"), ("luma", "u1", (INDEX_HEIGHT, INDEX_WIDTH))])
+
+
+class SignatureIndex:
+    """Per-frame signatures of source files, so they only have to be decoded once.
+
+    Every analysed range of a source file is written to its own file of fixed
+    width records, a timestamp and a tiny grayscale copy of the frame, which
+    is read back with np.memmap. Deciding again with other thresholds or
+    masks then only needs the index.
+    """
+
+    def __init__(self, index_dir: Path):
+        self.index_dir = index_dir
+
+    def segment_path(self, source_file: Path, time_range: TimeRange) -> Path:
+        start_time, end_time = time_range
+        return self.index_dir / source_file.name / f"{start_time}_{end_time}.sig"
+
+    def segments(self, source_file: Path) -> list[tuple[TimeRange, Path]]:
+        segments = []
+        for path in (self.index_dir / source_file.name).glob("*.sig"):
+            start_time, end_time = path.stem.split("_")
+            segments.append(((Decimal(start_time), Decimal(end_time)), path))
+        return sorted(segments)
+
+    def read(
+        self,
+        source_file: Path,
+        time_range: TimeRange,
+        batch_frames: int = BATCH_FRAMES,
+    ) -> list["np.ndarray"] | None:
+        """Signatures of the frames in time_range, or None if some aren't indexed."""
+        start_time, end_time = time_range
+        segments = [
+            (segment_range, path)
+            for segment_range, path in self.segments(source_file)
+            if segment_range[0] < end_time and segment_range[1] > start_time
+        ]
+        if next(IntervalSet(r for r, _ in segments).gaps(time_range), None):
+            return None
+
+        batches = []
+        # Segments can overlap when a range was analysed again after a failure
+        next_pts = float(start_time) - PTS_EPSILON
+        for _, path in segments:
+            if not path.stat().st_size:
+                continue
+            records = np.memmap(path, dtype=signature_dtype(), mode="r")
+            lo = np.searchsorted(records["pts"], next_pts)
+            hi = np.searchsorted(records["pts"], float(end_time) - PTS_EPSILON)
+            batches.extend(
+                records["luma"][i : min(i + batch_frames, hi)]
+                for i in range(lo, hi, batch_frames)
+            )
+            if lo < hi:
+                next_pts = records["pts"][hi - 1] + PTS_EPSILON
+
+        return batches
+
+    def build(self, ffmpeg: FFmpeg, source_file: Path, time_range: TimeRange) -> Path:
+        path = self.segment_path(source_file, time_range)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        pts_file = path.with_suffix(".pts")
+        dtype = signature_dtype()
+
+        with NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False) as f:
+            try:
+                with ffmpeg.raw_frames(
+                    source_file,
+                    INDEX_WIDTH,
+                    INDEX_HEIGHT,
+                    time_range=time_range,
+                    pts_file=pts_file,
+                ) as stream:
+                    for frames in read_frames(stream, INDEX_WIDTH, INDEX_HEIGHT):
+                        records = np.zeros(len(frames), dtype=dtype)
+                        records["luma"] = frames
+                        records.tofile(f)
+                f.close()
+                # Where -ss lands and how far apart frames are is up to the
+                # source, so the timestamps are ffmpeg's rather than worked
+                # out from the frame rate
+                start_time = Fraction(time_range[0])
+                pts = [
+                    float(start_time + t) for t in framecrc_pts(pts_file.read_text())
+                ]
+                if pts:
+                    records = np.memmap(f.name, dtype=dtype, mode="r+")
+                    records["pts"] = pts
+                    records.flush()
+                    del records
+            except BaseException:
+                f.close()
+                os.unlink(f.name)
+                raise
+            finally:
+                pts_file.unlink(missing_ok=True)
+
+        # Readers never see a half written segment
+        os.replace(f.name, path)
+        return path
+
+
+def find_frames_to_keep_indexed(
+    ffmpeg: FFmpeg,
+    index: SignatureIndex,
+    source_file: Path,
+    detector: DuplicateDetector,
+    time_range: TimeRange,
+) -> list[int]:
+    require_numpy()
+    batches = index.read(source_file, time_range)
+    if batches is None:
+        index.build(ffmpeg, source_file, time_range)
+        batches = index.read(source_file, time_range)
+    return detector.frames_to_keep(iter(batches))
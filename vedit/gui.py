@@ -1,8 +1,10 @@
+from datetime import timedelta
 from multiprocessing import Queue, Process
 from queue import Empty
 import tkinter as tk
 from pathlib import Path
 from tkinter import filedialog, ttk
+from vedit.progress import ProgressTracker
 from vedit.video_editor import process_dir
 
 
@@ -10,6 +12,9 @@ import os
 import signal
 import psutil
 
+# How often messages from the processing process are picked up
+POLL_MS = 200
+
 
 def kill_children(sig=signal.SIGTERM, timeout=None, on_terminate=None):
     """Kill a process tree (including grandchildren) with signal
@@ -63,13 +68,23 @@ class VEditGUI:
         )
         self.progress_bar.pack(pady=10)
 
+        self.rate_label = tk.Label(root, text="")
+        self.rate_label.pack()
+
         self.status_label = tk.Label(root, text="")
         self.status_label.pack(pady=10)
 
         self.video_editing_process: Process | None = None
-
-    def step(self, step: float) -> None:
-        self.progress_bar.step(step)
+        self.progress = ProgressTracker()
+
+    def show_progress(self) -> None:
+        self.progress_bar["value"] = self.progress.percent
+        text = f"{self.progress.percent:.1f}%"
+        if fps := self.progress.fps:
+            text += f" - {fps:.0f} fps"
+        if (eta_secs := self.progress.eta_secs()) is not None:
+            text += f" - {timedelta(seconds=round(eta_secs))} left"
+        self.rate_label.config(text=text)
         self.root.update()
 
     def select_file(self):
@@ -86,10 +101,12 @@ class VEditGUI:
             text="Processing stopped. Please select a new file."
         )
         self.status_label.config(text="")
+        self.rate_label.config(text="")
         self.root.update()
         self.process_button.config(state=tk.NORMAL)
         self.stop_button.config(state=tk.DISABLED)
         self.progress_bar.stop()
+        self.progress_bar["value"] = 0
 
     def process_folder(self) -> None:
         if not self.selected_file_path:
@@ -100,6 +117,7 @@ class VEditGUI:
 
         # Make sure the queue is clear by overwriting it.
         self.message_queue = Queue()
+        self.progress = ProgressTracker()
 
         self.video_editing_process = Process(
             target=process_dir,
@@ -112,7 +130,7 @@ class VEditGUI:
 
         self.process_button.config(state=tk.DISABLED)
         self.stop_button.config(state=tk.NORMAL)
-        self.root.after(1000, self.check_progress)
+        self.root.after(POLL_MS, self.check_progress)
 
     def check_progress(self) -> None:
         if (
@@ -129,47 +147,52 @@ class VEditGUI:
             return
 
         if self.message_queue.empty() and self.video_editing_process.is_alive():
-            self.root.after(1000, self.check_progress)
+            self.root.after(POLL_MS, self.check_progress)
             return
 
-        try:
-            message = self.message_queue.get(block=False, timeout=2)
-        except Empty:
-            message = None
-
-        match message:
-            case ("step", step, message):
-                self.step(step)
-                self.status_label.config(text=message)
-            case ("done", output_path):
-                self.video_editing_process.join()
-                self.video_editing_process = None
-                self.selected_file_path = None
-                self.file_path_label.config(
-                    text=f"File processed and saved as: {output_path}"
-                )
-                self.status_label.config(text="Done!")
-                self.stop_button.config(state=tk.DISABLED)
-                self.root.update()
-                return
-            case ("skipped", output_path):
-                self.video_editing_process.join()
-                self.video_editing_process = None
-                self.selected_file_path = None
-                self.file_path_label.config(
-                    text=f"{output_path} Already exists, nothing to do. If the file is bad, please delete it and try again."
-                )
-                self.status_label.config(text="Nothing to do!")
-                self.stop_button.config(state=tk.DISABLED)
-                self.root.update()
-                return
-            case None:
-                pass
-            case _:
-                raise RuntimeError("Unknown response from processing process")
-
-        self.root.update()
-        self.root.after(1000, self.check_progress)
+        messages = []
+        while True:
+            try:
+                messages.append(self.message_queue.get(block=False))
+            except Empty:
+                break
+
+        # Progress comes in faster than it can be shown, only the latest for
+        # each job matters.
+        for message in ProgressTracker.collapse(messages):
+            match message:
+                case ("step", _, text):
+                    self.progress.handle(message)
+                    self.status_label.config(text=text)
+                case ("progress", *_):
+                    self.progress.handle(message)
+                case ("done", output_path):
+                    self.video_editing_process.join()
+                    self.video_editing_process = None
+                    self.selected_file_path = None
+                    self.file_path_label.config(
+                        text=f"File processed and saved as: {output_path}"
+                    )
+                    self.status_label.config(text="Done!")
+                    self.stop_button.config(state=tk.DISABLED)
+                    self.root.update()
+                    return
+                case ("skipped", output_path):
+                    self.video_editing_process.join()
+                    self.video_editing_process = None
+                    self.selected_file_path = None
+                    self.file_path_label.config(
+                        text=f"{output_path} Already exists, nothing to do. If the file is bad, please delete it and try again."
+                    )
+                    self.status_label.config(text="Nothing to do!")
+                    self.stop_button.config(state=tk.DISABLED)
+                    self.root.update()
+                    return
+                case _:
+                    raise RuntimeError("Unknown response from processing process")
+
+        self.show_progress()
+        self.root.after(POLL_MS, self.check_progress)
 
     def run(self):
         try:
@@ -0,0 +1,112 @@
+import os
+from pathlib import Path
+import socket
+from threading import Event, RLock, Thread
+import time
+
+import psutil
+
+
+class FileLock:
+    """Mutual exclusion between processes, including ones on other machines.
+
+    Creating a file with O_EXCL is atomic on local disks as well as on NFS and
+    SMB shares, which is more than can be said for the byte range locks sqlite
+    relies on. owner is written into the file as "host:pid".
+
+    The holder touches the file every stale_secs / 3, so a lock that hasn't
+    been touched for stale_secs is assumed to belong to a process that died
+    while holding it and is broken. Locks held by a process on this machine
+    are broken as soon as it is gone, and never while it is still running.
+
+    Re-entering the lock from the thread holding it is allowed, other threads
+    of the same process wait for it like other processes do.
+    """
+
+    def __init__(
+        self, path: Path, owner: str, stale_secs: float = 60, poll_secs: float = 0.05
+    ):
+        self.path = path
+        self.owner = owner
+        self.stale_secs = stale_secs
+        self.poll_secs = poll_secs
+        self.depth = 0
+        self.thread_lock = RLock()
+        self.released = Event()
+        self.heartbeat: Thread | None = None
+
+    def try_acquire(self) -> bool:
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            self.break_if_stale()
+            return False
+
+        with os.fdopen(fd, "w") as f:
+            f.write(self.owner)
+        return True
+
+    def is_stale(self, path: Path) -> bool:
+        age = time.time() - path.stat().st_mtime
+        try:
+            host, pid = path.read_text().rsplit(":", 1)
+            if host == socket.gethostname():
+                return not psutil.pid_exists(int(pid))
+        except ValueError:
+            # Not written by a FileLock, or caught halfway through being written
+            pass
+        return age >= self.stale_secs
+
+    def break_if_stale(self) -> None:
+        # Only one process at a time gets to look at the lock and break it,
+        # otherwise one that found it stale could remove the lock another one
+        # had just taken after breaking it first.
+        breaking = self.path.with_name(f"{self.path.name}.break")
+        try:
+            fd = os.open(breaking, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                # Whoever was breaking it died doing so
+                if time.time() - breaking.stat().st_mtime >= self.stale_secs:
+                    breaking.unlink(missing_ok=True)
+            except FileNotFoundError:
+                pass
+            return
+        os.close(fd)
+
+        try:
+            if self.is_stale(self.path):
+                self.path.unlink(missing_ok=True)
+        except FileNotFoundError:
+            pass
+        finally:
+            breaking.unlink(missing_ok=True)
+
+    def touch(self) -> None:
+        while not self.released.wait(self.stale_secs / 3):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+    def release(self) -> None:
+        self.released.set()
+        if self.heartbeat:
+            self.heartbeat.join()
+        self.path.unlink(missing_ok=True)
+
+    def __enter__(self) -> None:
+        self.thread_lock.acquire()
+        if self.depth == 0:
+            while not self.try_acquire():
+                time.sleep(self.poll_secs)
+            self.released.clear()
+            self.heartbeat = Thread(target=self.touch, daemon=True)
+            self.heartbeat.start()
+        self.depth += 1
+
+    def __exit__(self, *exc_info) -> None:
+        self.depth -= 1
+        if self.depth == 0:
+            self.release()
+        self.thread_lock.release()
@@ -0,0 +1,81 @@
+from dataclasses import dataclass, field
+import time
+
+
+@dataclass(frozen=True)
+class Progress:
+    """One update from ffmpeg's -progress output.
+
+    out_secs is how much has been written, which for dedupe is less than what
+    has been read. frame counts the frames read, dedupe and select_frames
+    have an output just for that.
+    """
+
+    out_secs: float
+    frame: int
+    fps: float
+    speed: float | None
+
+
+@dataclass
+class ProgressTracker:
+    """Overall progress from the messages process_dir puts on its queue.
+
+    "step" messages move the bar on for good. "progress" messages say how far
+    a running job has got, each replacing the last one for that job, and a
+    percent of None means the job is over.
+    """
+
+    completed: float = 0
+    running: dict[object, tuple[float, float]] = field(default_factory=dict)
+    started: float | None = None
+    started_at_percent: float = 0
+
+    @staticmethod
+    def collapse(messages: list[tuple]) -> list[tuple]:
+        """Drop progress messages that a later one for the same job replaces."""
+        latest = {
+            message[1]: i
+            for i, message in enumerate(messages)
+            if message[0] == "progress"
+        }
+        return [
+            message
+            for i, message in enumerate(messages)
+            if message[0] != "progress" or latest[message[1]] == i
+        ]
+
+    def handle(self, message: tuple, now: float | None = None) -> None:
+        now = time.monotonic() if now is None else now
+        match message:
+            case ("step", step, _):
+                self.completed += step
+            case ("progress", job, None, _):
+                self.running.pop(job, None)
+            case ("progress", job, percent, fps):
+                self.running[job] = (percent, fps)
+            case _:
+                return
+
+        if self.started is None:
+            self.started = now
+            self.started_at_percent = self.percent
+
+    @property
+    def percent(self) -> float:
+        return min(
+            self.completed + sum(percent for percent, _ in self.running.values()), 100
+        )
+
+    @property
+    def fps(self) -> float:
+        return sum(fps for _, fps in self.running.values())
+
+    def eta_secs(self, now: float | None = None) -> float | None:
+        now = time.monotonic() if now is None else now
+        if self.started is None or now <= self.started:
+            return None
+        rate = (self.percent - self.started_at_percent) / (now - self.started)
+        if rate <= 0:
+            return None
+        return (100 - self.percent) / rate
@@ -0,0 +1,139 @@
+from dataclasses import dataclass
+from typing import Sequence
+
+# What parts of the frame are looked at, kept out of vedit.ffmpeg so that
+# config can check them without importing it.
+
+# Size of the grayscale copy of the video that duplicate frames are looked for
+# in, before it is cropped down to the analysis regions. Plenty to tell
+# whether anything happened on screen, while being cheap to scale, compare and
+# pipe around.
+ANALYSIS_WIDTH = 320
+ANALYSIS_HEIGHT = 180
+
+# Regions of the frame, as fractions of it: (x, y, width, height)
+Region = tuple[float, float, float, float]
+# Looked at unless configured otherwise: all but the left and bottom 20%
+DEFAULT_INCLUDED_REGIONS: tuple[Region, ...] = ((0.2, 0, 0.8, 0.8),)
+# Analysis tiles are whole 8x8 blocks, the size mpdecimate compares
+TILE_ALIGN = 8
+
+
+def align(pixels: float) -> int:
+    return max(TILE_ALIGN, round(pixels / TILE_ALIGN) * TILE_ALIGN)
+
+
+@dataclass(frozen=True)
+class AnalysisRegions:
+    """The parts of the frame that changes are looked for in.
+
+    Each included region is cropped out and scaled down on its own, to the
+    size it would have in a width x height copy of the whole frame, and the
+    tiles are put side by side into one grayscale analysis image. Excluded
+    regions are painted over wherever they overlap an included one. Comparing
+    frames then costs as much as the area looked at, not the whole frame.
+    """
+
+    include: tuple[Region, ...] = DEFAULT_INCLUDED_REGIONS
+    exclude: tuple[Region, ...] = ()
+
+    def __post_init__(self) -> None:
+        if not self.include:
+            raise ValueError("At least one region has to be included in the analysis")
+        for region in (*self.include, *self.exclude):
+            if len(region) != 4:
+                raise ValueError(f"Regions are [x, y, width, height], got {region}")
+            x, y, w, h = region
+            # Fractions that add up to 1 can come out a hair over it
+            if min(x, y) < 0 or min(w, h) <= 0 or max(x + w, y + h) > 1 + 1e-9:
+                raise ValueError(f"Region {list(region)} isn't inside the frame")
+
+    @staticmethod
+    def parse(
+        include: Sequence[Sequence[float]], exclude: Sequence[Sequence[float]] = ()
+    ) -> "AnalysisRegions":
+        """Regions from config values, which are lists."""
+        return AnalysisRegions(tuple(map(tuple, include)), tuple(map(tuple, exclude)))
+
+    def tiles(self, width: int, height: int) -> list[tuple[int, int, int, int]]:
+        """Where each included region is in the analysis image, (left, top, width, height)."""
+        tiles = []
+        left = 0
+        for _, _, w, h in self.include:
+            tiles.append((left, 0, align(w * width), align(h * height)))
+            left += tiles[-1][2]
+        return tiles
+
+    def size(self, width: int, height: int) -> tuple[int, int]:
+        tiles = self.tiles(width, height)
+        return sum(w for _, _, w, _ in tiles), max(h for _, _, _, h in tiles)
+
+    def excluded_boxes(
+        self, width: int, height: int
+    ) -> list[tuple[int, int, int, int]]:
+        """Pixels of the analysis image that are painted over, (left, top, width, height)."""
+        boxes = []
+        for (x, y, w, h), (left, top, tile_w, tile_h) in zip(
+            self.include, self.tiles(width, height)
+        ):
+            for ex, ey, ew, eh in self.exclude:
+                x0, x1 = max(ex, x), min(ex + ew, x + w)
+                y0, y1 = max(ey, y), min(ey + eh, y + h)
+                if x0 >= x1 or y0 >= y1:
+                    continue
+                box_left = left + round((x0 - x) / w * tile_w)
+                box_top = top + round((y0 - y) / h * tile_h)
+                box_right = left + round((x1 - x) / w * tile_w)
+                box_bottom = top + round((y1 - y) / h * tile_h)
+                boxes.append(
+                    (box_left, box_top, box_right - box_left, box_bottom - box_top)
+                )
+        return boxes
+
+    def filter(self, width: int, height: int) -> str:
+        """Filters turning a frame into the analysis image, for -vf."""
+        tiles = self.tiles(width, height)
+        crops = [
+            f"crop=iw*{w}:ih*{h}:iw*{x}:ih*{y},scale={tile_w}:{tile_h}"
+            for (x, y, w, h), (_, _, tile_w, tile_h) in zip(self.include, tiles)
+        ]
+        if len(crops) == 1:
+            (graph,) = crops
+        else:
+            _, image_height = self.size(width, height)
+            n = len(crops)
+            graph = ";".join(
+                [
+                    f"split={n}" + "".join(f"[region{i}]" for i in range(n)),
+                    *(
+                        f"[region{i}]{crop},pad={tile_w}:{image_height}:0:0:white[tile{i}]"
+                        for i, (crop, (_, _, tile_w, _)) in enumerate(zip(crops, tiles))
+                    ),
+                    "".join(f"[tile{i}]" for i in range(n)) + f"hstack=inputs={n}",
+                ]
+            )
+        boxes = [
+            f"drawbox=x={left}:y={top}:w={w}:h={h}:t=fill:c=white"
+            for left, top, w, h in self.excluded_boxes(width, height)
+        ]
+        return ",".join([graph, *boxes, "format=gray"])
+
+    def paint_filter(self) -> str:
+        """Paints over everything not looked at, keeping the frame's size."""
+        xs = sorted({0, 1, *(x for x, _, w, _ in self.include for x in (x, x + w))})
+        ys = sorted({0, 1, *(y for _, y, _, h in self.include for y in (y, y + h))})
+        # The frame cut up along every edge of an included region, so that
+        # each cell is either entirely in one or not in any.
+        painted = [
+            (x0, y0, round(x1 - x0, 6), round(y1 - y0, 6))
+            for x0, x1 in zip(xs, xs[1:])
+            for y0, y1 in zip(ys, ys[1:])
+            if not any(
+                x <= x0 and x1 <= x + w and y <= y0 and y1 <= y + h
+                for x, y, w, h in self.include
+            )
+        ]
+        return ",".join(
+            f"drawbox=x=iw*{x}:y=ih*{y}:w=iw*{w}:h=ih*{h}:t=fill:c=white"
+            for x, y, w, h in [*painted, *self.exclude]
+        )
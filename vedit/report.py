@@ -0,0 +1,74 @@
+from pathlib import Path
+import sqlite3
+
+from vedit.video_editor import RUNS_FILE
+
+# Stages that decode a chunk and encode only the frames worth keeping
+DEDUPE_STAGES = ("dedupe", "select")
+SLOWEST_RUNS = 5
+
+
+def open_runs(selected_dir: Path) -> sqlite3.Connection:
+    """The ffmpeg_runs of a folder that is being processed, or was processed."""
+    for db_path in [selected_dir / ".vedit" / "db.sqlite", selected_dir / RUNS_FILE]:
+        if db_path.exists():
+            return sqlite3.connect(db_path)
+    raise FileNotFoundError(f"{selected_dir} hasn't been processed yet")
+
+
+def summarise(conn: sqlite3.Connection) -> str:
+    lines = [
+        f"{'stage':<10}{'runs':>6}{'failed':>8}{'wall':>10}{'cpu':>10}"
+        f"{'speed':>9}{'fps':>9}{'peak MB':>9}"
+    ]
+    cursor = conn.execute(
+        """SELECT stage, COUNT(*), SUM(returncode != 0), SUM(wall_secs), SUM(cpu_secs),
+            SUM(end_time - start_time), SUM(frames_out), MAX(peak_rss)
+        FROM ffmpeg_runs
+        GROUP BY stage
+        ORDER BY SUM(wall_secs) DESC"""
+    )
+    for stage, runs, failed, wall, cpu, footage, frames, peak in cursor.fetchall():
+        # How many seconds of recording went through per second of work
+        speed = f"{footage / wall:.1f}x" if footage and wall else "-"
+        fps = f"{frames / wall:.0f}" if frames and wall else "-"
+        lines.append(
+            f"{stage:<10}{runs:>6}{failed:>8}{wall:>9.1f}s{cpu:>9.1f}s"
+            f"{speed:>9}{fps:>9}{peak / 2**20:>9.0f}"
+        )
+
+    frames_in, frames_out = conn.execute(
+        f"""SELECT SUM(frames_in), SUM(frames_out)
+        FROM ffmpeg_runs
+        WHERE stage IN ({", ".join("?" * len(DEDUPE_STAGES))}) AND returncode = 0""",
+        DEDUPE_STAGES,
+    ).fetchone()
+    if frames_in:
+        lines += [
+            "",
+            f"Dedupe kept {frames_out} of {frames_in} frames decoded "
+            f"({frames_out / frames_in:.1%})",
+        ]
+
+    lines += ["", "Slowest runs:"]
+    cursor = conn.execute(
+        """SELECT stage, input_file, start_time, end_time, wall_secs, fps
+        FROM ffmpeg_runs
+        ORDER BY wall_secs DESC
+        LIMIT ?""",
+        [SLOWEST_RUNS],
+    )
+    for stage, input_file, start, end, wall, fps in cursor.fetchall():
+        time_range = f" {start:g}s-{end:g}s" if start is not None else ""
+        fps = f", {fps:.0f} fps" if fps else ""
+        lines.append(f"  {wall:.1f}s {stage} {Path(input_file).name}{time_range}{fps}")
+
+    return "\n".join(lines)
+
+
+def print_report(selected_dir: Path) -> None:
+    conn = open_runs(selected_dir)
+    try:
+        print(summarise(conn))
+    finally:
+        conn.close()
@@ -1,19 +1,77 @@
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import nullcontext
+import csv
 from datetime import datetime
 from decimal import Decimal
+from fractions import Fraction
+import hashlib
 from itertools import chain
+import os
 from queue import Queue
 from pathlib import Path
 from shutil import rmtree
+import socket
 import subprocess
-from typing import Iterator
-from vedit.db import DB, EditingTracker
+from threading import BoundedSemaphore
+import time
+from typing import Callable
+
+import psutil
+
+from vedit.chunk_cache import ChunkCache
+from vedit.db import DB, Job, TimeRange, VideoInfo
 
 from vedit.logger import get_logger
-from vedit.config import Config
-from vedit.ffmpeg import FFmpeg
+from vedit.config import Config, host_memory_usage
+from vedit.ffmpeg import FFmpeg, MemoryLimitExceeded
+from vedit.progress import Progress
+from vedit.frame_dedupe import (
+    INDEX_HEIGHT,
+    INDEX_WIDTH,
+    DuplicateDetector,
+    SignatureIndex,
+    analysis_mask,
+    find_frames_to_keep,
+    find_frames_to_keep_indexed,
+    region_mask,
+    require_numpy,
+    static_runs,
+    static_spans,
+)
 
 logger = get_logger()
 
+PROBE_WORKERS = 8
+# Leases are renewed while a job is running, this only matters after a crash.
+LEASE_SECS = 300
+# How often to check on jobs that other machines are working on
+POLL_SECS = 5
+# Chunks are sized to use this much of each ffmpeg's share of memory_budget_mb,
+# leaving room for footage that is harder to process than what was seen so far.
+MEMORY_TARGET = 0.6
+MIN_CHUNK_SECS = 5
+OUTPUT_FILE = "processed.mkv"
+# What every ffmpeg invocation cost, kept for `python -m vedit report` once
+# the working directory is cleaned up.
+RUNS_FILE = "processed.runs.sqlite"
+# How often a worker waiting on its piece of a source checks if it is written
+SEGMENT_POLL_SECS = 0.2
+# Segment lists have times to the microsecond, keyframe indexes to the millisecond
+SEGMENT_TOLERANCE_SECS = Decimal("0.002")
+# With a disk budget, finished chunks are merged into parts once there is
+# this much of the budget's worth of them in a row.
+PART_BUDGET_SHARE = 0.25
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
 
 def parse_filename(p: Path) -> datetime:
     parsing_options = [
@@ -30,29 +88,848 @@ def parse_filename(p: Path) -> datetime:
     raise RuntimeError("Could not get a meaningful value to order video files by")
 
 
+def probe_files(
+    ffmpeg: FFmpeg, db: DB, video_files: list[Path]
+) -> dict[Path, VideoInfo]:
+    video_infos = {f: db.get_video_info(f) for f in video_files}
+    if misses := [f for f, info in video_infos.items() if info is None]:
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as pool:
+            for video_file, info in zip(misses, pool.map(ffmpeg.probe, misses)):
+                db.save_video_info(video_file, info)
+                video_infos[video_file] = info
+
+    return video_infos
+
+
+def index_packets(
+    ffmpeg: FFmpeg,
+    db: DB,
+    video_files: list[Path],
+    video_infos: dict[Path, VideoInfo],
+    config: Config,
+) -> None:
+    """Make sure the db knows every file's keyframes and static runs.
+
+    Both come from one read of the packets, so jobs can be split on
+    keyframes and static spans left out without decoding anything.
+    """
+    misses = [
+        f
+        for f in video_files
+        if db.get_keyframes(f) is None
+        or db.get_static_runs(f, config.static_packet_bytes) is None
+    ]
+    if misses:
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as pool:
+            for video_file, packets in zip(misses, pool.map(ffmpeg.packets, misses)):
+                db.save_keyframes(
+                    video_file, [time for time, _, keyframe in packets if keyframe]
+                )
+                db.save_static_runs(
+                    video_file,
+                    config.static_packet_bytes,
+                    static_runs(
+                        packets,
+                        config.static_packet_bytes,
+                        video_infos[video_file].duration,
+                    ),
+                )
+
+
+def static_ranges(db: DB, video_file: Path, config: Config) -> list[TimeRange]:
+    """Ranges of video_file that don't need decoding, with static_span_secs set."""
+    if not config.static_span_secs:
+        return []
+    return static_spans(
+        db.get_static_runs(video_file, config.static_packet_bytes),
+        db.get_keyframes(video_file),
+        Decimal(config.static_span_secs),
+    )
+
+
+def memory_limit(config: Config) -> int | None:
+    """Bytes each ffmpeg may use, or None when there is no memory budget."""
+    if not config.memory_budget_mb:
+        return None
+    return config.memory_budget_mb * 2**20 // config.workers
+
+
+def make_ffmpeg(config: Config) -> FFmpeg:
+    return FFmpeg(
+        memory_limit=memory_limit(config),
+        bin_dir=Path(config.ffmpeg_dir) if config.ffmpeg_dir else None,
+        stall_secs=config.ffmpeg_stall_secs,
+    )
+
+
+def chunk_secs(db: DB, info: VideoInfo, config: Config) -> Decimal:
+    """How long the chunks of a video should be.
+
+    With a memory budget, that is worked out from how much memory chunks of
+    the same resolution needed so far.
+    """
+    limit = memory_limit(config)
+    model = limit and db.get_memory_model(info.width, info.height)
+    if not model:
+        if config.video_split_secs > 0:
+            return Decimal(config.video_split_secs)
+        # Not splitting at all is fine when memory use doesn't grow with the
+        # length of a chunk
+        return info.duration
+
+    fixed_bytes, bytes_per_sec = model
+    secs = int((limit * MEMORY_TARGET - fixed_bytes) / bytes_per_sec)
+    return Decimal(min(max(secs, MIN_CHUNK_SECS), info.duration))
+
+
+def splits_sources(config: Config) -> bool:
+    """Whether chunks are cut out of each source in one read, see Segments."""
+    return config.split_sources and not (
+        # These read chunks straight from the source, change chunk lengths
+        # as they go or leave jobs to other machines.
+        config.dedupe_from_source
+        or config.signature_index
+        or config.memory_budget_mb
+        or config.multi_host
+    )
+
+
+def matches(piece_range: TimeRange, time_range: TimeRange) -> bool:
+    return all(
+        abs(a - b) <= SEGMENT_TOLERANCE_SECS for a, b in zip(piece_range, time_range)
+    )
+
+
+class Segments:
+    """The chunks of each source, cut out in one sequential read ahead of the workers.
+
+    Sources are split one at a time in the background, in the order their
+    jobs are claimed, so each is read from start to end once instead of
+    being seeked into for every chunk. A worker waits for its piece to be
+    written while the split carries on with the pieces after it.
+
+    The segment muxer only cuts on keyframes, so pieces are matched to jobs
+    by the times in its segment list. Jobs without a piece spanning exactly
+    their range, jobs whose range changed since and jobs of a split that
+    failed get None and cut their chunk out themselves.
+    """
+
+    def __init__(
+        self, ffmpeg: FFmpeg, tmp_path: Path, plans: dict[Path, list[TimeRange]]
+    ) -> None:
+        self.ffmpeg = ffmpeg
+        self.tmp_path = tmp_path
+        # (source name, range) -> segment list, where the split starts and the split
+        self.pieces: dict[tuple[str, TimeRange], tuple[Path, Decimal, Future]] = {}
+        # Jobs that got their chunk some other way
+        self.discarded: set[tuple[str, TimeRange]] = set()
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        for video_file, ranges in plans.items():
+            # A single chunk is read in one go when it is cut out anyway
+            if len(ranges) < 2:
+                continue
+            bounds = sorted({t for time_range in ranges for t in time_range})
+            segment_list = tmp_path / f"{video_file.stem}-pieces.csv"
+            segment_list.unlink(missing_ok=True)
+            split = self.pool.submit(
+                self.split, video_file, bounds, segment_list, ranges
+            )
+            for time_range in ranges:
+                self.pieces[(video_file.name, time_range)] = (
+                    segment_list,
+                    bounds[0],
+                    split,
+                )
+
+    def split(
+        self,
+        video_file: Path,
+        bounds: list[Decimal],
+        segment_list: Path,
+        ranges: list[TimeRange],
+    ) -> None:
+        start_time = bounds[0]
+        try:
+            self.ffmpeg.split(
+                video_file,
+                self.tmp_path,
+                prefix=f"{video_file.stem}-piece",
+                split_at=[t - start_time for t in bounds[1:-1]],
+                time_range=(start_time, bounds[-1]),
+                segment_list=segment_list,
+            )
+        except subprocess.CalledProcessError:
+            logger.writeline(
+                f"Splitting {video_file} failed, cutting its chunks one by one"
+            )
+            return
+        # Nobody takes a piece that doesn't span the range of a pending job
+        # that still needs one
+        needed = [r for r in ranges if (video_file.name, r) not in self.discarded]
+        for name, time_range in self.written(segment_list, start_time):
+            if not any(matches(time_range, r) for r in needed):
+                self.tmp_path.joinpath(name).unlink(missing_ok=True)
+
+    @staticmethod
+    def written(segment_list: Path, start_time: Decimal) -> list[tuple[str, TimeRange]]:
+        """The pieces written so far, with the range of the source each spans."""
+        try:
+            with segment_list.open(newline="") as f:
+                return [
+                    (
+                        Path(name).name,
+                        (start_time + Decimal(start), start_time + Decimal(end)),
+                    )
+                    for name, start, end in csv.reader(f)
+                ]
+        except FileNotFoundError:
+            return []
+
+    def take(self, video_file: Path, time_range: TimeRange) -> Path | None:
+        """The piece of video_file spanning time_range, once it is written."""
+        if (piece := self.pieces.get((video_file.name, time_range))) is None:
+            return None
+        segment_list, start_time, split = piece
+        while True:
+            # Checked before the list, so the last piece isn't missed
+            finished = split.done()
+            written = self.written(segment_list, start_time)
+            for name, piece_range in written:
+                if matches(piece_range, time_range):
+                    path = self.tmp_path / name
+                    # Gone if an earlier attempt at the same job used it up
+                    return path if path.exists() else None
+            # Pieces are written in order, so one ending after time_range
+            # means it was cut elsewhere
+            if finished or (
+                written and written[-1][1][1] > time_range[1] + SEGMENT_TOLERANCE_SECS
+            ):
+                return None
+            time.sleep(SEGMENT_POLL_SECS)
+
+    def discard(self, video_file: Path, time_range: TimeRange) -> None:
+        """Remove the piece of a job that doesn't need it.
+
+        Without waiting for it, a piece written later is removed once its
+        source is split.
+        """
+        if (piece := self.pieces.get((video_file.name, time_range))) is None:
+            return
+        self.discarded.add((video_file.name, time_range))
+        segment_list, start_time, _ = piece
+        for name, piece_range in self.written(segment_list, start_time):
+            if matches(piece_range, time_range):
+                self.tmp_path.joinpath(name).unlink(missing_ok=True)
+
+    def __enter__(self) -> "Segments":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.pool.shutdown(cancel_futures=True)
+
+
+def dedupe(
+    ffmpeg: FFmpeg,
+    in_file: Path,
+    out_path: Path,
+    config: Config,
+    time_range: TimeRange | None = None,
+    index: SignatureIndex | None = None,
+    frame_size: tuple[int, int] | None = None,
+) -> Path:
+    options = dict(
+        time_range=time_range,
+        codec=config.intermediate_codec,
+        speed_multiplier=config.speed_multiplier if config.speedup_per_chunk else 1,
+    )
+    thresholds = dict(hi=config.dedupe_hi, lo=config.dedupe_lo, frac=config.dedupe_frac)
+    regions = config.regions
+    match config.dedupe_engine:
+        case "mpdecimate":
+            return ffmpeg.dedupe(
+                in_file, out_path, regions=regions, frame_size=frame_size, **options
+            )
+        case "two-pass":
+            keep = ffmpeg.analyse_duplicates(
+                in_file, time_range=time_range, regions=regions, **thresholds
+            )
+        case "numpy" if index is not None:
+            # Signatures are of the whole frame, so other regions can be
+            # tried without decoding it again.
+            detector = DuplicateDetector(
+                region_mask(
+                    INDEX_WIDTH,
+                    INDEX_HEIGHT,
+                    excluded=regions.exclude,
+                    included=regions.include,
+                ),
+                **thresholds,
+            )
+            keep = find_frames_to_keep_indexed(
+                ffmpeg, index, in_file, detector, time_range
+            )
+        case "numpy":
+            detector = DuplicateDetector(analysis_mask(regions), **thresholds)
+            keep = find_frames_to_keep(
+                ffmpeg, in_file, detector, time_range=time_range, regions=regions
+            )
+
+    # Only the frames worth keeping are decoded into the output, without any
+    # frames being held back for a filter graph to catch up.
+    return ffmpeg.select_frames(in_file, keep, out_path, **options)
+
+
+def process_chunk(
+    ffmpeg: FFmpeg,
+    video_file: Path,
+    tmp_path: Path,
+    time_range: TimeRange,
+    config: Config,
+    name_tag: str = "",
+    segments: Segments | None = None,
+    cache: ChunkCache | None = None,
+    frame_size: tuple[int, int] | None = None,
+) -> Path:
+    start_time, end_time = time_range
+    out_path = tmp_path / (
+        f"{video_file.stem}-{start_time}s-{end_time}s{name_tag}_processed{video_file.suffix}"
+    )
+    if cache:
+        if cache.get(video_file, time_range, config, out_path):
+            if segments:
+                segments.discard(video_file, time_range)
+            return out_path
+        # ffmpeg overwrites in place, which would change a chunk linked to
+        # from the cache too
+        out_path.unlink(missing_ok=True)
+    out_path = make_chunk(
+        ffmpeg,
+        video_file,
+        tmp_path,
+        time_range,
+        config,
+        out_path,
+        name_tag,
+        segments,
+        frame_size,
+    )
+    if cache:
+        cache.put(video_file, time_range, config, out_path)
+    return out_path
+
+
+def make_chunk(
+    ffmpeg: FFmpeg,
+    video_file: Path,
+    tmp_path: Path,
+    time_range: TimeRange,
+    config: Config,
+    out_path: Path,
+    name_tag: str,
+    segments: Segments | None,
+    frame_size: tuple[int, int] | None,
+) -> Path:
+    start_time, end_time = time_range
+    # Indexed frames are timed against the source file, so read straight from it
+    if config.dedupe_from_source or config.signature_index:
+        index = (
+            # Kept with the recordings rather than in a scratch_dir
+            SignatureIndex(video_file.parent / ".vedit" / "signatures")
+            if config.signature_index
+            else None
+        )
+        try:
+            dedupe(
+                ffmpeg,
+                video_file,
+                out_path,
+                config,
+                time_range=time_range,
+                index=index,
+                frame_size=frame_size,
+            )
+        except subprocess.CalledProcessError:
+            out_path.unlink(missing_ok=True)
+            raise
+        return out_path
+
+    sub_file = (segments and segments.take(video_file, time_range)) or (
+        ffmpeg.cut_section(
+            video_file,
+            tmp_path=tmp_path,
+            start_time=start_time,
+            end_time=end_time,
+            name_tag=name_tag,
+        )
+    )
+    try:
+        dedupe(ffmpeg, sub_file, out_path, config, frame_size=frame_size)
+    except subprocess.CalledProcessError:
+        out_path.unlink(missing_ok=True)
+        raise
+    finally:
+        sub_file.unlink(missing_ok=True)
+
+    return out_path
+
+
+def process_chunk_measured(ffmpeg: FFmpeg, *args, **kwargs) -> tuple[Path, int]:
+    """process_chunk, along with the most memory one of its ffmpegs used."""
+    ffmpeg.reset_peak_rss()
+    return process_chunk(ffmpeg, *args, **kwargs), ffmpeg.peak_rss()
+
+
+def report_progress(
+    message_queue: Queue, job: Job, total_duration: Decimal, frame_rate: Fraction
+) -> Callable[[Progress], None]:
+    start_time, end_time = job.time_range
+    length = float(end_time - start_time)
+
+    def report(progress: Progress) -> None:
+        # By what has been read, what is written shrinks with the duplicates
+        # dropped and the speedup
+        done = min(progress.frame / float(frame_rate), length)
+        message_queue.put(
+            ("progress", job.id, 95 * done / float(total_duration), progress.fps)
+        )
+
+    return report
+
+
+def process_job(
+    ffmpeg: FFmpeg,
+    message_queue: Queue,
+    total_duration: Decimal,
+    job: Job,
+    frame_rate: Fraction | None,
+    timeout: float | None,
+    process: Callable,
+    *args,
+):
+    """process_chunk on a worker thread, with ffmpeg's progress on the queue.
+
+    Without the frame_rate there is no telling how far it has got, only when
+    it is done. ffmpeg is stopped once the job has taken timeout seconds.
+    """
+    with ffmpeg.time_limit(timeout):
+        if frame_rate is None:
+            return process(ffmpeg, *args)
+        with ffmpeg.progress_to(
+            report_progress(message_queue, job, total_duration, frame_rate)
+        ):
+            return process(ffmpeg, *args)
+
+
+def job_timeout(job: Job, config: Config) -> float | None:
+    """Seconds the ffmpeg runs of job may take, None for no limit."""
+    start_time, end_time = job.time_range
+    return float(end_time - start_time) * config.ffmpeg_timeout_factor or None
+
+
+def merge_order(db: DB, video_file: Path, tmp_path: Path, config: Config) -> list[Path]:
+    chunks = db.get_merge_order(video_file)
+    if config.multi_host:
+        # Whoever processed a chunk may have the share mounted somewhere else
+        chunks = [tmp_path / chunk.name for chunk in chunks]
+    return chunks
+
+
+def work_dir(selected_dir: Path, config: Config) -> Path:
+    """Where chunks are written while they are worked on.
+
+    That is scratch_dir when there is one, unless other machines need to
+    see the chunks too.
+    """
+    if not config.scratch_dir or config.multi_host:
+        return selected_dir / ".vedit"
+    # Several folders can be processed at once, and share a name
+    digest = hashlib.sha1(selected_dir.resolve().as_posix().encode()).hexdigest()
+    return Path(config.scratch_dir) / f"{selected_dir.name}-{digest[:8]}"
+
+
+def merges_parts(config: Config) -> bool:
+    """Whether chunks are merged into parts as they finish, see PartMerger."""
+    # Chunks of other machines would have to be found on the share first
+    return bool(config.disk_budget_mb) and not config.multi_host
+
+
+def disk_usage(path: Path) -> int:
+    usage = 0
+    for child in path.iterdir():
+        try:
+            usage += child.stat().st_size
+        except FileNotFoundError:
+            # Finished with in the meantime
+            continue
+    return usage
+
+
+class PartMerger:
+    """Merges finished chunks into parts as soon as the chunks before them are done.
+
+    The parts go to .vedit and the chunks are deleted, so only the chunks
+    finished out of order are left in the work directory however long the
+    recordings are. Parts are sped up like the final video, which then only
+    needs them stream copied together. One merge runs at a time, on pool,
+    while the db is only used on the thread calling poll.
+    """
+
+    def __init__(
+        self,
+        db: DB,
+        ffmpeg: FFmpeg,
+        config: Config,
+        tmp_path: Path,
+        work_path: Path,
+        pool: ThreadPoolExecutor,
+    ) -> None:
+        self.db = db
+        self.ffmpeg = ffmpeg
+        self.config = config
+        self.tmp_path = tmp_path
+        self.work_path = work_path
+        self.pool = pool
+        self.min_bytes = config.disk_budget_mb * 2**20 * PART_BUDGET_SHARE
+        self.merging: tuple[Path, list[tuple[TimeRange, Path]], Future] | None = None
+
+    def merge(self, chunks: list[Path], part: Path) -> Path:
+        if self.config.speedup_per_chunk:
+            return self.ffmpeg.concat(
+                chunks, output_path=part, concat_file=self.work_path / "parts.txt"
+            )
+        return self.ffmpeg.combine_and_speedup(
+            chunks,
+            speed_multiplier=self.config.speed_multiplier,
+            output_path=part,
+            tmp_path=self.work_path,
+        )
+
+    def poll(self, video_files: list[Path], final: bool = False) -> bool:
+        """Start merging the next chunks that are ready, returning whether busy.
+
+        With final, whatever chunks are left are merged whether they follow
+        on or not, waiting for each merge.
+        """
+        if self.merging:
+            video_file, chunks, future = self.merging
+            if not final and not future.done():
+                return True
+            part = future.result()
+            self.db.record_part(video_file, chunks, part)
+            for _, chunk in chunks:
+                chunk.unlink(missing_ok=True)
+            self.merging = None
+
+        for video_file in video_files:
+            if final:
+                chunks = self.db.get_chunks(video_file)
+            else:
+                chunks = self.db.next_chunks_to_merge(video_file)
+                # Small parts only once there is nothing more to come
+                if sum(
+                    chunk.stat().st_size for _, chunk in chunks
+                ) < self.min_bytes and not self.db.file_done(video_file):
+                    continue
+            if not chunks:
+                continue
+            (start_time, _), _ = chunks[0]
+            (_, end_time), _ = chunks[-1]
+            part = self.tmp_path / (
+                f"{video_file.stem}-{start_time}s-{end_time}s_part{video_file.suffix}"
+            )
+            future = self.pool.submit(self.merge, [c for _, c in chunks], part)
+            self.merging = video_file, chunks, future
+            return True
+        return False
+
+    def finish(self, video_files: list[Path]) -> None:
+        while self.poll(video_files, final=True):
+            pass
+
+
+def process_jobs(
+    db: DB,
+    ffmpeg: FFmpeg,
+    config: Config,
+    selected_dir: Path,
+    message_queue: Queue,
+    total_duration: Decimal,
+    files_to_merge: list[Path],
+    video_infos: dict[Path, VideoInfo] | None = None,
+    budget: BoundedSemaphore | None = None,
+) -> dict[Path, Path]:
+    """Work through the job table until every job is done.
+
+    Each job takes one of the workers in budget, which can be shared with
+    other folders.
+    With speedup_per_chunk, each file in files_to_merge is stream-copied
+    together as soon as it is finished and the merged files are returned.
+    With a memory budget, the memory use of finished chunks decides how long
+    the chunks still to do should be, for the video_infos given.
+    With a disk budget, no more jobs are started while the work directory is
+    over it, and finished chunks are merged into parts as they go (see
+    PartMerger) instead.
+    """
+    tmp_path = selected_dir / ".vedit"
+    work_path = work_dir(selected_dir, config)
+    disk_budget = config.disk_budget_mb * 2**20
+    owner = worker_id()
+    measure = memory_limit(config) is not None
+    # Matched by name, other machines may have the folder mounted elsewhere
+    infos = {video_file.name: info for video_file, info in (video_infos or {}).items()}
+    budget = budget or BoundedSemaphore(config.workers)
+    # Chunk names must not clash with another machine redoing an expired job
+    name_tag = f"_{owner.replace(':', '-')}" if config.multi_host else ""
+
+    segments = (
+        Segments(
+            ffmpeg,
+            work_path,
+            {
+                video_file: db.pending_ranges(video_file)
+                for video_file in files_to_merge
+            },
+        )
+        if splits_sources(config)
+        else None
+    )
+    cache = (
+        ChunkCache(Path(config.chunk_cache_dir), config.chunk_cache_mb * 2**20)
+        if config.chunk_cache_dir
+        else None
+    )
+    # ffmpeg does the heavy lifting in its own process, so threads are enough to
+    # keep several chunks going at once. All db access stays on this thread.
+    with ThreadPoolExecutor(max_workers=config.workers) as pool, ThreadPoolExecutor(
+        max_workers=1
+    ) as merge_pool, segments or nullcontext():
+        in_flight: dict[Future, Job] = {}
+        merges: dict[Path, Future] = {}
+        parts = (
+            PartMerger(db, ffmpeg, config, tmp_path, work_path, merge_pool)
+            if merges_parts(config) and files_to_merge
+            else None
+        )
+
+        def claim() -> Job | None:
+            # Running jobs finish and make room, with none running one has to
+            # be started anyway.
+            if in_flight and disk_budget and disk_usage(work_path) >= disk_budget:
+                return None
+            # With nothing running there is nothing else to do than wait for
+            # another folder to free up a worker.
+            if not budget.acquire(blocking=not in_flight):
+                return None
+            if (job := db.claim_job(owner, LEASE_SECS)) is None:
+                budget.release()
+            return job
+
+        while True:
+            while len(in_flight) < config.workers and (job := claim()):
+                start_time, end_time = job.time_range
+                message_queue.put(
+                    (
+                        "step",
+                        0,
+                        f"Processing {start_time}s-{end_time}s of {job.source_file}",
+                    )
+                )
+                info = infos.get(job.source_file.name)
+                future = pool.submit(
+                    process_job,
+                    ffmpeg,
+                    message_queue,
+                    total_duration,
+                    job,
+                    info.frame_rate if info else None,
+                    job_timeout(job, config),
+                    process_chunk_measured if measure else process_chunk,
+                    selected_dir / job.source_file.name,
+                    work_path,
+                    job.time_range,
+                    config,
+                    name_tag,
+                    segments,
+                    cache,
+                    (info.width, info.height) if info else None,
+                )
+                # Given back even if this folder fails, so others can carry on
+                future.add_done_callback(lambda _: budget.release())
+                in_flight[future] = job
+
+            if parts:
+                parts.poll(files_to_merge)
+            elif config.speedup_per_chunk:
+                # Chunks are already sped up, so each file can be stream-copied
+                # together as soon as it is finished while other chunks carry on.
+                for video_file in files_to_merge:
+                    if video_file not in merges and db.file_done(video_file):
+                        merges[video_file] = merge_pool.submit(
+                            ffmpeg.concat,
+                            merge_order(db, video_file, tmp_path, config),
+                            output_path=tmp_path
+                            / f"{video_file.stem}_merged{video_file.suffix}",
+                            concat_file=tmp_path / f"{video_file.stem}_concat.txt",
+                        )
+
+            if not in_flight:
+                if not config.multi_host or "leased" not in db.count_jobs():
+                    break
+                # Other machines are still busy, their jobs may yet fail and be
+                # split up or have their leases expire.
+                time.sleep(POLL_SECS)
+                continue
+
+            finished, _ = wait(
+                in_flight, timeout=LEASE_SECS / 3, return_when=FIRST_COMPLETED
+            )
+            db.renew_leases(owner, list(in_flight.values()), LEASE_SECS)
+            db.record_runs(ffmpeg.take_runs())
+            for future in finished:
+                job = in_flight.pop(future)
+                start_time, end_time = job.time_range
+                info = infos.get(job.source_file.name)
+                message_queue.put(("progress", job.id, None, 0))
+                try:
+                    result = future.result()
+                except MemoryLimitExceeded:
+                    # Retry at the size that should fit rather than halving
+                    # until it does.
+                    db.fail_job(
+                        job, max_secs=chunk_secs(db, info, config) if info else None
+                    )
+                    continue
+                except subprocess.CalledProcessError:
+                    db.fail_job(job)
+                    continue
+
+                chunk_path, peak_rss = result if measure else (result, 0)
+                if not db.complete_job(job, chunk_path):
+                    chunk_path.unlink(missing_ok=True)
+                    continue
+
+                if info and peak_rss:
+                    db.record_memory_usage(
+                        info.width, info.height, end_time - start_time, peak_rss
+                    )
+                    db.split_pending_jobs(
+                        [
+                            source_file
+                            for source_file in db.get_source_files()
+                            if (other := infos.get(source_file.name))
+                            and (other.width, other.height) == (info.width, info.height)
+                        ],
+                        chunk_secs(db, info, config),
+                    )
+
+                step = 95 * ((end_time - start_time) / (total_duration))
+                message_queue.put(
+                    (
+                        "step",
+                        step,
+                        f"Processed {start_time}s-{end_time}s of {job.source_file}",
+                    )
+                )
+
+        merged_files = {
+            video_file: merge.result() for video_file, merge in merges.items()
+        }
+        if parts:
+            parts.finish(files_to_merge)
+    if cache:
+        logger.writeline(f"Reused {cache.hits} chunks from {cache.cache_dir}")
+    db.record_runs(ffmpeg.take_runs())
+    return merged_files
+
+
+def open_db(tmp_path: Path, config: Config) -> DB:
+    db = DB.create_db(
+        tmp_path / "db.sqlite", shared_as=worker_id() if config.multi_host else None
+    )
+    db.release_dead_leases(socket.gethostname(), psutil.pid_exists)
+    return db
+
+
+def clean_up(tmp_path: Path, keep_signatures: bool = False) -> None:
+    if not keep_signatures:
+        rmtree(tmp_path)
+        return
+
+    # The index is what makes trying other dedupe settings quick next time
+    for path in tmp_path.iterdir():
+        if path.name == "signatures":
+            continue
+        if path.is_dir():
+            rmtree(path)
+        else:
+            path.unlink()
+
+
 def process_dir(
     selected_dir: Path,
     message_queue: Queue,
     ffmpeg: FFmpeg | None = None,
     config: Config | None = None,
     db: DB | None = None,
+    budget: BoundedSemaphore | None = None,
+    new_logfile: bool = True,
 ) -> None:
+    if new_logfile:
+        logger.make_new_logfile()
     config = config or Config.load()
-    logger.make_new_logfile()
+    if config.dedupe_engine == "numpy":
+        require_numpy()
     tmp_path = selected_dir / ".vedit"
     tmp_path.mkdir(parents=True, exist_ok=True)
 
-    db = db or DB.create_db(tmp_path / "db.sqlite")
+    db = db or open_db(tmp_path, config)
 
-    ffmpeg = ffmpeg or FFmpeg()
+    ffmpeg = ffmpeg or make_ffmpeg(config)
 
-    out_path = selected_dir / "processed.mkv"
+    out_path = selected_dir / OUTPUT_FILE
 
     if out_path.exists():
         message_queue.put(("skipped", out_path))
+        db.close()
+        return
 
     files_to_process = sorted(selected_dir.glob("*.mkv"), key=parse_filename)
-    total_duration = sum(map(ffmpeg.get_video_duration, files_to_process))
+    process_files(
+        db,
+        ffmpeg,
+        config,
+        selected_dir,
+        files_to_process,
+        out_path,
+        message_queue,
+        budget=budget,
+    )
+    message_queue.put(("done", out_path))
+
+
+def process_files(
+    db: DB,
+    ffmpeg: FFmpeg,
+    config: Config,
+    selected_dir: Path,
+    files_to_process: list[Path],
+    out_path: Path,
+    message_queue: Queue,
+    budget: BoundedSemaphore | None = None,
+    append_runs: bool = False,
+) -> None:
+    """Edit files_to_process into out_path, then clean up the working directory."""
+    tmp_path = selected_dir / ".vedit"
+    work_path = work_dir(selected_dir, config)
+    work_path.mkdir(parents=True, exist_ok=True)
+    video_infos = probe_files(ffmpeg, db, files_to_process)
+    index_packets(ffmpeg, db, files_to_process, video_infos, config)
+    # Chunk lengths pick up from what other folders found out
+    if memory_limit(config):
+        db.import_memory_usage(host_memory_usage())
+    if not config.multi_host:
+        db.requeue_missing_outputs(Path.exists)
+    total_duration = sum(info.duration for info in video_infos.values())
     total_processed_duration = db.get_total_processed_duration(files_to_process)
 
     start = 95 * ((total_processed_duration) / (total_duration))
@@ -63,52 +940,154 @@ def process_dir(
     )
     message_queue.put(("step", start, msg))
 
-    for video_file in files_to_process:
-        file_duration: Decimal = ffmpeg.get_video_duration(video_file=video_file)
-
-        vs = EditingTracker(
-            video_file, file_duration, split_time=config.video_split_secs, db=db
+    for file_order, video_file in enumerate(files_to_process):
+        info = video_infos[video_file]
+        db.plan_jobs(
+            video_file,
+            file_order,
+            info.duration,
+            split_time=chunk_secs(db, info, config),
+            static=static_ranges(db, video_file, config),
         )
 
-        while (current_range := vs.next()) is not None:
-            start_time, end_time = current_range
-            range_str = f"{start_time}s-{end_time}s"
-            message_queue.put(("step", 0, f"Cutting out {range_str} from {video_file}"))
-            sub_file = ffmpeg.cut_section(
-                video_file, tmp_path=tmp_path, start_time=start_time, end_time=end_time
-            )
-
-            message_queue.put(("step", 0, f"Processing {range_str} of {video_file}"))
-            out_path = sub_file.parent / f"{sub_file.stem}_processed{sub_file.suffix}"
-            try:
-                ffmpeg.dedupe(sub_file, out_path)
-            except subprocess.CalledProcessError:
-                sub_file.unlink(missing_ok=True)
-                out_path.unlink(missing_ok=True)
-                vs.failed(current_range)
-                continue
+    merged_files = process_jobs(
+        db,
+        ffmpeg,
+        config,
+        selected_dir,
+        message_queue,
+        total_duration,
+        files_to_merge=files_to_process,
+        video_infos=video_infos,
+        budget=budget,
+    )
 
-            step = 95 * ((end_time - start_time) / (total_duration))
-            message_queue.put(
-                ("step", step, f"Processing {start_time}s-{end_time}s of {video_file}")
+    # The final merge counts against the budget like any other ffmpeg
+    with budget or nullcontext():
+        if merges_parts(config):
+            message_queue.put(("step", 0, "Merging parts"))
+            ffmpeg.concat(
+                [
+                    part
+                    for video_file in files_to_process
+                    for part in db.get_parts(video_file)
+                ],
+                output_path=out_path,
+                concat_file=tmp_path / "concat.txt",
+            )
+        elif config.speedup_per_chunk:
+            message_queue.put(("step", 0, "Merging files"))
+            ffmpeg.concat(
+                [merged_files[video_file] for video_file in files_to_process],
+                output_path=out_path,
+                concat_file=tmp_path / "concat.txt",
+            )
+        else:
+            processed_paths = list(
+                chain.from_iterable(
+                    merge_order(db, video_file, tmp_path, config)
+                    for video_file in files_to_process
+                )
             )
-            vs.success(out_path, current_range)
-            sub_file.unlink(missing_ok=True)
-
-    processed_paths = list(
-        chain.from_iterable(map(db.get_merge_order, files_to_process))
-    )
 
-    message_queue.put(("step", 0, "Merging/Speeding up files"))
-    ffmpeg.combine_and_speedup(
-        processed_paths,
-        speed_multiplier=config.speed_multiplier,
-        output_path=out_path,
-        tmp_path=tmp_path,
-    )
+            message_queue.put(("step", 0, "Merging/Speeding up files"))
+            ffmpeg.combine_and_speedup(
+                processed_paths,
+                speed_multiplier=config.speed_multiplier,
+                output_path=out_path,
+                tmp_path=tmp_path,
+            )
     message_queue.put(("step", 5, "Merging Complete"))
+    ffmpeg.log_stage_timings()
+    db.record_runs(ffmpeg.take_runs())
+    db.export_runs(selected_dir / RUNS_FILE, append=append_runs)
+    if memory_limit(config):
+        db.export_memory_usage(host_memory_usage())
 
-    message_queue.put(("done", out_path))
+    db.close()
+    if work_path != tmp_path:
+        rmtree(work_path)
+    clean_up(tmp_path, keep_signatures=config.signature_index)
+
+
+def process_batch(
+    selected_dirs: list[Path],
+    message_queues: dict[Path, Queue],
+    config: Config | None = None,
+    ffmpeg: FFmpeg | None = None,
+) -> dict[Path, BaseException]:
+    """Process several folders at once, sharing config.workers between them.
+
+    Folders that fail don't stop the others, their errors are returned.
+    """
+    logger.make_new_logfile()
+    config = config or Config.load()
+    budget = BoundedSemaphore(config.workers)
+    failures: dict[Path, BaseException] = {}
+    with ThreadPoolExecutor(max_workers=len(selected_dirs) or 1) as pool:
+        futures = {
+            pool.submit(
+                process_dir,
+                selected_dir,
+                message_queues[selected_dir],
+                ffmpeg=ffmpeg,
+                config=config,
+                budget=budget,
+                new_logfile=False,
+            ): selected_dir
+            for selected_dir in selected_dirs
+        }
+        for future in as_completed(futures):
+            if error := future.exception():
+                logger.writeline(f"Processing {futures[future]} failed: {error!r}")
+                failures[futures[future]] = error
+    return failures
+
+
+def run_worker(
+    selected_dir: Path,
+    message_queue: Queue,
+    ffmpeg: FFmpeg | None = None,
+    config: Config | None = None,
+    db: DB | None = None,
+) -> None:
+    """Help with a folder that is being coordinated by process_dir elsewhere.
+
+    Workers only process chunks, planning and merging is left to the
+    coordinator. The folder has to be shared with the coordinator and every
+    machine needs multi_host enabled.
+    """
+    config = config or Config.load()
+    tmp_path = selected_dir / ".vedit"
+
+    # Nothing to do until the coordinator has planned the jobs
+    while not (tmp_path / "db.sqlite").exists():
+        time.sleep(POLL_SECS)
+    db = db or open_db(tmp_path, config)
+    while not db.count_jobs():
+        time.sleep(POLL_SECS)
+
+    ffmpeg = ffmpeg or make_ffmpeg(config)
+    message_queue.put(("step", 0, f"Working on {selected_dir} as {worker_id()}"))
+    video_files = sorted(selected_dir.glob("*.mkv"))
+    # Probing is only worth it to size chunks by how much memory they use,
+    # otherwise what the coordinator probed does.
+    video_infos = (
+        probe_files(ffmpeg, db, video_files)
+        if memory_limit(config)
+        else {f: info for f in video_files if (info := db.get_video_info(f))}
+    )
+    process_jobs(
+        db,
+        ffmpeg,
+        config,
+        selected_dir,
+        message_queue,
+        db.get_total_planned_duration(),
+        files_to_merge=[],
+        video_infos=video_infos,
+    )
+    ffmpeg.log_stage_timings()
+    message_queue.put(("done", selected_dir))
 
     db.close()
-    rmtree(tmp_path)
@@ -0,0 +1,241 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+import os
+from pathlib import Path
+from queue import Queue
+from shutil import rmtree
+from threading import BoundedSemaphore, Event
+import time
+
+from vedit.config import Config
+from vedit.ffmpeg import FFmpeg
+from vedit.frame_dedupe import require_numpy
+from vedit.logger import get_logger
+from vedit.video_editor import (
+    OUTPUT_FILE,
+    make_ffmpeg,
+    open_db,
+    parse_filename,
+    process_files,
+)
+
+logger = get_logger()
+
+# How often folders are checked for new recordings
+WATCH_POLL_SECS = 5
+# How long to leave a folder alone after processing its new recordings failed
+WATCH_RETRY_SECS = 300
+# The recordings that are in processed.mkv or waiting in PARTS_DIR to be
+# joined onto it, one name per line
+MANIFEST_FILE = "processed.files.txt"
+# New recordings are edited here before being added onto processed.mkv
+WATCH_DIR = ".vedit-watch"
+# Each batch of new recordings once edited, in order. Joining them onto
+# processed.mkv copies all of it, so that is left until there are a few.
+PARTS_DIR = ".vedit-parts"
+
+
+def included_files(selected_dir: Path) -> set[str]:
+    """Names of the recordings that processed.mkv and its parts already cover."""
+    manifest = selected_dir / MANIFEST_FILE
+    if manifest.exists():
+        return set(manifest.read_text().splitlines())
+
+    # Made before watching, or the manifest wasn't written in time. Anything
+    # older than the output went into it.
+    out_path = selected_dir / OUTPUT_FILE
+    if not out_path.exists():
+        return set()
+    made_at = out_path.stat().st_mtime
+    return {
+        video_file.name
+        for video_file in selected_dir.glob("*.mkv")
+        if video_file != out_path and video_file.stat().st_mtime <= made_at
+    }
+
+
+def finished_recordings(
+    selected_dir: Path, sizes: dict[Path, int], config: Config
+) -> list[Path]:
+    """Recordings that aren't in processed.mkv yet and have stopped changing.
+
+    A recording is finished once it hasn't been written to for
+    watch_settle_secs and its size is the same as at the last check, which
+    sizes keeps track of between calls.
+    """
+    included = included_files(selected_dir)
+    finished = []
+    now = time.time()
+    for video_file in selected_dir.glob("*.mkv"):
+        if video_file.name == OUTPUT_FILE or video_file.name in included:
+            continue
+        stat = video_file.stat()
+        if (
+            sizes.get(video_file) == stat.st_size
+            and now - stat.st_mtime >= config.watch_settle_secs
+        ):
+            finished.append(video_file)
+        sizes[video_file] = stat.st_size
+    return sorted(finished, key=parse_filename)
+
+
+def extend_output(
+    selected_dir: Path,
+    new_files: list[Path],
+    message_queue: Queue,
+    config: Config,
+    ffmpeg: FFmpeg | None = None,
+    budget: BoundedSemaphore | None = None,
+) -> Path:
+    """Edit new_files into a part to be joined onto the end of processed.mkv.
+
+    The first batch becomes processed.mkv straight away. See join_parts.
+    """
+    if config.dedupe_engine == "numpy":
+        require_numpy()
+    out_path = selected_dir / OUTPUT_FILE
+    # Worked out before processed.mkv changes, in case it is by modified time
+    included = included_files(selected_dir) | {f.name for f in new_files}
+    work_path = selected_dir / WATCH_DIR
+    work_path.mkdir(exist_ok=True)
+    tmp_path = selected_dir / ".vedit"
+    tmp_path.mkdir(exist_ok=True)
+
+    db = open_db(tmp_path, config)
+    ffmpeg = ffmpeg or make_ffmpeg(config)
+    part_path = work_path / "part.mkv"
+    process_files(
+        db,
+        ffmpeg,
+        config,
+        selected_dir,
+        new_files,
+        part_path,
+        message_queue,
+        budget=budget,
+        append_runs=out_path.exists(),
+    )
+
+    parts = pending_parts(selected_dir)
+    # After whatever parts are still waiting, even if processed.mkv is gone
+    if out_path.exists() or parts:
+        parts_path = selected_dir / PARTS_DIR
+        parts_path.mkdir(exist_ok=True)
+        os.replace(part_path, parts_path / f"part-{len(parts):05d}.mkv")
+    else:
+        os.replace(part_path, out_path)
+
+    (selected_dir / MANIFEST_FILE).write_text("\n".join(sorted(included)) + "\n")
+    rmtree(work_path)
+    message_queue.put(("done", out_path))
+    return out_path
+
+
+def pending_parts(selected_dir: Path) -> list[Path]:
+    return sorted((selected_dir / PARTS_DIR).glob("part-*.mkv"))
+
+
+def join_parts(
+    selected_dir: Path,
+    message_queue: Queue,
+    ffmpeg: FFmpeg,
+    budget: BoundedSemaphore | None = None,
+) -> Path:
+    """Add every part waiting onto the end of processed.mkv, in one go."""
+    out_path = selected_dir / OUTPUT_FILE
+    if not (parts := pending_parts(selected_dir)):
+        return out_path
+
+    message_queue.put(("step", 0, f"Adding {len(parts)} parts onto {out_path}"))
+    parts_path = selected_dir / PARTS_DIR
+    joined_path = parts_path / "joined.mkv"
+    # All were encoded the same way, so they can be stream copied together
+    with budget or nullcontext():
+        ffmpeg.concat(
+            [out_path, *parts] if out_path.exists() else parts,
+            output_path=joined_path,
+            concat_file=parts_path / "concat.txt",
+        )
+    os.replace(joined_path, out_path)
+    rmtree(parts_path)
+    return out_path
+
+
+def watch_dirs(
+    selected_dirs: list[Path],
+    message_queues: dict[Path, Queue],
+    config: Config | None = None,
+    ffmpeg: FFmpeg | None = None,
+    stop: Event | None = None,
+) -> None:
+    """Keep processed.mkv in each folder up to date until stop is set.
+
+    New recordings are joined onto it at most every watch_join_secs, and once
+    more when stopping. config.workers is shared between the folders like in
+    process_batch.
+    """
+    stop = stop or Event()
+    logger.make_new_logfile()
+    config = config or Config.load()
+    ffmpeg = ffmpeg or make_ffmpeg(config)
+    budget = BoundedSemaphore(config.workers)
+    sizes: dict[Path, int] = {}
+    busy: dict[Path, Future] = {}
+    retry_at: dict[Path, float] = {}
+    # Parts left over from last time are joined straight away
+    joined_at = dict.fromkeys(selected_dirs, float("-inf"))
+
+    def check_finished() -> None:
+        for selected_dir, future in list(busy.items()):
+            if not future.done():
+                continue
+            del busy[selected_dir]
+            if error := future.exception():
+                logger.writeline(f"Processing {selected_dir} failed: {error!r}")
+                message_queues[selected_dir].put(("failed", error))
+                retry_at[selected_dir] = time.monotonic() + WATCH_RETRY_SECS
+
+    with ThreadPoolExecutor(max_workers=len(selected_dirs) or 1) as pool:
+        while not stop.is_set():
+            check_finished()
+            for selected_dir in selected_dirs:
+                if (
+                    selected_dir in busy
+                    or retry_at.get(selected_dir, 0) > time.monotonic()
+                ):
+                    continue
+                if new_files := finished_recordings(selected_dir, sizes, config):
+                    busy[selected_dir] = pool.submit(
+                        extend_output,
+                        selected_dir,
+                        new_files,
+                        message_queues[selected_dir],
+                        config,
+                        ffmpeg,
+                        budget,
+                    )
+                elif (
+                    config.watch_join_secs
+                    and time.monotonic() - joined_at[selected_dir]
+                    >= config.watch_join_secs
+                    and pending_parts(selected_dir)
+                ):
+                    joined_at[selected_dir] = time.monotonic()
+                    busy[selected_dir] = pool.submit(
+                        join_parts,
+                        selected_dir,
+                        message_queues[selected_dir],
+                        ffmpeg,
+                        budget,
+                    )
+            stop.wait(WATCH_POLL_SECS)
+
+        # Let what was started finish rather than leave half a recording
+        wait(busy.values())
+        check_finished()
+        for selected_dir in selected_dirs:
+            busy[selected_dir] = pool.submit(
+                join_parts, selected_dir, message_queues[selected_dir], ffmpeg, budget
+            )
+        wait(busy.values())
+        check_finished()